@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+ClassChat asyncio Server Engine
+Single-threaded event loop transport for the ClassChat chat logic.
+
+Instead of one thread per client, every connection is a lightweight
+coroutine driven by asyncio.start_server(). An idle client costs a
+StreamReader/StreamWriter pair, a small decode buffer and a writer task
+that drains its outbound queue, so a single process can hold tens of
+thousands of classroom connections.
+
+The engine knows nothing about chat semantics. It calls three hooks:
+    on_connect(connection)          - connection accepted
+    on_frame(connection, payload)   - one complete frame received;
+                                      return False to close the connection
+                                      (or hand it off, see connection.py)
+    on_disconnect(connection)       - connection closed (always called)
+
+on_start(adopt) is called once the server listens; adopt(sock, address,
+preload) takes over a socket accepted by another worker.
+
+Everything on the loop thread holds up every connection, so the hooks
+must not wait on disk or on locks that other threads keep for long (the
+offline store's SQLite calls, spool writes, the store's sweeper). For a
+frame that needs to, on_frame returns a continuation (a callable) instead
+of True/False: the engine runs it on one of io_threads I/O threads and
+uses its result, and reads nothing more from that client until it is
+done, so each client's frames are still handled in order. on_disconnect
+always runs on an I/O thread. Serializing, compressing and queueing stay
+on the loop.
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from connection import Connection, FileRegion, OutboundQueue, WRITE_BATCH_BYTES
+from framing import FrameDecoder, FrameError, RECV_BUFFER_SIZE
+
+# Threads for hook calls that may block (see above)
+IO_THREADS = 4
+
+class AsyncConnection(Connection):
+    """Connection backed by an asyncio StreamWriter and a writer task"""
+    
+    def __init__(self, writer, loop):
+        super().__init__(writer.get_extra_info('peername'))
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.ready = asyncio.Event()
+        self.room = asyncio.Event()
+    
+    def wake_writer(self):
+        """Wake the writer task (safe to call from any thread)"""
+        if threading.get_ident() == self.loop_thread:
+            self.ready.set()
+        else:
+            self.loop.call_soon_threadsafe(self.ready.set)
+    
+    async def write_loop(self):
+        """Drain the outbound queue into the transport, honouring flow control"""
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                
+                while True:
+                    with self.outbound_lock:
+                        if not self.outbound:
+                            break
+                        batch, stamps = self.outbound.pop_batch(WRITE_BATCH_BYTES)
+                        self.drained.notify_all()
+                    
+                    for piece in self.pack(batch):
+                        if isinstance(piece, FileRegion):
+                            # Waits for the bytes before it to be flushed, then sendfile()
+                            await self.loop.sendfile(self.writer.transport, piece.file, piece.offset, piece.count)
+                        else:
+                            self.writer.write(piece)
+                    self.room.set()
+                    await self.writer.drain()
+                    self.sent(stamps)
+                
+                if self.closing:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            with self.outbound_lock:
+                self.closing = True
+            self.room.set()
+            self.writer.close()
+    
+    async def wait_for_room(self):
+        """
+        Pause reading while this client's own replies are backed up.
+        Replies then throttle the sender instead of overflowing its queue.
+        """
+        while len(self.outbound) >= self.queue_limit // 2 and not self.closing:
+            self.room.clear()
+            await self.room.wait()
+        
+        # A relayed file waits for its receiver
+        target, self.throttled_by = self.throttled_by, None
+        if target:
+            await target.wait_for_drain()
+    
+    async def wait_for_drain(self):
+        """Wait until this client's queue is below the relay window"""
+        while self.backlogged():
+            self.room.clear()
+            await self.room.wait()
+    
+    def abort(self):
+        """Drop the connection immediately"""
+        with self.outbound_lock:
+            self.closing = True
+            self.outbound = OutboundQueue()
+        if threading.get_ident() == self.loop_thread:
+            self.room.set()
+            self.writer.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.room.set)
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+async def handle_connection(reader, writer, on_connect, on_frame, on_disconnect, io_executor, preload=None):
+    """
+    Read frames from one client and dispatch them to the chat logic.
+    preload: bytes already read by another worker (on_connect is skipped).
+    """
+    loop = asyncio.get_running_loop()
+    connection = AsyncConnection(writer, loop)
+    writer_task = asyncio.create_task(connection.write_loop())
+    decoder = FrameDecoder()
+    
+    try:
+        if preload is None:
+            on_connect(connection)
+            data = await reader.read(RECV_BUFFER_SIZE)
+        else:
+            data = preload
+        
+        while data:
+            connection.received_at = time.perf_counter()
+            
+            payloads = decoder.feed(data)
+            for index, payload in enumerate(payloads):
+                result = on_frame(connection, payload)
+                if callable(result):
+                    # Needs disk or a store lock: finish it off the loop
+                    result = await loop.run_in_executor(io_executor, result)
+                if not result:
+                    if connection.handoff:
+                        # Another worker takes the client from this frame on
+                        connection.hand_off(writer.get_extra_info('socket'), payloads[index:], decoder)
+                    return
+            
+            await connection.wait_for_room()
+            data = await reader.read(RECV_BUFFER_SIZE)
+    
+    except (ConnectionError, FrameError) as e:
+        print(f"[ERROR] Client handler error: {e}")
+    finally:
+        # Cancels transfers and queues what the client missed
+        await loop.run_in_executor(io_executor, on_disconnect, connection)
+        connection.close()
+        await writer_task
+
+async def serve(host, port, on_connect, on_frame, on_disconnect, backlog=100, reuse_port=False, on_start=None,
+                io_threads=IO_THREADS):
+    """Accept connections forever on host:port"""
+    loop = asyncio.get_running_loop()
+    io_executor = ThreadPoolExecutor(io_threads, thread_name_prefix="io")
+    
+    async def client_connected(reader, writer):
+        await handle_connection(reader, writer, on_connect, on_frame, on_disconnect, io_executor)
+    
+    async def adopted(sock, preload):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await handle_connection(reader, writer, on_connect, on_frame, on_disconnect, io_executor, preload)
+    
+    def adopt(sock, address, preload):
+        """Take over a socket from another worker (safe to call from any thread)"""
+        loop.call_soon_threadsafe(lambda: loop.create_task(adopted(sock, preload)))
+    
+    server = await asyncio.start_server(
+        client_connected, host, port, backlog=backlog, reuse_address=True, reuse_port=reuse_port or None
+    )
+    if on_start:
+        on_start(adopt)
+    async with server:
+        await server.serve_forever()
+
+def run(host, port, on_connect, on_frame, on_disconnect, backlog=100, reuse_port=False, on_start=None,
+        io_threads=IO_THREADS):
+    """Run the asyncio server until interrupted"""
+    asyncio.run(serve(host, port, on_connect, on_frame, on_disconnect, backlog, reuse_port, on_start, io_threads))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+ClassChat Broker
+Lightweight TCP message broker for a ClassChat cluster (see cluster.py).
+
+Every node connects and sends its name as the first frame. After that
+each frame is an envelope, the target node's name, a newline and a JSON
+message:
+
+    node -> broker    b"node2\\n{...}"     to node2
+                      b"\\n{...}"          to every other node
+    broker -> node    b"node1\\n{...}"     from node1
+                      b"\\n{...}"          from the broker:
+                                          {"op": "node_joined" | "node_left", "node": name}
+
+The broker never parses the messages: it reads the name in front and
+copies the frame to the target's queue with the sender's name in front
+instead. Each node has a writer thread, so a slow node only delays its
+own traffic. Messages for a node that is not connected are dropped
+(the nodes only send to nodes they have heard from).
+
+Usage:
+    python3 src/broker.py [--host 127.0.0.1] [--port 12500]
+    python3 src/server_bonus3.py --port 12345 --cluster tcp://127.0.0.1:12500 --node a
+    python3 src/server_bonus3.py --port 12346 --cluster tcp://127.0.0.1:12500 --node b
+"""
+
+import argparse
+import json
+import socket
+import sys
+import threading
+from collections import deque
+
+from framing import FrameDecoder, encode_frame, RECV_BUFFER_SIZE
+
+# Broker address (the nodes' --cluster tcp://HOST:PORT)
+HOST = '127.0.0.1'
+PORT = 12500
+
+SEPARATOR = b"\n"
+
+# Connected nodes: {name: Node}
+nodes = {}
+nodes_lock = threading.Lock()
+
+class Node:
+    """One connected node: its socket and a queue drained by a writer thread"""
+    
+    def __init__(self, name, sock):
+        self.name = name
+        self.sock = sock
+        self.queue = deque()  # Frames to send
+        self.ready = threading.Condition()
+        self.closed = False
+        self.forwarded = 0  # Frames sent to this node
+        threading.Thread(target=self.write_loop, daemon=True).start()
+    
+    def send(self, frame):
+        with self.ready:
+            self.queue.append(frame)
+            self.ready.notify()
+    
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+    
+    def write_loop(self):
+        while True:
+            with self.ready:
+                while not self.queue and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    break
+                frames = list(self.queue)
+                self.queue.clear()
+            try:
+                self.sock.sendall(b"".join(frames))
+                self.forwarded += len(frames)
+            except OSError:
+                break
+        self.sock.close()
+
+def notice(op, name):
+    """Broker frame telling a node that name joined or left"""
+    return encode_frame(SEPARATOR + json.dumps({"op": op, "node": name}).encode('utf-8'))
+
+def route(sender, payload):
+    """Forward one envelope from sender to its target (or to everyone else)"""
+    target, _, body = payload.partition(SEPARATOR)
+    frame = encode_frame(sender.name.encode('utf-8') + SEPARATOR + body)
+    
+    if target:
+        node = nodes.get(target.decode('utf-8'))
+        if node:
+            node.send(frame)
+        return
+    
+    for node in list(nodes.values()):
+        if node is not sender:
+            node.send(frame)
+
+def handle_node(sock, address):
+    """Register a node from its first frame, then route its frames until it leaves"""
+    decoder = FrameDecoder()
+    node = None
+    try:
+        while True:
+            data = sock.recv(RECV_BUFFER_SIZE)
+            if not data:
+                break
+            
+            for payload in decoder.feed(data):
+                if node:
+                    route(node, payload)
+                    continue
+                
+                name = payload.decode('utf-8')
+                with nodes_lock:
+                    if name in nodes:
+                        # An old connection of a restarted node: the others forget it first
+                        nodes.pop(name).close()
+                        for other in nodes.values():
+                            other.send(notice("node_left", name))
+                    node = Node(name, sock)
+                    # Introduce the newcomer and everyone else to each other
+                    for other in nodes.values():
+                        other.send(notice("node_joined", name))
+                        node.send(notice("node_joined", other.name))
+                    nodes[name] = node
+                print(f"[BROKER] Node {name} joined from {address} ({len(nodes)} node(s))")
+    except OSError as e:
+        print(f"[BROKER] Node {node.name if node else address}: {e}")
+    finally:
+        if node:
+            with nodes_lock:
+                if nodes.get(node.name) is node:
+                    del nodes[node.name]
+                    for other in nodes.values():
+                        other.send(notice("node_left", node.name))
+            node.close()
+            print(f"[BROKER] Node {node.name} left after {node.forwarded} frame(s) ({len(nodes)} node(s))")
+        else:
+            sock.close()
+
+def start_broker(host=HOST, port=PORT):
+    """Accept nodes until interrupted"""
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind((host, port))
+    server_socket.listen()
+    print(f"[BROKER] ClassChat broker listening on {host}:{port}")
+    
+    try:
+        while True:
+            sock, address = server_socket.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=handle_node, args=(sock, address), daemon=True).start()
+    finally:
+        server_socket.close()
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="ClassChat cluster broker")
+    parser.add_argument("--host", default=HOST, help=f"Listen address (default {HOST})")
+    parser.add_argument("--port", type=int, default=PORT, help=f"Listen port (default {PORT})")
+    return parser.parse_args()
+
+def main():
+    """Main entry point"""
+    args = parse_args()
+    try:
+        start_broker(args.host, args.port)
+    except KeyboardInterrupt:
+        print("\n[BROKER] Shutting down...")
+        sys.exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -14,18 +14,21 @@ import sys
 import threading
 import json
 
+from framing import send_frame, send_json, iter_frames
+
 # Server configuration
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 12345
 
-def receive_messages(client_socket, username):
+def receive_messages(frames, username):
     """
     Receive messages from server in a dedicated thread.
+    Reads complete frames from the iter_frames() generator shared with registration.
     Handles direct messages, group messages, and system notifications.
     """
     while True:
         try:
-            data = client_socket.recv(4096)
+            data = next(frames, None)
             
             if not data:
                 print("\n[CLIENT] Server closed connection")
@@ -131,7 +134,8 @@ def start_client():
         print(f"[CLIENT] Connected to server\n")
         
         # Registration: Receive username prompt and respond
-        prompt = client_socket.recv(1024).decode('utf-8')
+        frames = iter_frames(client_socket)
+        prompt = next(frames).decode('utf-8')
         print(prompt, end="", flush=True)
         
         username = input().strip()
@@ -141,12 +145,12 @@ def start_client():
             return
         
         # Send username to server
-        client_socket.send(username.encode('utf-8'))
+        send_frame(client_socket, username.encode('utf-8'))
         
         # Start receiver thread
         receiver_thread = threading.Thread(
             target=receive_messages,
-            args=(client_socket, username),
+            args=(frames, username),
             daemon=True
         )
         receiver_thread.start()
@@ -197,7 +201,7 @@ def start_client():
                         "receiver": receiver,
                         "text": ""
                     }
-                    client_socket.send(json.dumps(message_data).encode('utf-8'))
+                    send_json(client_socket, message_data)
                     continue
                 
                 # Get message text
@@ -215,7 +219,7 @@ def start_client():
                 }
                 
                 # Send to server
-                client_socket.send(json.dumps(message_data).encode('utf-8'))
+                send_json(client_socket, message_data)
                 
             except KeyboardInterrupt:
                 print("\n[CLIENT] Interrupted by user")
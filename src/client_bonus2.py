@@ -18,10 +18,30 @@ import base64
 import hashlib
 import os
 
+from framing import send_frame, send_json, iter_frames
+from file_transfer import is_chunk, FileReceiver, FileSender
+
 # Server configuration
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 12345
 
+# Sends come from the input loop, the receiver thread (file_resume replies)
+# and upload threads
+send_lock = threading.Lock()
+
+def send_to_server(client_socket, message_data):
+    """Send one JSON message without interleaving with the other threads"""
+    with send_lock:
+        send_json(client_socket, message_data)
+
+def send_payload(client_socket, payload):
+    """Send one raw frame payload (file stream) under the send lock"""
+    with send_lock:
+        send_frame(client_socket, payload)
+
+# Files offered to other users, waiting for their file_resume
+outgoing_files = FileSender()
+
 def calculate_checksum(file_path):
     """Calculate SHA256 checksum of a file"""
     sha256 = hashlib.sha256()
@@ -37,19 +57,28 @@ def calculate_checksum(file_path):
         print(f"[ERROR] Could not calculate checksum: {e}")
         return None
 
-def receive_messages(client_socket, username):
+def receive_messages(client_socket, frames, username):
     """
     Receive messages from server in a dedicated thread.
+    Reads complete frames from the iter_frames() generator shared with registration.
+    Streamed files are written to downloads/ chunk by chunk.
     Handles direct messages, group messages, file transfers, and system notifications.
     """
+    files = FileReceiver()
+    
     while True:
         try:
-            data = client_socket.recv(1048576)  # 1MB buffer for files
+            data = next(frames, None)
             
             if not data:
                 print("\n[CLIENT] Server closed connection")
                 break
             
+            if is_chunk(data):
+                # Binary chunk of a streamed file
+                files.chunk(data)
+                continue
+            
             try:
                 # Parse JSON response
                 response = json.loads(data.decode('utf-8'))
@@ -70,6 +99,51 @@ def receive_messages(client_socket, username):
                     print(f"\n[@{group} - {sender}] {text}")
                     print(f"To: ", end="", flush=True)
                 
+                elif status == "file_offer":
+                    # Start of a streamed file; tell the sender where to begin
+                    incoming, reply = files.offer(response)
+                    if reply:
+                        send_to_server(client_socket, reply)
+                    print(f"\n[FILE INCOMING] From {incoming.sender}: {incoming.filename} ({incoming.filesize} bytes)")
+                    if incoming.received:
+                        print(f"[FILE] Resuming at byte {incoming.received} from {incoming.part_path}")
+                    print(f"To: ", end="", flush=True)
+                
+                elif status == "file_resume":
+                    # Receiver is ready: upload from the offset it asked for
+                    outgoing, offset = outgoing_files.resume(response)
+                    if outgoing:
+                        threading.Thread(
+                            target=upload_file,
+                            args=(client_socket, outgoing, offset),
+                            daemon=True
+                        ).start()
+                
+                elif status == "file_interrupted":
+                    # Receiver disconnected mid-transfer
+                    print(f"\n[FILE] {response.get('message', '')}")
+                    print(f"To: ", end="", flush=True)
+                
+                elif status == "file_end":
+                    # Streamed file complete: verify checksum
+                    incoming, verified = files.finish(response)
+                    if incoming:
+                        print(f"\n[FILE RECEIVED] From {incoming.sender}: {incoming.filename} ({incoming.received} bytes)")
+                        if verified:
+                            print(f"[FILE SAVED] {incoming.path}")
+                            print(f"[VERIFIED] Checksum OK")
+                        else:
+                            print(f"[WARNING] Checksum mismatch! File discarded - ask for it again.")
+                        print(f"To: ", end="", flush=True)
+                
+                elif status == "file_aborted":
+                    # Sender disconnected mid-transfer
+                    incoming = files.abort(response)
+                    if incoming:
+                        print(f"\n[FILE] Transfer of {incoming.filename} from {incoming.sender} was interrupted")
+                        print(f"[FILE] Partial file kept as {incoming.part_path} - it resumes if sent again")
+                        print(f"To: ", end="", flush=True)
+                
                 elif status == "file_transfer":
                     # Received file from another client
                     sender = response.get("sender", "Unknown")
@@ -197,42 +271,30 @@ def send_file(client_socket, username, receiver, file_path):
         filename = os.path.basename(file_path)
         filesize = os.path.getsize(file_path)
         
-        # Check file size (limit to 10MB for safety)
-        if filesize > 10 * 1024 * 1024:
-            print(f"[ERROR] File too large. Maximum size is 10MB.")
-            return
-        
-        print(f"[FILE] Sending {filename} ({filesize} bytes) to {receiver}...")
+        print(f"[FILE] Preparing {filename} ({filesize} bytes) for {receiver}...")
         
-        # Read file data
-        with open(file_path, 'rb') as f:
-            file_data = f.read()
-        
-        # Calculate checksum
-        checksum = hashlib.sha256(file_data).hexdigest()
-        
-        # Encode to base64 for JSON transport
-        data_b64 = base64.b64encode(file_data).decode('utf-8')
+        # Hash once (checksum + chunk manifest), then offer; the upload
+        # starts when the receiver answers with the offset to resume from
+        outgoing = outgoing_files.offer(username, receiver, file_path)
+        send_payload(client_socket, outgoing.offer())
+        print(f"[FILE] Offered {filename} to {receiver}. Waiting for the receiver...")
+    
+    except Exception as e:
+        print(f"[ERROR] Failed to send file: {e}")
+
+def upload_file(client_socket, outgoing, offset):
+    """Stream a file's chunks from offset, then its end frame (upload thread)"""
+    try:
+        if offset:
+            print(f"\n[FILE] Resuming {outgoing.filename} at byte {offset} of {outgoing.filesize}")
         
-        # Create file transfer message
-        message_data = {
-            "type": "file",
-            "sender": username,
-            "receiver": receiver,
-            "file_data": {
-                "filename": filename,
-                "filesize": filesize,
-                "checksum": checksum,
-                "data": data_b64
-            }
-        }
+        for payload in outgoing.iter_frames(offset):
+            send_payload(client_socket, payload)
         
-        # Send to server
-        client_socket.send(json.dumps(message_data).encode('utf-8'))
-        print(f"[FILE] Upload complete. Waiting for confirmation...")
+        print(f"\n[FILE] Upload of {outgoing.filename} complete. Waiting for confirmation...")
     
     except Exception as e:
-        print(f"[ERROR] Failed to send file: {e}")
+        print(f"\n[ERROR] Failed to send file: {e}")
 
 def start_client():
     """Start the ClassChat client with file transfer support"""
@@ -249,7 +311,8 @@ def start_client():
         print(f"[CLIENT] Connected to server\n")
         
         # Registration: Receive username prompt and respond
-        prompt = client_socket.recv(1024).decode('utf-8')
+        frames = iter_frames(client_socket)
+        prompt = next(frames).decode('utf-8')
         print(prompt, end="", flush=True)
         
         username = input().strip()
@@ -259,12 +322,12 @@ def start_client():
             return
         
         # Send username to server
-        client_socket.send(username.encode('utf-8'))
+        send_frame(client_socket, username.encode('utf-8'))
         
         # Start receiver thread
         receiver_thread = threading.Thread(
             target=receive_messages,
-            args=(client_socket, username),
+            args=(client_socket, frames, username),
             daemon=True
         )
         receiver_thread.start()
@@ -336,7 +399,7 @@ def start_client():
                         "receiver": receiver,
                         "text": ""
                     }
-                    client_socket.send(json.dumps(message_data).encode('utf-8'))
+                    send_to_server(client_socket, message_data)
                     continue
                 
                 # Get message text
@@ -355,8 +418,8 @@ def start_client():
                 }
                 
                 # Send to server
-                client_socket.send(json.dumps(message_data).encode('utf-8'))
-                
+                send_to_server(client_socket, message_data)
+            
             except KeyboardInterrupt:
                 print("\n[CLIENT] Interrupted by user")
                 break
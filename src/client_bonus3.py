@@ -6,57 +6,141 @@ Supports direct messaging, group chatting, file transfer, and offline message de
 Features:
 - Direct messages: Send to specific users (even if offline)
 - Group messages: Send to @groupname
-- File transfer: Send files to specific users
+- File transfer: Send files to specific users or a whole @group
 - Offline messages: Receive queued messages on connect
-- Group commands: /create, /join, /leave, /groups
+- Group commands: /create, /join, /leave, /groups (only changes are resent)
+- Online users: /users (kept current with presence deltas)
+- Server statistics: /stats (latency percentiles, lock waits, queue depths)
+- Compact binary messages when the server supports them (JSON otherwise)
+- Compressed large messages when the server supports it
 """
 
 import socket
 import sys
 import threading
-import json
 import base64
 import hashlib
 import os
 
+from framing import send_frame, iter_frames
+from codec import decode_message, encode_payload, login_message, transcode, CodecError, JSON
+from compression import Deflater, Inflater, COMPRESSIONS
+from file_transfer import is_chunk, chunk_prefix, hash_file, FileReceiver, FileSender
+from presence import PresenceTracker, SNAPSHOT_COMMAND, describe_changes
+from group_directory import GroupListTracker
+from metrics import format_stats
+
 # Server configuration
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 12345
 
+# Sends come from the input loop, the receiver thread (snapshot requests,
+# file_resume replies) and upload threads
+send_lock = threading.Lock()
+
+# Encoding of our messages, as agreed in the server's welcome (JSON until then)
+encoding = JSON
+
+# Compression of our large messages (once the welcome accepts it) and of the server's
+deflater = None
+inflater = Inflater()
+
+def send_to_server(client_socket, message_data):
+    """Send one message without interleaving with the other threads"""
+    send_payload(client_socket, encode_payload(message_data, encoding))
+
+def send_payload(client_socket, payload):
+    """Send one raw frame payload (file stream) under the send lock"""
+    with send_lock:
+        payload = transcode(payload, encoding)
+        # Compressed in sending order, so under the lock
+        if deflater:
+            payload = deflater.payload(payload)
+        send_frame(client_socket, payload)
+
+# Files offered to other users, waiting for their file_resume
+outgoing_files = FileSender()
+
+# Offline messages are read a page at a time; /more asks for the next one
+OFFLINE_PAGE_SIZE = 20
+backlog_cursor = None  # Where the next page starts (None = nothing left)
+
+# Last group listing; commands carry its version so the server sends only changes
+group_list = GroupListTracker()
+
+def fetch_offline_page(client_socket, cursor):
+    """Ask for the next page of stored messages (oldest first)"""
+    send_to_server(client_socket, {
+        "type": "offline_fetch",
+        "cursor": cursor,
+        "direction": "newer",
+        "limit": OFFLINE_PAGE_SIZE
+    })
+
 def calculate_checksum(file_path):
-    """Calculate SHA256 checksum of a file"""
-    sha256 = hashlib.sha256()
+    """Calculate SHA256 checksum of a file (memory-mapped, see file_transfer.hash_file)"""
     try:
-        with open(file_path, 'rb') as f:
-            while True:
-                data = f.read(65536)  # Read in 64KB chunks
-                if not data:
-                    break
-                sha256.update(data)
-        return sha256.hexdigest()
+        return hash_file(file_path)[0]
     except Exception as e:
         print(f"[ERROR] Could not calculate checksum: {e}")
         return None
 
-def receive_messages(client_socket, username):
+def receive_messages(client_socket, frames, username):
     """
     Receive messages from server in a dedicated thread.
+    Reads complete frames from the iter_frames() generator shared with registration.
+    Keeps the online user set current from presence deltas.
+    Streamed files are written to downloads/ chunk by chunk.
     Handles direct messages, group messages, file transfers, offline messages, and system notifications.
     """
+    global backlog_cursor, encoding, deflater
+    files = FileReceiver()
+    presence = PresenceTracker()
+    backlog = []  # Stored messages unpacked from an offline_page frame
+    
     while True:
         try:
-            data = client_socket.recv(1048576)  # 1MB buffer for files
-            
-            if not data:
-                print("\n[CLIENT] Server closed connection")
-                break
+            if backlog:
+                # Next stored message (already parsed)
+                data = None
+            else:
+                data = next(frames, None)
+                
+                if not data:
+                    print("\n[CLIENT] Server closed connection")
+                    break
+                
+                data = inflater.payload(data)
+                
+                if is_chunk(data):
+                    # Binary chunk of a streamed file
+                    files.chunk(data)
+                    continue
             
             try:
-                # Parse JSON response
-                response = json.loads(data.decode('utf-8'))
+                # Parse the response (JSON or binary)
+                response = backlog.pop(0) if data is None else decode_message(data)
                 status = response.get("status", "")
                 
-                if status == "message":
+                if status == "offline_page":
+                    # A page of stored messages: confirm receipt, then show each
+                    send_to_server(client_socket, {
+                        "type": "offline_ack",
+                        "batch": response.get("batch")
+                    })
+                    backlog.extend(response.get("messages", []))
+                    
+                    remaining = response.get("remaining", 0)
+                    if remaining:
+                        backlog_cursor = response.get("cursor")
+                        backlog.append({
+                            "status": "system",
+                            "message": f"{remaining} more offline message(s) - type /more to read them"
+                        })
+                    else:
+                        backlog_cursor = None
+                
+                elif status == "message":
                     # Received direct message from another client
                     sender = response.get("sender", "Unknown")
                     text = response.get("text", "")
@@ -76,6 +160,61 @@ def receive_messages(client_socket, username):
                     print(f"\n[@{group} - {sender}] {text}")
                     print(f"To: ", end="", flush=True)
                 
+                elif status == "file_offer":
+                    # Start of a streamed file; tell the sender where to begin
+                    incoming, reply = files.offer(response)
+                    if reply:
+                        send_to_server(client_socket, reply)
+                    print(f"\n[FILE INCOMING] From {incoming.sender}: {incoming.filename} ({incoming.filesize} bytes)")
+                    if incoming.received:
+                        print(f"[FILE] Resuming at byte {incoming.received} from {incoming.part_path}")
+                    print(f"To: ", end="", flush=True)
+                
+                elif status == "file_resume":
+                    # Receiver is ready: upload from the offset it asked for
+                    outgoing, offset = outgoing_files.resume(response)
+                    if outgoing:
+                        threading.Thread(
+                            target=upload_file,
+                            args=(client_socket, outgoing, offset),
+                            daemon=True
+                        ).start()
+                
+                elif status == "file_available":
+                    # Group file stored on the server: fetch it by checksum
+                    print(f"\n[FILE] {response.get('sender', 'Unknown')} shared {response.get('filename')} "
+                          f"({response.get('filesize', 0)} bytes) with @{response.get('group')} - downloading")
+                    send_to_server(client_socket, {
+                        "type": "file_fetch",
+                        "checksum": response.get("checksum")
+                    })
+                    print(f"To: ", end="", flush=True)
+                
+                elif status == "file_interrupted":
+                    # Receiver disconnected mid-transfer
+                    print(f"\n[FILE] {response.get('message', '')}")
+                    print(f"To: ", end="", flush=True)
+                
+                elif status == "file_end":
+                    # Streamed file complete: verify checksum
+                    incoming, verified = files.finish(response)
+                    if incoming:
+                        print(f"\n[FILE RECEIVED] From {incoming.sender}: {incoming.filename} ({incoming.received} bytes)")
+                        if verified:
+                            print(f"[FILE SAVED] {incoming.path}")
+                            print(f"[VERIFIED] Checksum OK")
+                        else:
+                            print(f"[WARNING] Checksum mismatch! File discarded - ask for it again.")
+                        print(f"To: ", end="", flush=True)
+                
+                elif status == "file_aborted":
+                    # Sender disconnected mid-transfer
+                    incoming = files.abort(response)
+                    if incoming:
+                        print(f"\n[FILE] Transfer of {incoming.filename} from {incoming.sender} was interrupted")
+                        print(f"[FILE] Partial file kept as {incoming.part_path} - it resumes if sent again")
+                        print(f"To: ", end="", flush=True)
+                
                 elif status == "file_transfer":
                     # Received file from another client
                     sender = response.get("sender", "Unknown")
@@ -138,6 +277,9 @@ def receive_messages(client_socket, username):
                     print(f"📬 {message}")
                     print(f"{'='*60}")
                     print(f"To: ", end="", flush=True)
+                    
+                    # First page, oldest messages first
+                    fetch_offline_page(client_socket, 0)
                 
                 elif status == "system":
                     # System notification
@@ -161,22 +303,43 @@ def receive_messages(client_socket, username):
                     print(f"To: ", end="", flush=True)
                 
                 elif status == "success":
-                    # Command success message
+                    # Command success message (the welcome names the encoding and compression to use)
+                    encoding = response.get("encoding", encoding)
+                    if response.get("compression") and not deflater:
+                        deflater = Deflater()
                     message = response.get("message", "")
                     print(f"\n[SUCCESS] {message}")
                     print(f"To: ", end="", flush=True)
                 
                 elif status == "user_list":
-                    # Updated user list
-                    users = response.get("users", [])
-                    other_users = [u for u in users if u != username]
+                    # Full snapshot of online users
+                    presence.apply(response)
+                    other_users = sorted(u for u in presence.users if u != username)
                     if other_users:
                         print(f"\n[ONLINE USERS] {', '.join(other_users)}")
                         print(f"To: ", end="", flush=True)
                 
-                elif status == "group_list":
-                    # List of groups
-                    groups = response.get("groups", {})
+                elif status in ("user_joined", "user_left", "presence_update"):
+                    # Presence delta: users came online or went offline
+                    joined, left, needs_snapshot = presence.apply(response)
+                    for line in describe_changes(joined - {username}, left):
+                        print(f"\n[SYSTEM] {line}")
+                    if joined or left:
+                        print(f"To: ", end="", flush=True)
+                    
+                    if needs_snapshot:
+                        # Missed an update - ask for a fresh list
+                        send_to_server(client_socket, {
+                            "type": "message",
+                            "sender": username,
+                            "receiver": SNAPSHOT_COMMAND,
+                            "text": ""
+                        })
+                
+                elif status in ("group_list", "group_delta", "group_list_unchanged"):
+                    # List of groups (full, changes since our version, or unchanged)
+                    group_list.apply(response)
+                    groups = group_list.groups
                     if groups:
                         print(f"\n[GROUPS]")
                         for group_name, members in groups.items():
@@ -185,6 +348,13 @@ def receive_messages(client_socket, username):
                         print(f"\n[GROUPS] No groups created yet")
                     print(f"To: ", end="", flush=True)
                 
+                elif status == "stats":
+                    # Server latency histograms, lock waits and queue depths
+                    print(f"\n[STATS]")
+                    for line in format_stats(response.get("stats", {})):
+                        print(line)
+                    print(f"To: ", end="", flush=True)
+                
                 elif status == "help":
                     # Help/commands message
                     commands = response.get("commands", {})
@@ -198,8 +368,8 @@ def receive_messages(client_socket, username):
                     print(f"\n[SERVER] {response.get('message', str(response))}")
                     print(f"To: ", end="", flush=True)
             
-            except json.JSONDecodeError:
-                # Not JSON, display as plain text
+            except CodecError:
+                # Not a message, display as plain text
                 message = data.decode('utf-8')
                 print(f"\n{message}", end="", flush=True)
         
@@ -208,7 +378,7 @@ def receive_messages(client_socket, username):
             break
 
 def send_file(client_socket, username, receiver, file_path):
-    """Send a file to another user (works even if offline)"""
+    """Send a file to another user or @group (works even if offline)"""
     try:
         if not os.path.exists(file_path):
             print(f"[ERROR] File not found: {file_path}")
@@ -222,45 +392,42 @@ def send_file(client_socket, username, receiver, file_path):
         filename = os.path.basename(file_path)
         filesize = os.path.getsize(file_path)
         
-        # Check file size (limit to 10MB for safety)
-        if filesize > 10 * 1024 * 1024:
-            print(f"[ERROR] File too large. Maximum size is 10MB.")
-            return
-        
-        print(f"[FILE] Sending {filename} ({filesize} bytes) to {receiver}...")
-        
-        # Read file data
-        with open(file_path, 'rb') as f:
-            file_data = f.read()
+        print(f"[FILE] Preparing {filename} ({filesize} bytes) for {receiver}...")
         
-        # Calculate checksum
-        checksum = hashlib.sha256(file_data).hexdigest()
-        
-        # Encode to base64 for JSON transport
-        data_b64 = base64.b64encode(file_data).decode('utf-8')
+        # Hash once (checksum + chunk manifest), then offer; the upload
+        # starts when the receiver answers with the offset to resume from
+        outgoing = outgoing_files.offer(username, receiver, file_path)
+        send_payload(client_socket, outgoing.offer())
+        print(f"[FILE] Offered {filename} to {receiver}. Waiting for the receiver...")
+    
+    except Exception as e:
+        print(f"[ERROR] Failed to send file: {e}")
+
+def upload_file(client_socket, outgoing, offset):
+    """Stream a file's chunks from offset with sendfile(), then its end frame (upload thread)"""
+    try:
+        if 0 < offset < outgoing.filesize:
+            print(f"\n[FILE] Resuming {outgoing.filename} at byte {offset} of {outgoing.filesize}")
         
-        # Create file transfer message
-        message_data = {
-            "type": "file",
-            "sender": username,
-            "receiver": receiver,
-            "file_data": {
-                "filename": filename,
-                "filesize": filesize,
-                "checksum": checksum,
-                "data": data_b64
-            }
-        }
+        # Each chunk: its headers, then the file range straight from the page cache
+        with open(outgoing.path, 'rb') as f:
+            for start, size in outgoing.chunk_ranges(offset):
+                with send_lock:
+                    client_socket.sendall(chunk_prefix(outgoing.transfer_id, size))
+                    client_socket.sendfile(f, start, size)
+        send_payload(client_socket, outgoing.end())
         
-        # Send to server
-        client_socket.send(json.dumps(message_data).encode('utf-8'))
-        print(f"[FILE] Upload complete. Waiting for confirmation...")
+        if offset and offset == outgoing.filesize:
+            print(f"\n[FILE] Server already has {outgoing.filename} - nothing to upload")
+        else:
+            print(f"\n[FILE] Upload of {outgoing.filename} complete. Waiting for confirmation...")
     
     except Exception as e:
-        print(f"[ERROR] Failed to send file: {e}")
+        print(f"\n[ERROR] Failed to send file: {e}")
 
 def start_client():
     """Start the ClassChat client with offline message support"""
+    global backlog_cursor
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     
     try:
@@ -274,7 +441,8 @@ def start_client():
         print(f"[CLIENT] Connected to server\n")
         
         # Registration: Receive username prompt and respond
-        prompt = client_socket.recv(1024).decode('utf-8')
+        frames = iter_frames(client_socket)
+        prompt = next(frames).decode('utf-8')
         print(prompt, end="", flush=True)
         
         username = input().strip()
@@ -283,13 +451,13 @@ def start_client():
             print("[CLIENT] Username cannot be empty")
             return
         
-        # Send username to server
-        client_socket.send(username.encode('utf-8'))
+        # Send username to server, offering the binary encoding and compression
+        send_frame(client_socket, login_message(username, compression=COMPRESSIONS))
         
         # Start receiver thread
         receiver_thread = threading.Thread(
             target=receive_messages,
-            args=(client_socket, username),
+            args=(client_socket, frames, username),
             daemon=True
         )
         receiver_thread.start()
@@ -312,7 +480,7 @@ def start_client():
         print("")
         print("Send File (works for offline users too!):")
         print("  1. Enter /sendfile as receiver")
-        print("  2. Enter username of recipient")
+        print("  2. Enter username of recipient (or @groupname)")
         print("  3. Enter full path to file")
         print("")
         print("Group Commands:")
@@ -320,6 +488,9 @@ def start_client():
         print("  /join groupname    - Join an existing group")
         print("  /leave groupname   - Leave a group")
         print("  /groups            - List all groups")
+        print("  /more              - Read more offline messages")
+        print("  /users             - List online users")
+        print("  /stats             - Server latency and queue statistics")
         print("")
         print("💡 Offline Messages: Messages sent to offline users")
         print("   will be queued and delivered when they reconnect!")
@@ -342,7 +513,7 @@ def start_client():
                 
                 # Handle file transfer command
                 if receiver == "/sendfile":
-                    file_receiver = input("Recipient username: ").strip()
+                    file_receiver = input("Recipient username or @group: ").strip()
                     if not file_receiver:
                         print("[ERROR] Recipient username cannot be empty")
                         continue
@@ -355,6 +526,16 @@ def start_client():
                     send_file(client_socket, username, file_receiver, file_path)
                     continue
                 
+                # Next page of offline messages
+                if receiver == "/more":
+                    if backlog_cursor is None:
+                        print("[OFFLINE] No more offline messages")
+                    else:
+                        # Cleared until the page arrives, so /more twice asks once
+                        cursor, backlog_cursor = backlog_cursor, None
+                        fetch_offline_page(client_socket, cursor)
+                    continue
+                
                 # Handle group commands
                 if receiver.startswith("/"):
                     # Send command as a message with receiver as command
@@ -362,9 +543,10 @@ def start_client():
                         "type": "message",
                         "sender": username,
                         "receiver": receiver,
-                        "text": ""
+                        "text": "",
+                        "version": group_list.version
                     }
-                    client_socket.send(json.dumps(message_data).encode('utf-8'))
+                    send_to_server(client_socket, message_data)
                     continue
                 
                 # Get message text
@@ -383,8 +565,8 @@ def start_client():
                 }
                 
                 # Send to server
-                client_socket.send(json.dumps(message_data).encode('utf-8'))
-                
+                send_to_server(client_socket, message_data)
+            
             except KeyboardInterrupt:
                 print("\n[CLIENT] Interrupted by user")
                 break
@@ -5,7 +5,7 @@ ClassChat GUI Client
 A graphical user interface for ClassChat supporting all features:
 - Direct messaging
 - Group chatting
-- File transfer
+- File transfer (to users or whole groups)
 - Offline message delivery
 - Real-time user list
 
@@ -24,6 +24,11 @@ import base64
 import hashlib
 from datetime import datetime
 
+from framing import send_frame, send_json, iter_frames
+from presence import PresenceTracker, SNAPSHOT_COMMAND, describe_changes
+from group_directory import GroupListTracker
+from file_transfer import is_chunk, chunk_prefix, FileReceiver, FileSender
+
 # Server configuration
 HOST = '127.0.0.1'
 PORT = 12345
@@ -37,10 +42,21 @@ class ClassChatGUI:
         
         # Client state
         self.client_socket = None
+        self.frames = None
         self.username = None
         self.connected = False
         self.online_users = set()
+        self.presence = PresenceTracker()
+        self.group_list = GroupListTracker()
         self.groups = set()
+        self.files = FileReceiver()
+        self.outgoing_files = FileSender()
+        self.send_lock = threading.Lock()  # File uploads send from a worker thread
+        
+        # Offline messages are loaded a page at a time while scrolling up
+        self.backlog_cursor = None
+        self.backlog_remaining = 0
+        self.backlog_loading = False
         
         # Setup UI
         self.setup_login_screen()
@@ -104,11 +120,15 @@ class ClassChatGUI:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((HOST, PORT))
             
+            # Server sends a username prompt first (one frame)
+            self.frames = iter_frames(self.client_socket)
+            next(self.frames)
+            
             # Send username
-            self.client_socket.send(username.encode('utf-8'))
+            send_frame(self.client_socket, username.encode('utf-8'))
             
             # Wait for acknowledgment (server sends JSON)
-            ack_data = self.client_socket.recv(1024).decode('utf-8')
+            ack_data = next(self.frames).decode('utf-8')
             
             # Try to parse as JSON (for bonus3 server)
             try:
@@ -230,6 +250,7 @@ class ClassChatGUI:
             height=20
         )
         self.chat_display.pack(fill=tk.BOTH, expand=True)
+        self.chat_display.config(yscrollcommand=self.on_chat_scroll)
         
         # Configure text tags for styling
         self.chat_display.tag_config('system', foreground='blue', font=('Arial', 9, 'italic'))
@@ -290,10 +311,17 @@ class ClassChatGUI:
         """Receive messages from server (runs in separate thread)"""
         while self.connected:
             try:
-                data = self.client_socket.recv(1024 * 1024).decode('utf-8')
+                data = next(self.frames, b'')
                 if not data:
                     break
                 
+                if is_chunk(data):
+                    # Binary chunk of a streamed file
+                    self.files.chunk(data)
+                    continue
+                
+                data = data.decode('utf-8')
+                
                 # Parse JSON message
                 try:
                     message = json.loads(data)
@@ -348,23 +376,99 @@ class ClassChatGUI:
             text = message.get('message', 'Message queued')
             self.root.after(0, lambda: self.display_message("📮 Queued", text, 'system'))
         
+        elif status == 'offline_page':
+            # A page of stored messages (older than everything shown)
+            self.send({
+                "type": "offline_ack",
+                "batch": message.get('batch')
+            })
+            self.root.after(0, lambda: self.show_backlog_page(message))
+        
         elif status == 'offline_messages':
-            # Offline messages notification
+            # Offline messages notification; newest page first, older ones on scroll
             count = message.get('count', 0)
+            cursor = message.get('cursor')
             self.root.after(0, lambda: self.display_message("📬 Offline Messages", f"You have {count} offline message(s)", 'system'))
+            self.root.after(0, lambda: self.start_backlog(cursor, count))
         
-        elif status == 'group_list':
-            # Groups list
-            groups = message.get('groups', [])
-            # Schedule GUI update in main thread
-            self.root.after(0, lambda: self.update_groups_list(groups))
+        elif status in ('group_list', 'group_delta', 'group_list_unchanged'):
+            # Groups list: full, changes since our version, or unchanged
+            if self.group_list.apply(message):
+                groups = list(self.group_list.groups)
+                # Schedule GUI update in main thread
+                self.root.after(0, lambda: self.update_groups_list(groups))
         
         elif status == 'user_list':
-            # Online users list
-            users = message.get('users', [])
+            # Full snapshot of online users
+            self.presence.apply(message)
+            users = set(self.presence.users)
             # Schedule GUI update in main thread
             self.root.after(0, lambda: self.update_users_list(users))
         
+        elif status in ('user_joined', 'user_left', 'presence_update'):
+            # Presence delta: patch the list instead of rebuilding it
+            joined, left, needs_snapshot = self.presence.apply(message)
+            self.root.after(0, lambda: self.apply_presence_delta(joined, left))
+            
+            if needs_snapshot:
+                # Missed an update - sends happen on the main thread
+                self.root.after(0, self.request_user_list)
+        
+        elif status == 'file_offer':
+            # Start of a streamed file; tell the sender where to begin
+            incoming, reply = self.files.offer(message)
+            if reply:
+                self.send(reply)
+            text = f"{incoming.filename} ({incoming.filesize} bytes) from {incoming.sender}"
+            if incoming.received:
+                text += f" - resuming at byte {incoming.received}"
+            self.root.after(0, lambda: self.display_message("📁 Receiving File", text, 'file'))
+        
+        elif status == 'file_resume':
+            # Receiver is ready: upload from the offset it asked for
+            outgoing, offset = self.outgoing_files.resume(message)
+            if outgoing:
+                threading.Thread(
+                    target=self.upload_file,
+                    args=(outgoing, offset),
+                    daemon=True
+                ).start()
+        
+        elif status == 'file_available':
+            # Group file stored on the server: fetch it by checksum
+            text = (f"{message.get('sender', 'Unknown')} shared {message.get('filename')} "
+                    f"({message.get('filesize', 0)} bytes) with @{message.get('group')} - downloading")
+            self.root.after(0, lambda: self.display_message("📁 Group File", text, 'file'))
+            self.send({
+                "type": "file_fetch",
+                "checksum": message.get('checksum')
+            })
+        
+        elif status == 'file_interrupted':
+            # Receiver disconnected mid-transfer
+            text = message.get('message', 'File transfer interrupted')
+            self.root.after(0, lambda: self.display_message("✗ File Error", text, 'error'))
+        
+        elif status == 'file_end':
+            # Streamed file complete
+            incoming, verified = self.files.finish(message)
+            if incoming:
+                if verified:
+                    text = (f"From {incoming.sender}: {incoming.filename} ({incoming.received} bytes)\n"
+                            f"Saved to: {incoming.path}\n✓ Checksum verified")
+                    self.root.after(0, lambda: self.display_message("📁 File Received", text, 'file'))
+                else:
+                    text = f"Checksum mismatch for {incoming.filename} - file discarded"
+                    self.root.after(0, lambda: self.display_message("✗ File Error", text, 'error'))
+        
+        elif status == 'file_aborted':
+            # Sender disconnected mid-transfer
+            incoming = self.files.abort(message)
+            if incoming:
+                text = (f"Transfer of {incoming.filename} from {incoming.sender} was interrupted\n"
+                        f"Partial file kept as {incoming.part_path} - it resumes if sent again")
+                self.root.after(0, lambda: self.display_message("✗ File Error", text, 'error'))
+        
         elif status == 'file_transfer':
             # File received
             sender = message.get('sender', 'Unknown')
@@ -380,6 +484,11 @@ class ClassChatGUI:
             # Unknown message type - display as is
             self.display_message("Server", str(message), 'system')
     
+    def send(self, message):
+        """Send one JSON message (never in the middle of a file upload frame)"""
+        with self.send_lock:
+            send_json(self.client_socket, message)
+    
     def display_message(self, sender, text, tag='incoming'):
         """Display a message in the chat area"""
         self.chat_display.config(state=tk.NORMAL)
@@ -398,6 +507,64 @@ class ClassChatGUI:
         self.chat_display.config(state=tk.DISABLED)
         self.chat_display.see(tk.END)
     
+    def start_backlog(self, cursor, count):
+        """Remember where stored messages start and load the newest page"""
+        self.backlog_cursor = cursor
+        self.backlog_remaining = count
+        self.load_older_messages()
+    
+    def load_older_messages(self):
+        """Request the next page of older stored messages (one at a time)"""
+        if self.backlog_loading or not self.backlog_remaining or not self.connected:
+            return
+        
+        self.backlog_loading = True
+        try:
+            self.send({
+                "type": "offline_fetch",
+                "cursor": self.backlog_cursor,
+                "direction": "older"
+            })
+        except Exception as e:
+            self.backlog_loading = False
+            self.display_message("Error", f"Failed to load offline messages: {e}", 'error')
+    
+    def show_backlog_page(self, page):
+        """Insert a page of stored messages above everything shown"""
+        self.backlog_cursor = page.get('cursor')
+        self.backlog_remaining = page.get('remaining', 0)
+        self.backlog_loading = False
+        
+        self.chat_display.config(state=tk.NORMAL)
+        
+        # Newest first at the top, so the page ends up in chronological order
+        for stored in reversed(page.get('messages', [])):
+            sender = stored.get('sender', 'Unknown')
+            if stored.get('status') == 'group_message':
+                sender = f"@{stored.get('group', 'Unknown')} - {sender}"
+                tag = 'group'
+            else:
+                tag = 'incoming'
+            
+            self.chat_display.insert('1.0', f"  {stored.get('text', '')}\n\n")
+            self.chat_display.insert('1.0', f"{sender}:\n", tag)
+            self.chat_display.insert('1.0', f"[{stored.get('timestamp', '')}] ", 'offline')
+        
+        if not self.backlog_remaining:
+            self.chat_display.insert('1.0', "── Start of offline messages ──\n\n", 'offline')
+        
+        self.chat_display.config(state=tk.DISABLED)
+        
+        # Keep loading while the top of the history is in view
+        if self.chat_display.yview()[0] <= 0.0:
+            self.load_older_messages()
+    
+    def on_chat_scroll(self, first, last):
+        """Scrollbar update; reaching the top loads older offline messages"""
+        self.chat_display.vbar.set(first, last)
+        if float(first) <= 0.0 and self.backlog_remaining:
+            self.load_older_messages()
+    
     def send_message(self):
         """Send a message"""
         recipient = self.recipient_var.get().strip()
@@ -434,7 +601,7 @@ class ClassChatGUI:
                 self.display_message(f"You → {recipient}", text, 'outgoing')
             
             # Send to server
-            self.client_socket.send(json.dumps(message).encode('utf-8'))
+            self.send(message)
             
             # Clear input
             self.message_entry.delete(0, tk.END)
@@ -450,53 +617,56 @@ class ClassChatGUI:
             messagebox.showwarning("No Recipient", "Please select or enter a recipient first")
             return
         
-        # Remove @ from group names
-        if recipient.startswith('@'):
-            messagebox.showinfo("File Transfer", "File transfer only works for direct messages, not groups")
-            return
-        
         # Open file dialog
         filepath = filedialog.askopenfilename(title="Select File to Send")
         
         if not filepath:
             return
         
-        # Check file size (10MB limit)
+        # Hash and upload on worker threads so large files do not freeze the window
+        filename = os.path.basename(filepath)
         filesize = os.path.getsize(filepath)
-        if filesize > 10 * 1024 * 1024:
-            messagebox.showerror("File Too Large", "File must be less than 10MB")
-            return
+        self.display_message("📁 Sending File", f"Offering {filename} ({filesize} bytes) to {recipient}...", 'file')
         
+        threading.Thread(
+            target=self.offer_file,
+            args=(filepath, recipient),
+            daemon=True
+        ).start()
+    
+    def offer_file(self, filepath, recipient):
+        """Hash a file (checksum + chunk manifest) and offer it (runs in separate thread)"""
         try:
-            # Read file
-            with open(filepath, 'rb') as f:
-                file_data = f.read()
-            
-            # Calculate checksum
-            checksum = hashlib.sha256(file_data).hexdigest()
-            
-            # Encode to base64
-            encoded_data = base64.b64encode(file_data).decode('utf-8')
-            
-            # Create message
-            filename = os.path.basename(filepath)
-            message = {
-                "status": "file_transfer",
-                "sender": self.username,
-                "receiver": recipient,
-                "filename": filename,
-                "filesize": filesize,
-                "checksum": checksum,
-                "data": encoded_data
-            }
-            
-            # Send
-            self.client_socket.send(json.dumps(message).encode('utf-8'))
-            
-            self.display_message("📁 File Sent", f"Sent {filename} ({filesize} bytes) to {recipient}", 'file')
+            outgoing = self.outgoing_files.offer(self.username, recipient, filepath)
+            with self.send_lock:
+                send_frame(self.client_socket, outgoing.offer())
         
         except Exception as e:
-            messagebox.showerror("File Transfer Error", f"Failed to send file: {e}")
+            error = f"Failed to send file: {e}"
+            self.root.after(0, lambda: messagebox.showerror("File Transfer Error", error))
+    
+    def upload_file(self, outgoing, offset):
+        """Stream a file's chunks from offset with sendfile(), then its end frame (runs in separate thread)"""
+        try:
+            # Each chunk: its headers, then the file range straight from the page cache
+            with open(outgoing.path, 'rb') as f:
+                for start, size in outgoing.chunk_ranges(offset):
+                    with self.send_lock:
+                        self.client_socket.sendall(chunk_prefix(outgoing.transfer_id, size))
+                        self.client_socket.sendfile(f, start, size)
+            with self.send_lock:
+                send_frame(self.client_socket, outgoing.end())
+            
+            text = f"Sent {outgoing.filename} ({outgoing.filesize} bytes) to {outgoing.receiver}"
+            if offset and offset == outgoing.filesize:
+                text += " (already stored on the server)"
+            elif offset:
+                text += f" (resumed at byte {offset})"
+            self.root.after(0, lambda: self.display_message("📁 File Sent", text, 'file'))
+        
+        except Exception as e:
+            error = f"Failed to send file: {e}"
+            self.root.after(0, lambda: messagebox.showerror("File Transfer Error", error))
     
     def receive_file(self, sender, filename, filesize, checksum, file_data, timestamp):
         """Receive and save a file"""
@@ -568,7 +738,7 @@ class ClassChatGUI:
                 "group": group_name,
                 "sender": self.username
             }
-            self.client_socket.send(json.dumps(message).encode('utf-8'))
+            self.send(message)
             
             dialog.destroy()
             self.list_groups()
@@ -608,7 +778,7 @@ class ClassChatGUI:
                 "group": group_name,
                 "sender": self.username
             }
-            self.client_socket.send(json.dumps(message).encode('utf-8'))
+            self.send(message)
             
             dialog.destroy()
             self.list_groups()
@@ -648,7 +818,7 @@ class ClassChatGUI:
                 "group": group_name,
                 "sender": self.username
             }
-            self.client_socket.send(json.dumps(message).encode('utf-8'))
+            self.send(message)
             
             dialog.destroy()
             self.list_groups()
@@ -664,12 +834,15 @@ class ClassChatGUI:
     def list_groups(self):
         """Request groups list from server"""
         try:
+            # Our version lets the server answer "unchanged" or just the changes
             message = {
-                "status": "command",
-                "command": "groups",
-                "sender": self.username
+                "type": "message",
+                "sender": self.username,
+                "receiver": "/groups",
+                "text": "",
+                "version": self.group_list.version
             }
-            self.client_socket.send(json.dumps(message).encode('utf-8'))
+            self.send(message)
         except Exception as e:
             self.display_message("Error", f"Failed to get groups: {e}", 'error')
     
@@ -700,6 +873,44 @@ class ClassChatGUI:
         # Update recipient combobox
         self.update_recipient_combo()
     
+    def apply_presence_delta(self, joined, left):
+        """Insert/remove only the users that changed"""
+        for user in left:
+            self.online_users.discard(user)
+            if user != self.username:
+                items = self.users_listbox.get(0, tk.END)
+                if user in items:
+                    self.users_listbox.delete(items.index(user))
+        
+        for user in joined:
+            self.online_users.add(user)
+            if user != self.username:
+                # Keep the listbox sorted
+                items = self.users_listbox.get(0, tk.END)
+                index = next((i for i, item in enumerate(items) if item > user), tk.END)
+                self.users_listbox.insert(index, user)
+        
+        for line in describe_changes(joined - {self.username}, left):
+            self.display_message("System", line, 'system')
+        
+        if joined or left:
+            user_count = len(self.online_users)
+            self.status_bar.config(text=f"Connected as {self.username} | {user_count} user(s) online")
+            self.update_recipient_combo()
+    
+    def request_user_list(self):
+        """Ask the server for a full online-user snapshot"""
+        try:
+            message = {
+                "type": "message",
+                "sender": self.username,
+                "receiver": SNAPSHOT_COMMAND,
+                "text": ""
+            }
+            self.send(message)
+        except Exception as e:
+            self.display_message("Error", f"Failed to get users: {e}", 'error')
+    
     def update_recipient_combo(self):
         """Update recipient dropdown with users and groups"""
         values = []
@@ -734,7 +945,7 @@ class ClassChatGUI:
     def refresh_all(self):
         """Refresh users and groups"""
         self.list_groups()
-        # Note: User list is updated automatically by server
+        self.request_user_list()
     
     def show_about(self):
         """Show about dialog"""
@@ -752,7 +963,7 @@ Built with Python + Tkinter
 Compatible with all ClassChat servers
 
 GitHub: bereket2sh/ClassChat"""
-        
+
         messagebox.showinfo("About ClassChat", about_text)
     
     def disconnect(self):
@@ -16,18 +16,21 @@ import sys
 import threading
 import json
 
+from framing import send_frame, iter_frames
+
 # Server configuration
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 12345
 
-def receive_messages(client_socket, username):
+def receive_messages(frames, username):
     """
     Receive messages from server in a dedicated thread.
+    Reads complete frames from the iter_frames() generator shared with registration.
     Handles both routed messages and system notifications.
     """
     while True:
         try:
-            data = client_socket.recv(4096)
+            data = next(frames, None)
             
             if not data:
                 print("\n[CLIENT] Server closed connection")
@@ -104,7 +107,8 @@ def start_client():
         print("[CLIENT] Connected to server\n")
         
         # Receive username prompt
-        prompt = client_socket.recv(1024).decode('utf-8')
+        frames = iter_frames(client_socket)
+        prompt = next(frames).decode('utf-8')
         print(prompt, end="", flush=True)
         
         # Get username from user
@@ -115,12 +119,12 @@ def start_client():
             return
         
         # Send username to server
-        client_socket.send(username.encode('utf-8'))
+        send_frame(client_socket, username.encode('utf-8'))
         
         # Start receiver thread
         receiver = threading.Thread(
             target=receive_messages,
-            args=(client_socket, username),
+            args=(frames, username),
             daemon=True
         )
         receiver.start()
@@ -166,7 +170,7 @@ def start_client():
             
             # Send to server
             try:
-                client_socket.send(message.encode('utf-8'))
+                send_frame(client_socket, message.encode('utf-8'))
             except Exception as e:
                 print(f"[ERROR] Failed to send: {e}")
                 break
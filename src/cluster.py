@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+ClassChat Cluster
+Several ClassChat servers (nodes) acting as one campus service over a
+message bus.
+
+Each server used to be an island: its clients, groups and offline
+messages lived in its own globals. With --cluster every node connects to
+a bus and tells the others what they need to route around it:
+
+    presence       a user logged in or out at the sending node
+    membership     a group join or leave (every node keeps all groups)
+    deliver        a direct message for a user connected there
+    group_message  an @group message for the members connected there
+    file_part      a piece of a stored file (base64), followed by
+    file           a stored file for a user connected there
+    group_file     a group file for the members connected there
+    sync           the sender's users and their groups (to a node that joined)
+
+Users belong to the node they are connected to. A message for a user who
+is offline everywhere is queued where it was sent; when the user logs in
+at any node, the others forward what they kept (see forward_offline() in
+server_bonus3.py).
+
+The bus is pluggable. server_bonus3 only uses:
+
+    bus = open_bus(url, node, on_message)
+    bus.start()                     connect and start calling on_message
+    bus.node                        this node's name
+    bus.send(node, message)         to one node
+    bus.send_stream(node, messages) an iterable of messages, read lazily
+    bus.broadcast(message)          to every other node
+    bus.close()
+
+on_message(message, None) runs in the bus's reader thread, with
+message["from"] set to the sending node. The bus itself reports
+{"op": "node_joined"} and {"op": "node_left"} (from the node concerned;
+None when this node lost the bus and should forget everyone).
+
+A bus type registers a URL scheme with register_bus(). The one shipped
+here, tcp://host:port, talks to broker.py, a small TCP broker for running
+a cluster on one machine or a campus LAN.
+"""
+
+import json
+import socket
+import threading
+import time
+from collections import deque
+
+from framing import FrameDecoder, encode_frame, RECV_BUFFER_SIZE
+
+# Seconds between attempts to reach the broker
+RECONNECT_DELAY = 1.0
+
+# Envelope of every bus frame: target (or sender) node, a newline, the JSON message.
+# An empty target means every other node; an empty sender means the broker itself.
+SEPARATOR = b"\n"
+
+# URL scheme -> bus class
+BUS_TYPES = {}
+
+def register_bus(scheme, factory):
+    """Make factory(address, node, on_message) available as scheme://address"""
+    BUS_TYPES[scheme] = factory
+
+def open_bus(url, node, on_message):
+    """Connect this node to the bus at url (e.g. tcp://127.0.0.1:12500)"""
+    scheme, _, address = url.partition("://")
+    if scheme not in BUS_TYPES:
+        raise ValueError(f"Unknown bus type '{scheme}' (known: {', '.join(sorted(BUS_TYPES))})")
+    return BUS_TYPES[scheme](address, node, on_message)
+
+def encode_envelope(node, message):
+    """Bus frame for a message to (or from) node"""
+    return encode_frame((node or "").encode('utf-8') + SEPARATOR + json.dumps(message).encode('utf-8'))
+
+def decode_envelope(payload):
+    """(node, message bytes) of a bus frame"""
+    node, _, body = payload.partition(SEPARATOR)
+    return node.decode('utf-8'), body
+
+class BrokerBus:
+    """Bus through broker.py: one TCP connection, reconnected if it drops"""
+    
+    def __init__(self, address, node, on_message):
+        host, _, port = address.rpartition(":")
+        self.address = (host or "127.0.0.1", int(port))
+        self.node = node
+        self.on_message = on_message
+        self.queue = deque()  # (target node or None, iterable of messages)
+        self.ready = threading.Condition()  # Queue or connection changed
+        self.sock = None  # Current broker connection (None while reconnecting)
+        self.closed = False
+    
+    def start(self):
+        threading.Thread(target=self.read_loop, daemon=True).start()
+        threading.Thread(target=self.write_loop, daemon=True).start()
+    
+    def send(self, node, message):
+        self.send_stream(node, (message,))
+    
+    def send_stream(self, node, messages):
+        """Queue messages for one node; a generator is read as its messages are sent"""
+        with self.ready:
+            self.queue.append((node, messages))
+            self.ready.notify_all()
+    
+    def broadcast(self, message):
+        self.send_stream(None, (message,))
+    
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+        if self.sock:
+            self.sock.close()
+    
+    def connect(self):
+        """Connect and say hello, retrying until the broker answers"""
+        while not self.closed:
+            try:
+                sock = socket.create_connection(self.address)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.sendall(encode_frame(self.node.encode('utf-8')))
+                print(f"[CLUSTER] Node {self.node} connected to the broker at {self.address[0]}:{self.address[1]}")
+                return sock
+            except OSError as e:
+                print(f"[CLUSTER] Broker {self.address[0]}:{self.address[1]} unreachable ({e}); retrying")
+                time.sleep(RECONNECT_DELAY)
+        return None
+    
+    def read_loop(self):
+        """Own the connection: connect, dispatch what arrives, start over when it drops"""
+        while not self.closed:
+            sock = self.connect()
+            if sock is None:
+                return
+            with self.ready:
+                self.sock = sock
+                self.ready.notify_all()
+            
+            decoder = FrameDecoder()
+            while True:
+                try:
+                    data = sock.recv(RECV_BUFFER_SIZE)
+                except OSError:
+                    break
+                if not data:
+                    break
+                
+                for payload in decoder.feed(data):
+                    node, body = decode_envelope(payload)
+                    message = json.loads(body.decode('utf-8'))
+                    if not node:
+                        # From the broker: a node joined or left
+                        node = message.pop("node")
+                    message["from"] = node
+                    self.dispatch(message)
+            
+            with self.ready:
+                self.sock = None
+                self.ready.notify_all()
+            sock.close()
+            if not self.closed:
+                # Everyone is gone as far as this node can tell; they come back as node_joined
+                print("[CLUSTER] Lost the broker; reconnecting")
+                self.dispatch({"op": "node_left", "from": None})
+                time.sleep(RECONNECT_DELAY)
+    
+    def write_loop(self):
+        """Send queued messages over the current connection"""
+        while True:
+            with self.ready:
+                while not self.closed and (not self.queue or self.sock is None):
+                    self.ready.wait()
+                if self.closed:
+                    return
+                sock = self.sock
+                node, messages = self.queue.popleft()
+            
+            try:
+                for message in messages:
+                    sock.sendall(encode_envelope(node, message))
+            except OSError:
+                # The rest of these messages is lost; the reader reconnects
+                sock.close()
+                with self.ready:
+                    while self.sock is sock and not self.closed:
+                        self.ready.wait()
+    
+    def dispatch(self, message):
+        try:
+            self.on_message(message, None)
+        except Exception as e:
+            print(f"[CLUSTER] Error handling {message.get('op')} from {message.get('from')}: {e}")
+
+register_bus("tcp", BrokerBus)
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+ClassChat Compact Encoding
+Binary message encoding negotiated at login, with JSON as the fallback.
+
+Every JSON frame repeats its keys ("status", "sender", "receiver",
+"text", ...), checksums and transfer ids travel as hex text, and the
+legacy file message carries the whole file as base64. In the binary
+encoding a message is
+
+    opcode (1 byte) | field mask (varint) | the present fields, in schema order
+
+The opcode names the message ("type" or "status" and its value) and
+with it a schema: the ordered fields that message usually has. Bit i of
+the mask says field i is present. Each field is written by its kind:
+
+    str    varint length + UTF-8
+    int    zigzag varint
+    hex    varint length + the raw bytes (checksums, transfer ids: half the size)
+    hexes  varint count + raw bytes of each (the chunk manifest)
+    strs   varint count + each as a str (user lists)
+    b64    varint length + the decoded bytes (the legacy file data)
+    file   the legacy file_data dict: its "data" as b64, the rest as json
+    msgs   varint count + each message binary-encoded (an offline page)
+    json   varint length + JSON (dicts, anything else)
+
+Keys outside the schema, or values that do not fit their kind (a
+checksum that is not lowercase hex, say), go in one JSON object after
+the fields, flagged by the bit after the last field. So any message
+survives the trip unchanged, and messages without an opcode are simply
+sent as JSON.
+
+decode_message() reads both: a JSON payload starts with '{', a binary
+one with its opcode (below '{') and a file chunk with 0x00 (see
+file_transfer.py), so one connection can carry any mix of them.
+
+Negotiation: the first frame may be a login message instead of the bare
+username,
+
+    {"type": "login", "username": "alice", "encodings": ["binary", "json"]}
+
+The server picks the first encoding it supports and names it in the
+welcome ("encoding"); after that it sends in that encoding. Older
+clients send the bare username and keep getting JSON. The login message
+can offer compression as well (see compression.py).
+"""
+
+import base64
+import binascii
+import json
+
+# Encodings, in the server's order of preference
+BINARY = "binary"
+JSON = "json"
+ENCODINGS = (BINARY, JSON)
+
+# Field kinds
+STR = "str"
+INT = "int"
+HEX = "hex"
+HEXES = "hexes"
+STRS = "strs"
+B64 = "b64"
+FILE = "file"
+MESSAGES = "msgs"
+ANY = "json"
+
+# Message schemas: (discriminator key, its value, fields). The opcode is the
+# position in this list plus one; append new messages at the end.
+SCHEMAS = [
+    # Client -> server
+    ("type", "message", (("sender", STR), ("receiver", STR), ("text", STR), ("version", INT))),
+    ("type", "file_offer", (("sender", STR), ("receiver", STR), ("transfer_id", HEX), ("filename", STR),
+                            ("filesize", INT), ("chunk_size", INT), ("checksum", HEX), ("manifest", HEXES))),
+    ("type", "file_resume", (("sender", STR), ("receiver", STR), ("transfer_id", HEX), ("offset", INT))),
+    ("type", "file_end", (("transfer_id", HEX), ("checksum", HEX))),
+    ("type", "file_fetch", (("checksum", HEX),)),
+    ("type", "offline_fetch", (("cursor", INT), ("direction", STR), ("limit", INT))),
+    ("type", "offline_ack", (("batch", INT),)),
+    ("type", "file", (("sender", STR), ("receiver", STR), ("file_data", FILE))),
+    
+    # Server -> client
+    ("status", "message", (("sender", STR), ("receiver", STR), ("text", STR), ("timestamp", STR))),
+    ("status", "group_message", (("group", STR), ("sender", STR), ("text", STR), ("timestamp", STR))),
+    ("status", "sent", (("message", STR),)),
+    ("status", "success", (("message", STR), ("encoding", STR))),
+    ("status", "error", (("message", STR),)),
+    ("status", "help", (("commands", ANY),)),
+    ("status", "stats", (("stats", ANY),)),
+    ("status", "user_list", (("users", STRS), ("version", INT))),
+    ("status", "user_joined", (("user", STR), ("version", INT))),
+    ("status", "user_left", (("user", STR), ("version", INT))),
+    ("status", "presence_update", (("joined", STRS), ("left", STRS), ("version", INT))),
+    ("status", "group_list", (("groups", ANY), ("version", INT))),
+    ("status", "group_list_unchanged", (("version", INT),)),
+    ("status", "group_delta", (("since", INT), ("version", INT), ("changed", ANY), ("removed", STRS))),
+    ("status", "file_offer", (("sender", STR), ("transfer_id", HEX), ("filename", STR), ("filesize", INT),
+                              ("chunk_size", INT), ("checksum", HEX), ("manifest", HEXES))),
+    ("status", "file_resume", (("transfer_id", HEX), ("offset", INT))),
+    ("status", "file_end", (("sender", STR), ("transfer_id", HEX), ("filename", STR), ("filesize", INT),
+                            ("checksum", HEX))),
+    ("status", "file_available", (("sender", STR), ("group", STR), ("filename", STR), ("filesize", INT),
+                                  ("checksum", HEX))),
+    ("status", "file_aborted", (("sender", STR), ("transfer_id", HEX), ("filename", STR))),
+    ("status", "file_interrupted", (("transfer_id", HEX), ("filename", STR), ("receiver", STR), ("message", STR))),
+    ("status", "file_transfer", (("sender", STR), ("filename", STR), ("filesize", INT), ("checksum", HEX),
+                                 ("data", B64))),
+    ("status", "offline_messages", (("count", INT), ("cursor", INT), ("message", STR))),
+    ("status", "offline_page", (("batch", INT), ("messages", MESSAGES), ("files", INT), ("cursor", INT),
+                                ("remaining", INT))),
+]
+
+# (discriminator, value) -> (opcode, discriminator, fields, {key: slot})
+OPCODES = {}
+# opcode -> (discriminator, value, fields)
+BY_OPCODE = {}
+for opcode, (key, value, fields) in enumerate(SCHEMAS, 1):
+    OPCODES[(key, value)] = (opcode, key, fields, {name: slot for slot, (name, _) in enumerate(fields)})
+    BY_OPCODE[opcode] = (key, value, fields)
+
+# First byte of a JSON payload; opcodes stay below it
+JSON_START = ord("{")
+assert len(SCHEMAS) < JSON_START
+
+class CodecError(ValueError):
+    """A payload that is neither valid JSON nor a valid binary message"""
+
+# One-byte varints, prebuilt (most lengths and counts)
+SMALL_VARINTS = [bytes((value,)) for value in range(0x80)]
+
+def write_varint(value):
+    """Unsigned LEB128"""
+    if value < 0x80:
+        return SMALL_VARINTS[value]
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def read_varint(data, pos):
+    """(value, next position)"""
+    byte = data[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def with_length(raw):
+    return write_varint(len(raw)) + raw
+
+# Field encoders return the field's bytes, or None if the value does not fit the kind
+def encode_str(value):
+    if isinstance(value, str):
+        return with_length(value.encode('utf-8'))
+    return None
+
+def encode_int(value):
+    if type(value) is int:
+        return write_varint(value << 1 if value >= 0 else (-value << 1) - 1)
+    return None
+
+def hex_bytes(value):
+    """Raw bytes of a lowercase hex string, or None (uppercase would not round-trip)"""
+    if not isinstance(value, str) or len(value) % 2:
+        return None
+    try:
+        raw = bytes.fromhex(value)
+    except ValueError:
+        return None
+    return raw if raw.hex() == value else None
+
+def encode_hex(value):
+    raw = hex_bytes(value)
+    return None if raw is None else with_length(raw)
+
+def encode_hexes(value):
+    if not isinstance(value, list):
+        return None
+    parts = [write_varint(len(value))]
+    for item in value:
+        raw = hex_bytes(item)
+        if raw is None:
+            return None
+        parts.append(with_length(raw))
+    return b"".join(parts)
+
+def encode_strs(value):
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        return None
+    return write_varint(len(value)) + b"".join(with_length(item.encode('utf-8')) for item in value)
+
+def encode_b64(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    # Only canonical base64 comes back identical
+    if base64.b64encode(raw).decode('ascii') != value:
+        return None
+    return with_length(raw)
+
+def encode_file(value):
+    if not isinstance(value, dict):
+        return None
+    data = encode_b64(value.get("data"))
+    if data is None:
+        return None
+    rest = {key: item for key, item in value.items() if key != "data"}
+    return encode_any(rest) + data
+
+def encode_messages(value):
+    if not isinstance(value, list) or not all(isinstance(item, dict) for item in value):
+        return None
+    return write_varint(len(value)) + b"".join(with_length(encode_binary(item)) for item in value)
+
+def encode_any(value):
+    return with_length(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+
+ENCODERS = {STR: encode_str, INT: encode_int, HEX: encode_hex, HEXES: encode_hexes, STRS: encode_strs,
+            B64: encode_b64, FILE: encode_file, MESSAGES: encode_messages, ANY: encode_any}
+
+def read_bytes(data, pos):
+    length, pos = read_varint(data, pos)
+    end = pos + length
+    if end > len(data):
+        raise CodecError("field runs past the end of the payload")
+    return data[pos:end], end
+
+def decode_str(data, pos):
+    raw, pos = read_bytes(data, pos)
+    return raw.decode('utf-8'), pos
+
+def decode_int(data, pos):
+    value, pos = read_varint(data, pos)
+    return (value >> 1) ^ -(value & 1), pos
+
+def decode_hex(data, pos):
+    raw, pos = read_bytes(data, pos)
+    return raw.hex(), pos
+
+def decode_hexes(data, pos):
+    count, pos = read_varint(data, pos)
+    items = []
+    for _ in range(count):
+        raw, pos = read_bytes(data, pos)
+        items.append(raw.hex())
+    return items, pos
+
+def decode_strs(data, pos):
+    count, pos = read_varint(data, pos)
+    items = []
+    for _ in range(count):
+        item, pos = decode_str(data, pos)
+        items.append(item)
+    return items, pos
+
+def decode_b64(data, pos):
+    raw, pos = read_bytes(data, pos)
+    return base64.b64encode(raw).decode('ascii'), pos
+
+def decode_file(data, pos):
+    value, pos = decode_any(data, pos)
+    value["data"], pos = decode_b64(data, pos)
+    return value, pos
+
+def decode_messages(data, pos):
+    count, pos = read_varint(data, pos)
+    items = []
+    for _ in range(count):
+        raw, pos = read_bytes(data, pos)
+        items.append(decode_message(raw))
+    return items, pos
+
+def decode_any(data, pos):
+    raw, pos = read_bytes(data, pos)
+    return json.loads(raw), pos
+
+DECODERS = {STR: decode_str, INT: decode_int, HEX: decode_hex, HEXES: decode_hexes, STRS: decode_strs,
+            B64: decode_b64, FILE: decode_file, MESSAGES: decode_messages, ANY: decode_any}
+
+def encode_binary(message):
+    """Binary payload of a message dict (JSON if it has no opcode)"""
+    if "type" in message:
+        schema = OPCODES.get(("type", message["type"]))
+    else:
+        schema = OPCODES.get(("status", message.get("status")))
+    if schema is None:
+        return json.dumps(message).encode('utf-8')
+    
+    opcode, discriminator, fields, slots = schema
+    values = [None] * len(fields)
+    mask = 0
+    extra = None
+    for key, value in message.items():
+        if key == discriminator:
+            continue
+        slot = slots.get(key)
+        if slot is not None:
+            encoded = ENCODERS[fields[slot][1]](value)
+            if encoded is not None:
+                values[slot] = encoded
+                mask |= 1 << slot
+                continue
+        # Not in the schema, or not of the expected kind: carried as JSON
+        if extra is None:
+            extra = {}
+        extra[key] = value
+    
+    parts = [bytes((opcode,)), None]
+    parts.extend(value for value in values if value is not None)
+    if extra is not None:
+        mask |= 1 << len(fields)
+        parts.append(encode_any(extra))
+    parts[1] = write_varint(mask)
+    return b"".join(parts)
+
+def decode_binary(payload):
+    """Message dict of a binary payload"""
+    schema = BY_OPCODE.get(payload[0])
+    if schema is None:
+        raise CodecError(f"unknown opcode {payload[0]}")
+    discriminator, value, fields = schema
+    
+    message = {discriminator: value}
+    try:
+        mask, pos = read_varint(payload, 1)
+        for slot, (key, kind) in enumerate(fields):
+            if mask >> slot & 1:
+                message[key], pos = DECODERS[kind](payload, pos)
+        if mask >> len(fields) & 1:
+            extra, pos = decode_any(payload, pos)
+            message.update(extra)
+    except (IndexError, ValueError) as e:
+        raise CodecError(f"malformed {value} message: {e}")
+    if pos != len(payload):
+        raise CodecError(f"{len(payload) - pos} stray byte(s) after a {value} message")
+    return message
+
+def encode_payload(message, encoding=JSON):
+    """Frame payload of a message (dict, or str for plain text) in an encoding"""
+    if isinstance(message, str):
+        return message.encode('utf-8')
+    if encoding == BINARY:
+        return encode_binary(message)
+    return json.dumps(message).encode('utf-8')
+
+def decode_message(payload):
+    """Message of a JSON or binary payload (not a file chunk); CodecError if it is neither"""
+    if not payload:
+        raise CodecError("empty payload")
+    if payload[0] == JSON_START:
+        try:
+            return json.loads(payload)
+        except ValueError as e:
+            raise CodecError(str(e))
+    return decode_binary(payload)
+
+def login_message(username, encodings=ENCODINGS, compression=()):
+    """
+    First frame of a client that can use the given encodings and
+    compression methods (see compression.py), in its order of preference
+    """
+    login = {"type": "login", "username": username, "encodings": list(encodings)}
+    if compression:
+        login["compression"] = list(compression)
+    return json.dumps(login).encode('utf-8')
+
+def parse_login(payload):
+    """
+    (username, encoding, login message) of a first frame: a login message
+    or a bare username. username is None if the name is not UTF-8.
+    """
+    if payload[:1] == b"{":
+        try:
+            login = json.loads(payload)
+        except ValueError:
+            login = None
+        if isinstance(login, dict) and login.get("type") == "login":
+            offered = login.get("encodings") or [JSON]
+            encoding = next((name for name in offered if name in ENCODINGS), JSON)
+            return str(login.get("username", "")).strip(), encoding, login
+    try:
+        return payload.decode('utf-8').strip(), JSON, {}
+    except UnicodeDecodeError:
+        return None, JSON, {}
+
+def transcode(payload, encoding):
+    """A JSON payload re-encoded for a connection (chunks and text pass through)"""
+    if encoding == BINARY and payload[:1] == b"{":
+        return encode_binary(json.loads(payload))
+    return payload
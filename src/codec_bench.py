@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+ClassChat Codec Benchmark
+Bytes on the wire and encode/decode cost of JSON vs the binary encoding.
+
+Runs every kind of message server_bonus3 handles from clients, and the
+replies it sends, through both encodings (see codec.py) and prints one
+line per message:
+
+    message            json B  binary B  saved   json enc/dec us   binary enc/dec us
+
+Sizes are payload bytes (the 4-byte frame header is the same for both).
+Times are the best of --repeat rounds of --number calls, in microseconds
+per message, so they compare the two codecs on this machine only.
+
+Usage:
+    python3 src/codec_bench.py [--number 2000] [--repeat 5]
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import timeit
+
+from codec import encode_binary, decode_message, JSON_START
+
+def sha(index):
+    return hashlib.sha256(str(index).encode('utf-8')).hexdigest()
+
+def sample_messages():
+    """(name, message) pairs shaped like server_bonus3's traffic"""
+    users = [f"student{i}" for i in range(40)]
+    checksum = sha("lecture.pdf")
+    transfer_id = sha("transfer")[:32]
+    manifest = [sha(i) for i in range(16)]  # A 1 MB file in 64 KB chunks
+    stored = [{"status": "message", "sender": users[i], "receiver": "alice",
+               "text": f"See you at the lab at {i}:00?", "timestamp": "2024-03-01 10:15:00"}
+              for i in range(20)]
+    return [
+        # Client -> server
+        ("direct message", {"type": "message", "sender": "alice", "receiver": "bob", "text": "Are you coming to the lecture?"}),
+        ("group message", {"type": "message", "sender": "alice", "receiver": "@cs101", "text": "Slides are up"}),
+        ("command", {"type": "message", "sender": "alice", "receiver": "/groups", "text": "", "version": 42}),
+        ("file_offer", {"type": "file_offer", "sender": "alice", "receiver": "bob", "transfer_id": transfer_id,
+                        "filename": "lecture.pdf", "filesize": 1048576, "chunk_size": 65536,
+                        "checksum": checksum, "manifest": manifest}),
+        ("file_resume", {"type": "file_resume", "sender": "bob", "receiver": "alice",
+                         "transfer_id": transfer_id, "offset": 262144}),
+        ("file_end", {"type": "file_end", "transfer_id": transfer_id, "checksum": checksum}),
+        ("file_fetch", {"type": "file_fetch", "checksum": checksum}),
+        ("offline_fetch", {"type": "offline_fetch", "cursor": 1234, "direction": "newer", "limit": 20}),
+        ("offline_ack", {"type": "offline_ack", "batch": 7}),
+        ("file (legacy 16 KB)", {"type": "file", "sender": "alice", "receiver": "bob", "file_data": {
+            "filename": "notes.txt", "filesize": 16384, "checksum": checksum,
+            "data": base64.b64encode(os.urandom(16384)).decode('ascii')}}),
+        
+        # Server -> client
+        ("message", {"status": "message", "sender": "alice", "receiver": "bob", "text": "Are you coming to the lecture?"}),
+        ("group_message", {"status": "group_message", "group": "cs101", "sender": "alice", "text": "Slides are up"}),
+        ("sent", {"status": "sent", "message": "Message delivered to bob"}),
+        ("user_list (40)", {"status": "user_list", "users": users, "version": 812}),
+        ("user_joined", {"status": "user_joined", "user": "student7", "version": 813}),
+        ("presence_update", {"status": "presence_update", "joined": users[:5], "left": users[5:8], "version": 820}),
+        ("group_delta", {"status": "group_delta", "since": 40, "version": 42,
+                         "changed": {"cs101": users[:10]}, "removed": ["old"]}),
+        ("file_offer (relay)", {"status": "file_offer", "sender": "alice", "transfer_id": transfer_id,
+                                "filename": "lecture.pdf", "filesize": 1048576, "chunk_size": 65536,
+                                "checksum": checksum, "manifest": manifest}),
+        ("file_available", {"status": "file_available", "sender": "alice", "group": "cs101",
+                            "filename": "lecture.pdf", "filesize": 1048576, "checksum": checksum}),
+        ("file_transfer (16 KB)", {"status": "file_transfer", "sender": "alice", "filename": "notes.txt",
+                                   "filesize": 16384, "checksum": checksum,
+                                   "data": base64.b64encode(os.urandom(16384)).decode('ascii')}),
+        ("offline_messages", {"status": "offline_messages", "count": 20, "cursor": 1255,
+                              "message": "You have 20 offline message(s)"}),
+        ("offline_page (20)", {"status": "offline_page", "batch": 3, "messages": stored, "files": 0,
+                               "cursor": 1255, "remaining": 0}),
+    ]
+
+def best(function, number, repeat):
+    """Microseconds per call, best of repeat rounds"""
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1000000
+
+def run(number, repeat):
+    print(f"{'message':<22} {'json B':>8} {'binary B':>9} {'saved':>6}   {'json enc/dec us':>16}   {'binary enc/dec us':>18}")
+    total_json = total_binary = 0
+    for name, message in sample_messages():
+        json_payload = json.dumps(message).encode('utf-8')
+        binary_payload = encode_binary(message)
+        assert binary_payload[0] != JSON_START, f"{name} has no opcode"
+        assert decode_message(binary_payload) == message, f"{name} did not survive the round trip"
+        
+        json_encode = best(lambda: json.dumps(message).encode('utf-8'), number, repeat)
+        json_decode = best(lambda: decode_message(json_payload), number, repeat)
+        binary_encode = best(lambda: encode_binary(message), number, repeat)
+        binary_decode = best(lambda: decode_message(binary_payload), number, repeat)
+        
+        total_json += len(json_payload)
+        total_binary += len(binary_payload)
+        saved = 1 - len(binary_payload) / len(json_payload)
+        print(f"{name:<22} {len(json_payload):>8} {len(binary_payload):>9} {saved:>6.0%}   "
+              f"{json_encode:>7.1f} / {json_decode:>6.1f}   {binary_encode:>8.1f} / {binary_decode:>7.1f}")
+    
+    print(f"{'all of the above':<22} {total_json:>8} {total_binary:>9} {1 - total_binary / total_json:>6.0%}")
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="Compare the JSON and binary ClassChat encodings")
+    parser.add_argument("--number", type=int, default=2000, help="Calls per timing round (default 2000)")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing rounds; the best is shown (default 5)")
+    return parser.parse_args()
+
+def main():
+    """Main entry point"""
+    args = parse_args()
+    run(args.number, args.repeat)
+
+if __name__ == "__main__":
+    main()
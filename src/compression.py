@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+ClassChat Compression
+Negotiated per-connection zlib streams with a preset dictionary.
+
+User lists, group listings, the help text and offline pages are long and
+repeat the same keys and phrases in every frame. A client that offers
+compression at login (see codec.py),
+
+    {"type": "login", "username": "alice", "encodings": [...], "compression": ["zlib"]}
+
+finds "compression": "zlib" in the welcome. From then on either side may
+send a frame payload as
+
+    COMPRESSED_MARKER (0x7F) + zlib data ending in a sync flush
+
+The marker is neither '{', a binary opcode nor the chunk marker, so
+compressed and plain frames mix freely. Each direction of a connection
+is one zlib stream: later frames can refer back to earlier ones (the
+second user list costs a fraction of the first), and both start from
+PRESET_DICTIONARY, the keys and system strings of ClassChat's own
+messages, so even the first frame compresses. Frames below the
+threshold and file chunks are sent as they are.
+
+A stream has to be read in the order it was written, so the server
+compresses in each connection's writer, after the overflow policy has
+run: a frame that was dropped or spilled never becomes part of it.
+
+A 4 KB window and memLevel 5 keep a stream at about 32 KB (instead of
+256 KB), created at the first frame that is compressed, so thousands of
+idle connections cost nothing.
+"""
+
+import threading
+import time
+import zlib
+
+from framing import encode_frame, HEADER_SIZE, MAX_FRAME_SIZE
+from file_transfer import CHUNK_MARKER
+
+# Compression methods, in the server's order of preference
+ZLIB = "zlib"
+COMPRESSIONS = (ZLIB,)
+
+# First byte of a compressed payload
+COMPRESSED_MARKER = b'\x7f'
+
+# Payloads shorter than this are not worth a compressor call
+DEFAULT_THRESHOLD = 256
+
+# zlib parameters (both sides must agree on the window)
+LEVEL = 6
+WINDOW_BITS = 12
+MEM_LEVEL = 5
+
+# Text the streams start from. zlib finds matches anywhere in the last
+# window, but the closer to the end the cheaper, so the most common
+# fragments come last. Must stay identical on every client and server
+# (and within the window): change it only together with the method name.
+PRESET_DICTIONARY = "".join([
+    # System strings
+    "ClassChat with Groups + Files + Offline Messages.",
+    "Username is already taken. Disconnecting...",
+    "Invalid message format. Please use JSON (or the binary encoding).",
+    "Unknown command: Usage: groupname",
+    "' was corrupted in transit - not shared",
+    "' interrupted: disconnected. Send it again to resume.",
+    "' shared with member(s) of @",
+    "(currently offline)Failed to deliver message to ",
+    "Group '' already exists' does not existYou are not a member of '",
+    "' created successfullyLeft group '(group deleted - no members)Joined group '",
+    "Message sent to members in '",
+    "File '' queued for (offline)' sent to ",
+    '{"status": "help", "commands": {"Direct message": "Use receiver\'s username", '
+    '"Group message": "Use @groupname as receiver", "Send file": "Use /sendfile username filepath", '
+    '"Send file to group": "Use /sendfile @groupname filepath", "Create group": "/create groupname", '
+    '"Join group": "/join groupname", "Leave group": "/leave groupname", "List groups": "/groups", '
+    '"Online users": "/users", "Server statistics": "/stats"}}',
+    '{"status": "stats", "stats": {"time": "", "uptime": , "latency": {"direct": {"parse": {"count": , '
+    '"p50": , "p90": , "p99": , "p999": , "mean": , "min": , "max": }, "route": , "fan_out": , "send": }, '
+    '"group": , "file": , "offline": }, "locks": {"clients": {"acquired": , "contended": , "wait": }, '
+    '"groups": , "user_groups": , "presence": , "transfers": , "offline": }, "counters": , "gauges": '
+    '{"outbound": {"clients": , "frames": , "max_frames": , "bytes": }, "compression": }}}',
+    
+    # Message keys, JSON
+    '{"status": "file_available", "sender": "", "group": "", "filename": "", "filesize": , "checksum": "',
+    '{"status": "file_offer", "sender": "", "transfer_id": "", "filename": "", "filesize": , '
+    '"chunk_size": 65536, "checksum": "", "manifest": ["',
+    '{"status": "file_end", "sender": "", "transfer_id": "", "filename": "", "filesize": , "checksum": "',
+    '{"status": "file_resume", "transfer_id": "", "offset": ',
+    '{"status": "group_delta", "since": , "version": , "changed": {"": [""]}, "removed": [',
+    '{"status": "group_list", "groups": {"": [""]}, "version": ',
+    '{"status": "presence_update", "joined": [""], "left": [""], "version": ',
+    '{"status": "user_list", "users": ["", ""], "version": ',
+    '{"status": "offline_messages", "count": , "cursor": , "message": "You have offline message(s)"}',
+    '{"status": "offline_page", "batch": , "messages": [], "files": 0, "cursor": , "remaining": 0}',
+    '{"status": "sent", "message": "Message queued for ',
+    '{"status": "success", "message": "Welcome ! ',
+    '{"status": "error", "message": "',
+    '{"status": "success", "message": "Message delivered to ',
+    '{"status": "group_message", "group": "", "sender": "", "text": "", "timestamp": "20',
+    '{"status": "message", "sender": "", "receiver": "", "text": "", "timestamp": "20',
+]).encode('utf-8')
+assert len(PRESET_DICTIONARY) <= 1 << WINDOW_BITS
+
+class CompressionError(ValueError):
+    """A compressed payload that cannot be inflated"""
+
+def choose_compression(offered):
+    """First method a client offered that we support, or None"""
+    return next((name for name in offered or () if name in COMPRESSIONS), None)
+
+class CompressionStats:
+    """What compression achieved and cost, for every connection of one server"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = 0            # Frames compressed
+        self.raw_bytes = 0         # Their payloads before ...
+        self.compressed_bytes = 0  # ... and after
+        self.deflate_seconds = 0.0
+        self.inflated = 0          # Frames received compressed
+        self.inflated_bytes = 0    # Their payloads after inflating
+        self.inflate_seconds = 0.0
+    
+    def deflated(self, raw, compressed, seconds):
+        with self.lock:
+            self.frames += 1
+            self.raw_bytes += raw
+            self.compressed_bytes += compressed
+            self.deflate_seconds += seconds
+    
+    def inflate(self, raw, seconds):
+        with self.lock:
+            self.inflated += 1
+            self.inflated_bytes += raw
+            self.inflate_seconds += seconds
+    
+    def summary(self):
+        """Ratios and CPU time (for the metrics gauges)"""
+        with self.lock:
+            summary = {
+                "frames": self.frames,
+                "raw_bytes": self.raw_bytes,
+                "compressed_bytes": self.compressed_bytes,
+                "ratio": round(self.raw_bytes / self.compressed_bytes, 2) if self.compressed_bytes else None,
+                "deflate_cpu_ms": round(self.deflate_seconds * 1000, 1),
+                "deflate_us_per_frame": round(self.deflate_seconds / self.frames * 1000000, 1) if self.frames else None,
+                "inflated": self.inflated,
+                "inflate_cpu_ms": round(self.inflate_seconds * 1000, 1)
+            }
+        return summary
+
+class Deflater:
+    """Outgoing half of a compressed connection: one zlib stream"""
+    
+    def __init__(self, threshold=DEFAULT_THRESHOLD, stats=None):
+        self.threshold = threshold
+        self.stats = stats
+        self.stream = None  # Created at the first compressed frame
+    
+    def payload(self, payload):
+        """The payload as sent: compressed if large enough (call in sending order)"""
+        if len(payload) < self.threshold or payload[:1] == CHUNK_MARKER:
+            return payload
+        
+        started = time.perf_counter()
+        if self.stream is None:
+            self.stream = zlib.compressobj(LEVEL, zlib.DEFLATED, WINDOW_BITS, MEM_LEVEL,
+                                           zlib.Z_DEFAULT_STRATEGY, PRESET_DICTIONARY)
+        data = COMPRESSED_MARKER + self.stream.compress(payload) + self.stream.flush(zlib.Z_SYNC_FLUSH)
+        if self.stats:
+            self.stats.deflated(len(payload), len(data), time.perf_counter() - started)
+        return data
+    
+    def pack(self, frames):
+        """Bytes to write for a batch of encoded frames, large ones compressed"""
+        parts = []
+        for frame in frames:
+            if len(frame) - HEADER_SIZE < self.threshold or frame[HEADER_SIZE:HEADER_SIZE + 1] == CHUNK_MARKER:
+                parts.append(frame)
+            else:
+                parts.append(encode_frame(self.payload(frame[HEADER_SIZE:])))
+        return b"".join(parts)
+
+class Inflater:
+    """Incoming half of a compressed connection: one zlib stream"""
+    
+    def __init__(self, stats=None):
+        self.stats = stats
+        self.stream = None  # Created at the first compressed frame
+    
+    def payload(self, payload):
+        """The original payload of a received frame (plain frames pass through)"""
+        if payload[:1] != COMPRESSED_MARKER:
+            return payload
+        
+        started = time.perf_counter()
+        if self.stream is None:
+            self.stream = zlib.decompressobj(WINDOW_BITS, zdict=PRESET_DICTIONARY)
+        try:
+            data = self.stream.decompress(payload[1:], MAX_FRAME_SIZE)
+        except zlib.error as e:
+            raise CompressionError(f"Corrupt compressed frame: {e}")
+        if self.stream.unconsumed_tail:
+            raise CompressionError(f"Compressed frame inflates past {MAX_FRAME_SIZE} bytes")
+        if self.stats:
+            self.stats.inflate(len(data), time.perf_counter() - started)
+        return data
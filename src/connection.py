@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+ClassChat Connections
+Transport-independent view of a connected client.
+
+The chat logic in server_bonus3.py only talks to Connection objects, so
+the same registration, messaging, group, file and offline code runs
+unchanged on top of the thread-per-client server and the event-loop
+servers. Each I/O model provides its own subclass.
+
+Every connection owns a bounded outbound queue of encoded frames that is
+drained by its own writer (a thread, an asyncio task or the reactor).
+send() only appends to that queue, so a student on a slow link can never
+stall the thread that is broadcasting to everyone else. When a queue
+passes its high-water mark the configured overflow policy decides what
+happens:
+- drop_oldest: discard the oldest queued frames to make room
+- disconnect:  drop the slow client (it can reconnect and resync)
+- spill:       hand the frame to a spill handler (the offline store)
+
+File chunks relayed from one client to another must not be dropped, so
+the relay uses flow control instead: after queuing a chunk the chat logic
+calls sender.throttle(receiver) and the transport stops reading from the
+sender until the receiver's queue is below RELAY_WINDOW_BYTES again.
+
+A connection can also be handed to another worker process (workers.py):
+the chat logic sets connection.handoff and returns False from on_frame,
+and the transport passes the socket and the input it has not processed
+yet to handoff(sock, preload) instead of closing it.
+
+Messages are encoded in the encoding the client asked for at login
+(JSON unless it chose the binary one, see codec.py). If it also asked
+for compression, the writer passes each batch through pack(), which
+compresses the large frames in the order they are written (see
+compression.py).
+
+Stored files are queued as FileRegions instead of bytes: a frame header
+and a range of an open file that the writer hands to sendfile(), so the
+kernel copies spool pages straight to the socket without the data ever
+passing through Python.
+
+Frames can be queued with a kind of message ("direct", "group", ...).
+The writer reports how long those frames waited before reaching the
+socket to the configured metrics (the "send" stage, see metrics.py).
+"""
+
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+from framing import encode_frame
+from codec import encode_payload, JSON
+from workers import pending_bytes
+
+# Overflow policies
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+SPILL = "spill"
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT, SPILL)
+
+# Default high-water mark: frames queued for one client
+DEFAULT_QUEUE_LIMIT = 1024
+
+# Largest amount of queued data handed to one write call
+WRITE_BATCH_BYTES = 256 * 1024
+
+# Relayed file data queued for one receiver before its sender is paused
+RELAY_WINDOW_BYTES = 1024 * 1024
+
+def configure_outbound(queue_limit=DEFAULT_QUEUE_LIMIT, policy=DROP_OLDEST, spill_handler=None, metrics=None):
+    """
+    Set the outbound queue limit and overflow policy for all connections.
+    spill_handler(connection, frame) is used by the spill policy.
+    metrics (a metrics.Metrics) gets send latencies and dropped frames.
+    """
+    if policy not in OVERFLOW_POLICIES:
+        raise ValueError(f"Unknown overflow policy: {policy}")
+    Connection.queue_limit = queue_limit
+    Connection.overflow_policy = policy
+    Connection.spill_handler = staticmethod(spill_handler) if spill_handler else None
+    Connection.metrics = metrics
+
+class FileRegion:
+    """
+    A queued frame whose payload is read from a file by sendfile().
+    Regions of one file share its file object, which stays open (even if
+    the file is deleted) until the last of them has been written or dropped.
+    """
+    
+    __slots__ = ("header", "file", "offset", "count")
+    
+    def __init__(self, header, file, offset, count):
+        self.header = header  # Frame header and the start of the payload, sent as bytes
+        self.file = file
+        self.offset = offset
+        self.count = count  # Bytes of the file still to send
+    
+    def __len__(self):
+        return len(self.header) + self.count
+    
+    def send(self, sock):
+        """Send what a non-blocking socket takes of the file range now (BlockingIOError if nothing)"""
+        if hasattr(os, "sendfile"):
+            sent = os.sendfile(sock.fileno(), self.file.fileno(), self.offset, self.count)
+        else:
+            self.file.seek(self.offset)
+            sent = sock.send(self.file.read(min(self.count, WRITE_BATCH_BYTES)))
+        if not sent:
+            raise OSError(f"{self.file.name} ended {self.count} bytes early")
+        self.offset += sent
+        self.count -= sent
+
+class OutboundQueue:
+    """FIFO of encoded frames waiting to be written to one client"""
+    
+    def __init__(self):
+        self.frames = deque()
+        self.stamps = deque()  # (queued_at, kind) for each frame
+        self.bytes = 0
+    
+    def __len__(self):
+        return len(self.frames)
+    
+    def push(self, frame, kind=None):
+        self.frames.append(frame)
+        self.stamps.append((time.perf_counter(), kind))
+        self.bytes += len(frame)
+    
+    def pop(self):
+        self.stamps.popleft()
+        frame = self.frames.popleft()
+        self.bytes -= len(frame)
+        return frame
+    
+    def pop_batch(self, max_bytes):
+        """
+        Pop frames (at least one) up to max_bytes, for one write call.
+        Returns (frames, stamps) - pass stamps to Connection.sent() once written.
+        """
+        stamps = [self.stamps[0]]
+        batch = [self.pop()]
+        size = len(batch[0])
+        while self.frames and size + len(self.frames[0]) <= max_bytes:
+            stamps.append(self.stamps[0])
+            frame = self.pop()
+            batch.append(frame)
+            size += len(frame)
+        return batch, stamps
+
+class Connection:
+    """A connected client as seen by the chat logic"""
+    
+    queue_limit = DEFAULT_QUEUE_LIMIT
+    overflow_policy = DROP_OLDEST
+    spill_handler = None
+    metrics = None
+    
+    def __init__(self, address):
+        self.address = address
+        self.username = None  # Set once registration succeeds
+        self.received_at = None  # perf_counter() of the last read, set by the transport
+        self.encoding = JSON  # Encoding of messages sent to this client, negotiated at login
+        self.deflater = None  # compression.Deflater / Inflater once compression is negotiated
+        self.inflater = None
+        self.handoff = None  # handoff(sock, preload) when another worker takes the client
+        self.outbound = OutboundQueue()
+        self.outbound_lock = threading.Lock()
+        self.closing = False  # No new frames; close once the queue drains
+        self.dropped_frames = 0
+        self.spilled_frames = 0
+        self.throttled_by = None  # Connection whose queue must drain before we read on
+        self.drained = threading.Condition(self.outbound_lock)  # Notified as the writer pops frames
+    
+    def send(self, message, kind=None):
+        """Encode a message (dict or str) in the client's encoding as a frame and queue it"""
+        self.send_frame(encode_frame(encode_payload(message, self.encoding)), kind)
+    
+    def send_frame(self, frame, kind=None):
+        """
+        Queue an already encoded frame, applying the overflow policy.
+        kind (a metrics message kind) times the frame until it is written.
+        """
+        overflow = None
+        
+        with self.outbound_lock:
+            if self.closing:
+                return
+            
+            if len(self.outbound) >= self.queue_limit:
+                overflow = self.overflow_policy
+                if overflow == DROP_OLDEST:
+                    while len(self.outbound) >= self.queue_limit:
+                        self.outbound.pop()
+                        self.dropped_frames += 1
+                        if self.metrics:
+                            self.metrics.count("frames_dropped")
+                    self.outbound.push(frame, kind)
+            else:
+                self.outbound.push(frame, kind)
+        
+        # Policy actions run outside the queue lock (they take other locks)
+        if overflow == DISCONNECT:
+            print(f"[QUEUE] {self.username} is too slow ({self.queue_limit} frames queued) - disconnecting")
+            self.abort()
+            return
+        
+        if overflow == SPILL:
+            if self.spill_handler and self.spill_handler(self, frame):
+                self.spilled_frames += 1
+                if self.metrics:
+                    self.metrics.count("frames_spilled")
+            else:
+                self.dropped_frames += 1
+                if self.metrics:
+                    self.metrics.count("frames_dropped")
+            return
+        
+        self.wake_writer()
+    
+    def pack(self, batch):
+        """
+        What to write for a batch of frames (called by the writer, in order):
+        bytes, and each FileRegion right after the bytes ending in its header
+        """
+        pieces = []
+        frames = []
+        for frame in batch:
+            if isinstance(frame, FileRegion):
+                frames.append(frame.header)
+                pieces.append(self.join(frames))
+                pieces.append(frame)
+                frames = []
+            else:
+                frames.append(frame)
+        if frames:
+            pieces.append(self.join(frames))
+        return pieces
+    
+    def join(self, frames):
+        """Bytes to write for a run of encoded frames, large ones compressed if negotiated"""
+        if self.deflater is None:
+            return b''.join(frames)
+        return self.deflater.pack(frames)
+    
+    def hand_off(self, sock, payloads, decoder):
+        """Pass the socket on with the input not processed yet (payloads from the current frame on)"""
+        self.handoff(sock, pending_bytes(payloads, decoder))
+    
+    def sent(self, stamps):
+        """Report the send latency of a batch the writer has just written"""
+        if self.metrics:
+            self.metrics.record_sent(stamps)
+    
+    def queued_frames(self):
+        """Number of frames waiting in the outbound queue"""
+        return len(self.outbound)
+    
+    def throttle(self, target):
+        """Stop reading from this client until target's queue drains (file relay)"""
+        self.throttled_by = target
+    
+    def backlogged(self):
+        """True while more than a relay window of data is queued"""
+        return self.outbound.bytes > RELAY_WINDOW_BYTES and not self.closing
+    
+    def wait_until_drained(self, limit=RELAY_WINDOW_BYTES, frames=None):
+        """
+        Block a helper thread (never an event loop) until at most limit
+        bytes (and, if given, fewer than frames frames) are queued.
+        Returns False if the connection is closing.
+        """
+        with self.drained:
+            while ((self.outbound.bytes > limit or (frames is not None and len(self.outbound) >= frames))
+                   and not self.closing):
+                self.drained.wait(1.0)
+            return not self.closing
+    
+    def close(self):
+        """Stop accepting frames and close once queued frames are written"""
+        with self.outbound_lock:
+            self.closing = True
+        self.wake_writer()
+    
+    def wake_writer(self):
+        """Tell the writer that the queue has new work"""
+        raise NotImplementedError
+    
+    def abort(self):
+        """Close the transport immediately, discarding queued frames"""
+        raise NotImplementedError
+
+class SocketConnection(Connection):
+    """Blocking socket connection used by the thread-per-client server"""
+    
+    def __init__(self, sock, address):
+        super().__init__(address)
+        self.sock = sock
+        self.ready = self.drained  # Writer wake-ups, reader room and drain waits share one condition
+        
+        # Dedicated writer thread drains the outbound queue
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+    
+    def wake_writer(self):
+        with self.ready:
+            self.ready.notify_all()
+    
+    def wait_for_room(self):
+        """
+        Block the reader while this client's own replies are backed up.
+        Replies then throttle the sender instead of overflowing its queue.
+        """
+        with self.ready:
+            while len(self.outbound) >= self.queue_limit // 2 and not self.closing:
+                self.ready.wait()
+        
+        # A relayed file waits for its receiver
+        target, self.throttled_by = self.throttled_by, None
+        if target:
+            target.wait_for_drain()
+    
+    def wait_for_drain(self):
+        """Block the calling thread until this client's queue is below the relay window"""
+        with self.ready:
+            while self.backlogged():
+                self.ready.wait()
+    
+    def write_loop(self):
+        """Write queued frames until the connection is closed"""
+        try:
+            while True:
+                with self.ready:
+                    while not self.outbound and not self.closing:
+                        self.ready.wait()
+                    if not self.outbound:
+                        break  # Closing and fully drained
+                    batch, stamps = self.outbound.pop_batch(WRITE_BATCH_BYTES)
+                    self.ready.notify_all()  # Room for a waiting reader
+                
+                for piece in self.pack(batch):
+                    if isinstance(piece, FileRegion):
+                        self.sock.sendfile(piece.file, piece.offset, piece.count)
+                    else:
+                        self.sock.sendall(piece)
+                self.sent(stamps)
+        except OSError:
+            pass
+        finally:
+            with self.ready:
+                self.closing = True
+                self.outbound = OutboundQueue()
+                self.ready.notify_all()  # Release a reader waiting for room
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+    
+    def abort(self):
+        """Shut the socket down so both reader and writer threads exit"""
+        with self.outbound_lock:
+            self.closing = True
+            self.outbound = OutboundQueue()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.wake_writer()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+ClassChat File Store
+Content-addressed on-disk storage for files waiting for offline users.
+
+Files sent to an offline student used to sit in the offline queue as a
+base64 string, so a few handouts could cost the server gigabytes of
+memory. Now the bytes are spooled to disk while they arrive and kept
+under their SHA-256 checksum:
+
+    spool/
+        tmp/                 files still being received
+        ab/abcdef0123...     finished files, named by checksum
+
+The offline queue only holds a small reference (the checksum) and the
+bytes are streamed from disk again when the student logs in.
+
+Identical files are stored once. Every queued reference holds a count on
+its file (commit() and acquire() take one, release() drops one) and the
+file is deleted with its last reference, so a handout sent to 300
+students costs one copy on disk. A sender offering a stored file does
+not need to upload it again, if the store knows the sender has the file
+(it uploaded it, or was sent it: see add_holder()). Knowing the checksum
+is not enough, since every recipient of the file is shown it.
+"""
+
+import hashlib
+import os
+import shutil
+import string
+import tempfile
+import threading
+
+# Default location of the store (relative to the server's working directory)
+DEFAULT_SPOOL_DIR = "spool"
+
+# Read size used when streaming a stored file
+READ_SIZE = 1024 * 1024
+
+def valid_checksum(checksum):
+    """True for a SHA-256 hex digest (checksums from clients become file names)"""
+    return (isinstance(checksum, str) and len(checksum) == 64
+            and all(c in string.hexdigits for c in checksum))
+
+class SpoolFile:
+    """A file being written to the store; hashes while writing"""
+    
+    def __init__(self, store):
+        self.store = store
+        fd, self.path = tempfile.mkstemp(dir=store.tmp_dir)
+        self.file = os.fdopen(fd, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+    
+    def write(self, data):
+        self.file.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+    
+    def discard(self):
+        """Throw away a partly written file"""
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class FileStore:
+    """Content-addressed blob store keyed by SHA-256 (hex)"""
+    
+    def __init__(self, root=DEFAULT_SPOOL_DIR):
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        
+        # Reference counts; all changes to stored files happen under the lock
+        self.lock = threading.Lock()
+        self.refs = {}  # {checksum: references}
+        self.holders = {}  # {checksum: usernames known to have the file}
+        
+        # Metrics
+        self.deduplicated = 0  # Stores that reused an existing file
+        self.saved_bytes = 0   # Bytes not written (or uploaded) again
+        
+        # Leftovers from transfers interrupted by a restart
+        for name in os.listdir(self.tmp_dir):
+            try:
+                os.remove(os.path.join(self.tmp_dir, name))
+            except OSError:
+                pass
+    
+    def path(self, checksum):
+        """Location of a stored file"""
+        return os.path.join(self.root, checksum[:2], checksum)
+    
+    def contains(self, checksum):
+        return valid_checksum(checksum) and os.path.exists(self.path(checksum))
+    
+    def size(self, checksum):
+        return os.path.getsize(self.path(checksum))
+    
+    def spool(self):
+        """Start writing a new file; finish with commit() or SpoolFile.discard()"""
+        return SpoolFile(self)
+    
+    def commit(self, spool, checksum=None):
+        """
+        Move a finished spool file into the store and take one reference to it.
+        Returns its checksum, or None if it does not match the expected one.
+        """
+        spool.file.close()
+        actual = spool.sha256.hexdigest()
+        if checksum is not None and actual != checksum:
+            spool.discard()
+            return None
+        
+        path = self.path(actual)
+        with self.lock:
+            if os.path.exists(path):
+                os.remove(spool.path)  # Same content already stored
+                self.deduplicated += 1
+                self.saved_bytes += spool.size
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(spool.path, path)
+            self.refs[actual] = self.refs.get(actual, 0) + 1
+        return actual
+    
+    def put(self, data, checksum=None):
+        """Store a bytes object; same result as spool() + write() + commit()"""
+        spool = self.spool()
+        spool.write(data)
+        return self.commit(spool, checksum)
+    
+    def acquire(self, checksum, duplicate=True):
+        """
+        Take another reference to a stored file; False if it is not stored.
+        duplicate=False for short holds that are not another copy of the file.
+        """
+        with self.lock:
+            if not valid_checksum(checksum) or not os.path.exists(self.path(checksum)):
+                return False
+            self.refs[checksum] = self.refs.get(checksum, 0) + 1
+            if duplicate:
+                self.deduplicated += 1
+                self.saved_bytes += self.size(checksum)
+        return True
+    
+    def release(self, checksum):
+        """Drop one reference; the file is deleted with the last one"""
+        with self.lock:
+            count = self.refs.get(checksum, 0) - 1
+            if count > 0:
+                self.refs[checksum] = count
+                return
+            self.refs.pop(checksum, None)
+            self.remove(checksum)
+    
+    def link(self, checksum, directory):
+        """
+        Put a stored file in another directory (e.g. another worker's spool/tmp)
+        under a new unique name, without copying if possible. Returns the path.
+        """
+        os.makedirs(directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=directory)
+        os.close(fd)
+        os.remove(path)
+        try:
+            os.link(self.path(checksum), path)
+        except OSError:
+            shutil.copyfile(self.path(checksum), path)
+        return path
+    
+    def adopt(self, path, checksum):
+        """Take over a file linked into tmp by link() and one reference to it"""
+        target = self.path(checksum)
+        with self.lock:
+            if os.path.exists(target):
+                os.remove(path)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(path, target)
+            self.refs[checksum] = self.refs.get(checksum, 0) + 1
+        return checksum
+    
+    def add_holder(self, checksum, username):
+        """Remember that username has a stored file (uploaded it or was sent it)"""
+        with self.lock:
+            if checksum in self.refs:
+                self.holders.setdefault(checksum, set()).add(username)
+    
+    def held_size(self, checksum, username):
+        """Size of a stored file username is known to have, or None (it has to upload it)"""
+        with self.lock:
+            if username not in self.holders.get(checksum, ()):
+                return None
+            return self.size(checksum)
+    
+    def load_references(self, counts):
+        """Set reference counts at startup ({checksum: references}); returns files pruned"""
+        with self.lock:
+            self.refs = dict(counts)
+        return self.prune(self.refs)
+    
+    def open(self, checksum):
+        """Open a stored file for reading (it stays readable while open, even once removed)"""
+        return open(self.path(checksum), 'rb')
+    
+    def iter_chunks(self, checksum, size=READ_SIZE):
+        """Yield a stored file in pieces of size bytes"""
+        with open(self.path(checksum), 'rb') as f:
+            while True:
+                data = f.read(size)
+                if not data:
+                    return
+                yield data
+    
+    def remove(self, checksum):
+        self.holders.pop(checksum, None)
+        try:
+            os.remove(self.path(checksum))
+        except OSError:
+            pass
+    
+    def prune(self, keep):
+        """Delete stored files whose checksum is not in keep; returns the count"""
+        removed = 0
+        for directory in os.listdir(self.root):
+            subdir = os.path.join(self.root, directory)
+            if directory == "tmp" or not os.path.isdir(subdir):
+                continue
+            for checksum in os.listdir(subdir):
+                if checksum not in keep:
+                    self.remove(checksum)
+                    removed += 1
+        return removed
+    
+    def stats(self):
+        """Counters for the server's status output"""
+        with self.lock:
+            return {
+                "files": len(self.refs),
+                "references": sum(self.refs.values()),
+                "deduplicated": self.deduplicated,
+                "saved_bytes": self.saved_bytes
+            }
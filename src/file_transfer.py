@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+ClassChat Streaming File Transfer
+Chunked, resumable binary file transfer on top of the framing layer.
+
+Files used to travel as one base64 string inside a JSON message: the
+whole file was held in memory on both ends (plus 33% for base64) and the
+server had to receive all of it before forwarding anything. Now a file
+is sent as a stream of frames:
+
+    1. file_offer  (JSON)    {"type": "file_offer", "sender", "receiver",
+                              "transfer_id", "filename", "filesize",
+                              "chunk_size", "checksum", "manifest"}
+    2. file_resume (JSON)    {"type": "file_resume", "transfer_id", "offset"}
+                             receiver -> sender: where to start
+    3. chunks      (binary)  CHUNK_MARKER + transfer id (16 bytes) + data
+    4. file_end    (JSON)    {"type": "file_end", "transfer_id", "checksum"}
+
+The server relays each frame as it arrives (with "status" instead of
+"type") and never holds more than a few chunks per transfer.
+
+Transfers are resumable. The offer carries a manifest with the SHA-256 of
+every chunk, and the transfer id is derived from sender, receiver and the
+file's checksum, so sending the same file again reuses the id. The
+receiver writes into downloads/<name>.<id>.part; when an offer arrives
+for a .part it already has, it keeps the chunks that match the manifest
+and answers with the byte offset to continue from. The .part file is
+renamed only after the whole-file checksum verifies.
+
+Offers without a manifest (files the server stored for an offline user)
+are not resumable: they start at offset 0 and need no file_resume.
+
+Files for offline users and groups ("@group" as receiver) are stored on
+the server under their checksum. If it already has the file, and knows
+the sender has it too (the sender uploaded it or was sent it before), it
+answers the offer with the file size as offset, and the sender only
+sends file_end. Online group members get a notice instead of the file:
+
+    file_available (JSON)   {"status": "file_available", "sender", "group",
+                             "filename", "filesize", "checksum"}
+    file_fetch     (JSON)   {"type": "file_fetch", "checksum"}
+
+and the server streams the stored file in reply to file_fetch.
+
+Neither end copies file data through Python when it does not have to:
+files are hashed from a memory map (hash_file), and a chunk is sent as
+chunk_prefix() followed by socket.sendfile() of its range of the file
+(chunk_ranges), so a 500 MB lecture video goes from the page cache to
+the socket in the kernel.
+
+JSON payloads always start with '{', so a leading zero byte is enough to
+tell a chunk apart.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+
+from framing import HEADER
+
+# Bytes of file data per chunk frame (and per manifest entry)
+CHUNK_SIZE = 64 * 1024
+
+# First byte of a binary chunk payload
+CHUNK_MARKER = b'\x00'
+
+# Transfer ids are 16 raw bytes in a chunk header, hex in JSON
+TRANSFER_ID_SIZE = 16
+CHUNK_HEADER_SIZE = len(CHUNK_MARKER) + TRANSFER_ID_SIZE
+
+# Where received files are saved
+DOWNLOADS_DIR = "downloads"
+PART_SUFFIX = ".part"
+
+def transfer_id_for(sender, receiver, checksum):
+    """Stable transfer id: the same file to the same user resumes"""
+    key = f"{sender}\0{receiver}\0{checksum}".encode('utf-8')
+    return hashlib.sha256(key).hexdigest()[:TRANSFER_ID_SIZE * 2]
+
+def is_chunk(payload):
+    """True if a frame payload is a binary file chunk"""
+    return payload[:1] == CHUNK_MARKER
+
+def encode_chunk(transfer_id, data):
+    """Build a chunk payload for a transfer"""
+    return CHUNK_MARKER + bytes.fromhex(transfer_id) + data
+
+def chunk_prefix(transfer_id, size):
+    """Frame header and chunk header of a chunk carrying size bytes (the data follows, e.g. by sendfile)"""
+    return HEADER.pack(CHUNK_HEADER_SIZE + size) + CHUNK_MARKER + bytes.fromhex(transfer_id)
+
+def chunk_transfer_id(payload):
+    """Transfer id (hex) of a chunk payload"""
+    return payload[len(CHUNK_MARKER):CHUNK_HEADER_SIZE].hex()
+
+def chunk_data(payload):
+    """File data carried by a chunk payload (no copy)"""
+    return memoryview(payload)[CHUNK_HEADER_SIZE:]
+
+def hash_file(path, chunk_size=None):
+    """
+    SHA-256 of a file, and of each chunk_size piece if chunk_size is given
+    (None otherwise): (checksum, manifest). The file is memory-mapped, so
+    the hashes read the page cache directly, without the GIL.
+    """
+    sha256 = hashlib.sha256()
+    manifest = [] if chunk_size else None
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return sha256.hexdigest(), manifest  # Empty files cannot be mapped
+        
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            if not chunk_size:
+                sha256.update(view)
+            else:
+                for start in range(0, size, chunk_size):
+                    with view[start:start + chunk_size] as chunk:
+                        sha256.update(chunk)
+                        manifest.append(hashlib.sha256(chunk).hexdigest())
+    return sha256.hexdigest(), manifest
+
+def unique_path(directory, filename):
+    """Path in directory for filename that does not overwrite an existing file"""
+    # Never trust a path from the network: keep only the base name
+    filename = os.path.basename(filename) or "unknown_file"
+    save_path = os.path.join(directory, filename)
+    
+    counter = 1
+    base_name, extension = os.path.splitext(filename)
+    while os.path.exists(save_path):
+        save_path = os.path.join(directory, f"{base_name}_{counter}{extension}")
+        counter += 1
+    return save_path
+
+class OutgoingFile:
+    """
+    A file offered to another user.
+    Hashes the file once up front to build the chunk manifest and checksum.
+    """
+    
+    def __init__(self, sender, receiver, file_path, chunk_size=CHUNK_SIZE):
+        self.sender = sender
+        self.receiver = receiver
+        self.path = file_path
+        self.filename = os.path.basename(file_path)
+        self.filesize = os.path.getsize(file_path)
+        self.chunk_size = chunk_size
+        
+        self.checksum, self.manifest = hash_file(file_path, chunk_size)
+        self.transfer_id = transfer_id_for(sender, receiver, self.checksum)
+    
+    def offer(self):
+        """Payload of the file_offer frame"""
+        return json.dumps({
+            "type": "file_offer",
+            "sender": self.sender,
+            "receiver": self.receiver,
+            "transfer_id": self.transfer_id,
+            "filename": self.filename,
+            "filesize": self.filesize,
+            "chunk_size": self.chunk_size,
+            "checksum": self.checksum,
+            "manifest": self.manifest
+        }).encode('utf-8')
+    
+    def end(self):
+        """Payload of the file_end frame"""
+        return json.dumps({
+            "type": "file_end",
+            "transfer_id": self.transfer_id,
+            "checksum": self.checksum
+        }).encode('utf-8')
+    
+    def chunk_ranges(self, offset=0):
+        """(offset, size) of every chunk from offset, for sending with sendfile"""
+        for start in range(offset, self.filesize, self.chunk_size):
+            yield start, min(self.chunk_size, self.filesize - start)
+    
+    def iter_frames(self, offset=0):
+        """Yield chunk payloads from offset, then the file_end payload (read into memory)"""
+        with open(self.path, 'rb') as f:
+            for start, size in self.chunk_ranges(offset):
+                f.seek(start)
+                yield encode_chunk(self.transfer_id, f.read(size))
+        
+        yield self.end()
+
+class FileSender:
+    """Client-side list of offered files waiting for the receiver's file_resume"""
+    
+    def __init__(self):
+        self.offered = {}  # {transfer_id: OutgoingFile}
+    
+    def offer(self, sender, receiver, file_path):
+        """Prepare a file; returns the OutgoingFile (send outgoing.offer())"""
+        outgoing = OutgoingFile(sender, receiver, file_path)
+        self.offered[outgoing.transfer_id] = outgoing
+        return outgoing
+    
+    def resume(self, message):
+        """Match a file_resume; returns (outgoing, offset) or (None, 0)"""
+        outgoing = self.offered.pop(message.get("transfer_id"), None)
+        if not outgoing:
+            return None, 0
+        
+        # Only whole chunks are acknowledged (or the whole file, if already stored)
+        offset = int(message.get("offset", 0))
+        if offset < outgoing.filesize:
+            offset -= offset % outgoing.chunk_size
+        offset = max(0, min(offset, outgoing.filesize))
+        return outgoing, offset
+
+class IncomingFile:
+    """One file being received into a .part file, with running checksums"""
+    
+    def __init__(self, offer, directory):
+        self.transfer_id = offer.get("transfer_id")
+        self.sender = offer.get("sender", "Unknown")
+        self.filename = os.path.basename(offer.get("filename") or "unknown_file")
+        self.filesize = offer.get("filesize", 0)
+        self.chunk_size = offer.get("chunk_size", CHUNK_SIZE)
+        self.manifest = offer.get("manifest")
+        self.directory = directory
+        self.part_path = os.path.join(directory, f"{self.filename}.{self.transfer_id[:16]}{PART_SUFFIX}")
+        self.path = self.part_path  # Final path once verified
+        self.sha256 = hashlib.sha256()
+        self.received = 0
+        self.corrupt = False
+        
+        if self.manifest is None:
+            self.file = open(self.part_path, 'wb')
+        else:
+            self.file = self.open_part()
+    
+    def open_part(self):
+        """Open the .part file, keeping the prefix of chunks that match the manifest"""
+        f = open(self.part_path, 'a+b')
+        f.seek(0)
+        
+        for expected in self.manifest:
+            data = f.read(self.chunk_size)
+            if not data or hashlib.sha256(data).hexdigest() != expected:
+                break
+            self.sha256.update(data)
+            self.received += len(data)
+        
+        # Drop anything after the last good chunk
+        f.truncate(self.received)
+        f.seek(self.received)
+        return f
+    
+    def write(self, data):
+        if self.manifest is not None:
+            index = self.received // self.chunk_size
+            if index >= len(self.manifest) or hashlib.sha256(data).hexdigest() != self.manifest[index]:
+                self.corrupt = True
+        self.file.write(data)
+        self.sha256.update(data)
+        self.received += len(data)
+
+class FileReceiver:
+    """
+    Client-side reassembly of streamed files into the downloads folder.
+    Feed it file_offer / chunk / file_end / file_aborted frames in order.
+    """
+    
+    def __init__(self, downloads_dir=DOWNLOADS_DIR):
+        self.downloads_dir = downloads_dir
+        self.transfers = {}  # {transfer_id: IncomingFile}
+    
+    def offer(self, message):
+        """
+        Start (or resume) receiving a file.
+        Returns (incoming, reply): reply is the file_resume message to send
+        back, or None when the offer is not resumable.
+        """
+        os.makedirs(self.downloads_dir, exist_ok=True)
+        
+        # Close a stale attempt of the same transfer first
+        stale = self.transfers.pop(message.get("transfer_id"), None)
+        if stale:
+            stale.file.close()
+        
+        incoming = IncomingFile(message, self.downloads_dir)
+        self.transfers[incoming.transfer_id] = incoming
+        
+        if incoming.manifest is None:
+            return incoming, None
+        
+        reply = {
+            "type": "file_resume",
+            "sender": message.get("receiver"),
+            "receiver": incoming.sender,
+            "transfer_id": incoming.transfer_id,
+            "offset": incoming.received
+        }
+        return incoming, reply
+    
+    def chunk(self, payload):
+        """Write one chunk; returns the IncomingFile (None if unknown)"""
+        incoming = self.transfers.get(chunk_transfer_id(payload))
+        if incoming:
+            incoming.write(chunk_data(payload))
+        return incoming
+    
+    def finish(self, message):
+        """
+        Complete a file: verify it and move the .part file into place.
+        Returns (incoming, verified) or (None, False) if the transfer is unknown.
+        """
+        incoming = self.transfers.pop(message.get("transfer_id"), None)
+        if not incoming:
+            return None, False
+        
+        incoming.file.close()
+        verified = not incoming.corrupt and incoming.sha256.hexdigest() == message.get("checksum")
+        
+        if verified:
+            incoming.path = unique_path(self.downloads_dir, incoming.filename)
+            os.replace(incoming.part_path, incoming.path)
+        else:
+            # A corrupt .part cannot be resumed; start over next time
+            try:
+                os.remove(incoming.part_path)
+            except OSError:
+                pass
+        return incoming, verified
+    
+    def abort(self, message):
+        """
+        Stop receiving a file whose sender went away.
+        The .part file stays so the transfer can resume; returns the
+        IncomingFile (None if unknown).
+        """
+        incoming = self.transfers.pop(message.get("transfer_id"), None)
+        if incoming:
+            incoming.file.close()
+        return incoming
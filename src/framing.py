@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+ClassChat Framing Layer
+Length-prefixed message framing shared by the JSON servers and clients.
+
+TCP is a byte stream: one recv() can return half a message or several
+messages glued together. Every message on the wire is therefore sent as
+a frame:
+
+    +----------------------+---------------------------+
+    | length (4 bytes, BE) | payload (length bytes)    |
+    +----------------------+---------------------------+
+
+The payload is UTF-8 text (the username prompt, the username) or a JSON
+document. FrameDecoder buffers partial input and returns every complete
+payload, so many messages can be read with a single recv() call.
+
+The send helpers take a lock per socket: in the thread-per-client
+servers several threads write to one client (its own replies, a
+broadcast, a relayed file chunk), and two sendall() calls that
+interleave would leave the receiver reading a header out of the middle
+of a payload.
+"""
+
+import json
+import struct
+import threading
+import weakref
+
+# Frame header: unsigned 32-bit payload length, network byte order
+HEADER = struct.Struct('!I')
+HEADER_SIZE = HEADER.size
+
+# Refuse frames larger than this (protects the decoder buffer)
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# One lock per socket written by the send helpers: {socket: Lock}
+send_locks = weakref.WeakKeyDictionary()
+send_locks_lock = threading.Lock()
+
+# Default recv() size for socket reads
+RECV_BUFFER_SIZE = 65536
+
+class FrameError(ValueError):
+    """Raised when the peer sends a frame that violates the protocol"""
+
+def encode_frame(payload):
+    """Prefix a payload (bytes) with its length header"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame too large: {len(payload)} bytes")
+    return HEADER.pack(len(payload)) + payload
+
+def encode_message(message):
+    """Encode a JSON-serializable message (or plain string) as a frame"""
+    if isinstance(message, str):
+        return encode_frame(message.encode('utf-8'))
+    return encode_frame(json.dumps(message).encode('utf-8'))
+
+def send_lock(sock):
+    """The lock that keeps frames sent on sock whole"""
+    with send_locks_lock:
+        lock = send_locks.get(sock)
+        if lock is None:
+            lock = send_locks[sock] = threading.Lock()
+        return lock
+
+def send_all(sock, data):
+    """sendall() that never interleaves with another thread's frame"""
+    with send_lock(sock):
+        sock.sendall(data)
+
+def send_frame(sock, payload):
+    """Send one framed payload on a blocking socket"""
+    send_all(sock, encode_frame(payload))
+
+def send_json(sock, message):
+    """Serialize a message to JSON and send it as one frame"""
+    send_all(sock, encode_message(message))
+
+def send_text(sock, text):
+    """Send a plain text string (e.g. prompt or username) as one frame"""
+    send_all(sock, encode_message(text))
+
+class FrameDecoder:
+    """
+    Incremental frame decoder.
+    Feed it raw bytes as they arrive; it returns the complete payloads
+    and keeps any trailing partial frame for the next call.
+    """
+    
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+    
+    def feed(self, data):
+        """Append received bytes and return a list of complete payloads"""
+        self.buffer.extend(data)
+        payloads = []
+        offset = 0
+        buffered = len(self.buffer)
+        
+        while buffered - offset >= HEADER_SIZE:
+            (length,) = HEADER.unpack_from(self.buffer, offset)
+            if length > self.max_frame_size:
+                raise FrameError(f"Frame too large: {length} bytes")
+            
+            end = offset + HEADER_SIZE + length
+            if end > buffered:
+                break  # Wait for the rest of this frame
+            
+            payloads.append(bytes(self.buffer[offset + HEADER_SIZE:end]))
+            offset = end
+        
+        # Drop consumed bytes in one operation
+        if offset:
+            del self.buffer[:offset]
+        
+        return payloads
+    
+    def pending(self):
+        """Number of buffered bytes not yet forming a complete frame"""
+        return len(self.buffer)
+
+def iter_frames(sock, decoder=None, bufsize=RECV_BUFFER_SIZE):
+    """
+    Yield complete payloads read from a blocking socket.
+    Stops when the peer closes the connection.
+    """
+    if decoder is None:
+        decoder = FrameDecoder()
+    
+    while True:
+        data = sock.recv(bufsize)
+        if not data:
+            return
+        
+        for payload in decoder.feed(data):
+            yield payload
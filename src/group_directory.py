@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+ClassChat Group Directory
+Versioned, pre-serialized group listings for the /groups command.
+
+Server -> client messages:
+    {"status": "group_list", "groups": {name: [members]}, "version": N}
+                                                   - full listing
+    {"status": "group_list_unchanged", "version": N}
+                                                   - nothing changed since N
+    {"status": "group_delta", "since": M, "version": N,
+     "changed": {name: [members]}, "removed": [names]}
+                                                   - groups changed after M
+
+The server used to rebuild and re-serialize the whole listing on every
+/create, /join, /leave and /groups. Now every membership change bumps
+the directory version and records which group changed. The full listing
+is built and framed once per version and the same bytes are queued for
+every client that asks.
+
+A client sends the version it last saw with its command:
+
+    {"type": "message", "receiver": "/groups", "version": N}
+
+and gets "unchanged" if nothing happened since, a delta with the groups
+that changed if the change history still covers N, or the full listing
+otherwise. Deltas carry each changed group's current members (not the
+individual joins and leaves), so applying one twice, or on top of a
+newer listing, is harmless. Clients that send no version always get
+the full listing, as before.
+"""
+
+import threading
+import time
+from collections import deque
+
+from framing import encode_message
+
+# Changes remembered for deltas; clients further behind get the full listing
+DEFAULT_HISTORY = 1024
+
+class GroupDirectory:
+    """
+    Server-side version counter, change history and cached listing.
+    
+    Reads the group registry ({group_name: frozenset(members)}) without
+    locking it; changed() is called by whoever modifies a group.
+    """
+    
+    def __init__(self, registry, history=DEFAULT_HISTORY):
+        self.registry = registry
+        self.lock = threading.Lock()
+        # Starts at the start time (ms): a version from before a restart never matches
+        self.version = int(time.time() * 1000)
+        self.changes = deque(maxlen=history)  # (version, group_name), oldest first
+        self.listing = None  # Framed full listing for self.version
+        
+        # Metrics
+        self.full = 0       # Full listings sent
+        self.rebuilt = 0    # Full listings built and serialized
+        self.deltas = 0     # Deltas sent
+        self.unchanged = 0  # "Not modified" replies
+    
+    def changed(self, group_name):
+        """Record a membership change (group created, joined, left or deleted)"""
+        with self.lock:
+            self.version += 1
+            self.changes.append((self.version, group_name))
+            self.listing = None
+    
+    def reply(self, since=None):
+        """Frame answering a client that last saw version since (None = never)"""
+        with self.lock:
+            version = self.version
+            if since == version:
+                self.unchanged += 1
+                return encode_message({"status": "group_list_unchanged", "version": version})
+            
+            # History covers since when the change right after it is still recorded
+            names = None
+            if isinstance(since, int) and since < version and self.changes and self.changes[0][0] <= since + 1:
+                names = {name for change, name in self.changes if change > since}
+            
+            if names is None:
+                self.full += 1
+                if self.listing is not None:
+                    return self.listing
+        
+        if names is not None:
+            return self.delta(since, version, names)
+        return self.build(version)
+    
+    def build(self, version):
+        """Serialize the full listing, caching it if no change raced the build"""
+        # Lock-free snapshot; a change made meanwhile is also sent as a delta later
+        listing = encode_message({
+            "status": "group_list",
+            "groups": {name: list(members) for name, members in self.registry.items()},
+            "version": version
+        })
+        with self.lock:
+            self.rebuilt += 1
+            if self.version == version:
+                self.listing = listing
+        return listing
+    
+    def delta(self, since, version, names):
+        """Serialize the current members of the groups that changed after since"""
+        changed = {}
+        removed = []
+        for name in names:
+            members = self.registry.get(name)
+            if members is None:
+                removed.append(name)
+            else:
+                changed[name] = list(members)
+        
+        with self.lock:
+            self.deltas += 1
+        return encode_message({
+            "status": "group_delta",
+            "since": since,
+            "version": version,
+            "changed": changed,
+            "removed": removed
+        })
+    
+    def stats(self):
+        """Counters for the server's status output"""
+        with self.lock:
+            return {
+                "version": self.version,
+                "full": self.full,
+                "rebuilt": self.rebuilt,
+                "deltas": self.deltas,
+                "unchanged": self.unchanged
+            }
+
+class GroupListTracker:
+    """Client-side copy of the group directory kept current from listings and deltas"""
+    
+    def __init__(self):
+        self.groups = {}  # {group_name: [members]}
+        self.version = None  # No listing received yet
+    
+    def apply(self, message):
+        """
+        Apply a group_list / group_delta / group_list_unchanged message.
+        Returns True if the groups changed.
+        """
+        status = message.get("status")
+        version = message.get("version")
+        
+        if status == "group_list":
+            self.groups = dict(message.get("groups", {}))
+            self.version = version
+            return True
+        
+        if status == "group_delta":
+            for name, members in message.get("changed", {}).items():
+                self.groups[name] = members
+            for name in message.get("removed", []):
+                self.groups.pop(name, None)
+            if version is not None and (self.version is None or version > self.version):
+                self.version = version
+            return True
+        
+        return False
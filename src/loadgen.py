@@ -0,0 +1,737 @@
+#!/usr/bin/env python3
+"""
+ClassChat Load Generator
+Headless benchmark that drives a ClassChat server with simulated clients.
+
+The only checks so far were py_compile (make test, verify.sh) and opening
+Tk windows by hand (test_gui.sh). This tool starts a server (or uses one
+that is already running), connects thousands of simulated students from
+a single asyncio event loop and reports:
+
+    - delivered messages per second (direct and @group)
+    - p50 / p99 delivery latency, from send to receipt (one process, one clock)
+    - file throughput (streamed file_offer transfers)
+    - offline delivery after a reconnect (queued, paged and acknowledged)
+    - the server's resident memory, peak and at the end (from /proc)
+
+Every server gets the traffic it understands:
+
+    task4   direct messages
+    bonus1  direct, @group
+    bonus2  direct, @group, files
+    bonus3  direct, @group, files, offline reconnect
+
+Examples:
+    python3 src/loadgen.py --server bonus3 --clients 2000 --duration 20
+    python3 src/loadgen.py --server bonus3 --server-args "--mode reactor"
+    python3 src/loadgen.py --server bonus1 --connect 127.0.0.1:12345 --pid 4242
+    python3 src/loadgen.py --server bonus3 --nodes 3
+    python3 src/loadgen.py --server bonus3 --encoding binary
+    python3 src/loadgen.py --server bonus3 --compression
+
+With --nodes N it starts a cluster instead: broker.py and N server_bonus3
+nodes on the following ports. Clients are spread over the nodes and come
+back from the offline round at the next node, so offline messages have
+to be forwarded between nodes.
+
+With --encoding binary the clients ask server_bonus3 for the compact
+binary encoding at login (codec.py), and with --compression for
+compressed streams (compression.py); the report shows the bytes they
+received, for comparing either with plain JSON.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+
+from framing import FrameDecoder, encode_frame, RECV_BUFFER_SIZE
+from codec import decode_message, encode_payload, login_message, transcode, BINARY, JSON
+from compression import Deflater, Inflater, COMPRESSIONS
+from file_transfer import is_chunk, chunk_transfer_id, CHUNK_HEADER_SIZE, FileSender
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Traffic each server understands
+SERVER_FEATURES = {
+    "task4": ("direct",),
+    "bonus1": ("direct", "group"),
+    "bonus2": ("direct", "group", "file"),
+    "bonus3": ("direct", "group", "file", "offline"),
+}
+
+# Port for servers started by the benchmark (away from the default 12345)
+DEFAULT_PORT = 12400
+
+# Connections opened at once while ramping up; the older servers listen(10),
+# so a bigger burst overflows their accept queue and waits on retries
+CONNECT_BATCH = 200
+SMALL_BACKLOG_BATCH = 10
+SMALL_BACKLOG_SERVERS = ("task4", "bonus1", "bonus2")
+CONNECT_RETRIES = 50
+
+# Seconds to wait for the username prompt; a connection dropped from a full
+# accept queue never gets one, so it is closed and opened again
+HANDSHAKE_TIMEOUT = 2.0
+
+# Seconds to wait for a server to accept connections or for group setup
+STARTUP_TIMEOUT = 10.0
+
+# Offline pages requested on reconnect
+OFFLINE_PAGE_LIMIT = 100
+
+def percentile(values, p):
+    """p-th percentile of a sorted list (None if empty)"""
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def read_rss(pid):
+    """Resident memory of a process in bytes (None where /proc is not available)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def total_rss(pids):
+    """Resident memory of several processes together (None if one is unknown)"""
+    sizes = [read_rss(pid) for pid in pids]
+    return None if not sizes or None in sizes else sum(sizes)
+
+def raise_file_limit():
+    """Raise the open file limit; a server started by us inherits it"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        return hard
+    except (ImportError, ValueError, OSError):
+        return None
+
+def start_broker(port, log):
+    """Start broker.py on port in the background; returns the Popen"""
+    command = [sys.executable, os.path.join(SRC_DIR, "broker.py"), "--port", str(port)]
+    env = dict(os.environ, PYTHONPATH=SRC_DIR, PYTHONUNBUFFERED="1")
+    return subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def start_server(name, port, extra_args, workdir, log):
+    """Start server_<name> on port in the background; returns the Popen"""
+    module = f"server_{name}"
+    if name == "bonus3":
+        # Offline queue and spool in the scratch directory, not the repo
+        command = [sys.executable, os.path.join(SRC_DIR, f"{module}.py"), "--port", str(port),
+                   "--offline-db", os.path.join(workdir, "offline.db"),
+                   "--spool-dir", os.path.join(workdir, "spool")] + extra_args
+    else:
+        # The older servers have no options: set PORT, then run main()
+        command = [sys.executable, "-c", f"import {module} as server; server.PORT = {port}; server.main()"]
+    
+    env = dict(os.environ, PYTHONPATH=SRC_DIR, PYTHONUNBUFFERED="1")
+    return subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def stop_server(process):
+    """Ctrl+C the server (it prints its shutdown stats), kill it if it hangs"""
+    if process.poll() is not None:
+        return
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def wait_for_port(host, port, process=None, timeout=STARTUP_TIMEOUT):
+    """True once host:port accepts connections (False if process exits first)"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        # A server that failed to bind (port in use) must not be mistaken
+        # for whatever else is listening there
+        if process is not None and process.poll() is not None:
+            return False
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+class Stats:
+    """Counters and latency samples for one run"""
+    
+    KINDS = ("direct", "group", "offline")
+    
+    def __init__(self):
+        self.sent = dict.fromkeys(self.KINDS, 0)
+        self.delivered = dict.fromkeys(self.KINDS, 0)
+        self.latencies = {kind: [] for kind in self.KINDS}
+        self.sent_at = {}  # {message id: (kind, send time)}
+        self.next_id = 0
+        
+        self.files_sent = 0
+        self.files_received = 0
+        self.file_bytes = 0
+        self.file_started = {}  # {transfer_id: send time}
+        self.file_times = []
+        
+        self.wire_bytes = 0  # Bytes the clients read from the server
+        self.rss = []  # Server RSS samples (bytes)
+        self.connect_failures = 0
+    
+    def message_sent(self, kind):
+        """Register a message; returns the text that identifies it"""
+        self.next_id += 1
+        self.sent[kind] += 1
+        self.sent_at[self.next_id] = (kind, time.perf_counter())
+        return f"bench:{self.next_id}"
+    
+    def message_received(self, text):
+        if not isinstance(text, str) or not text.startswith("bench:"):
+            return
+        try:
+            entry = self.sent_at.get(int(text[6:]))
+        except ValueError:
+            return
+        if entry:
+            kind, sent = entry
+            self.delivered[kind] += 1
+            self.latencies[kind].append(time.perf_counter() - sent)
+    
+    def file_done(self, transfer_id, size):
+        started = self.file_started.pop(transfer_id, None)
+        if started is not None:
+            self.files_received += 1
+            self.file_bytes += size
+            self.file_times.append(time.perf_counter() - started)
+
+class SimClient:
+    """One simulated student speaking the framed protocol (JSON or binary)"""
+    
+    def __init__(self, bench, index):
+        self.bench = bench
+        self.index = index
+        self.connects = 0  # Each connect goes to the next node of a cluster
+        self.username = f"{bench.prefix}{index}"
+        self.encoding = JSON  # As agreed in the welcome
+        self.deflater = None  # Compression of what we send, if the welcome agreed to it
+        self.inflater = None
+        self.reader = None
+        self.writer = None
+        self.decoder = None
+        self.pending = deque()  # Decoded payloads not read yet
+        self.online = False
+        self.group = None
+        self.joined = False  # Member of self.group on the server right now
+        self.group_listed = asyncio.Event()  # Set when a group listing arrives
+        self.files = FileSender()
+        self.incoming = {}  # {transfer_id: bytes received}
+        self.read_task = None
+    
+    async def connect(self):
+        """Connect and register; False if the server refused"""
+        ports = self.bench.ports
+        host, port = self.bench.host, ports[(self.index + self.connects) % len(ports)]
+        self.connects += 1
+        for attempt in range(CONNECT_RETRIES):
+            try:
+                self.reader, self.writer = await asyncio.open_connection(host, port)
+                self.decoder = FrameDecoder()
+                self.inflater = Inflater()
+                self.deflater = None
+                self.pending.clear()
+                # "Enter your username: "
+                await asyncio.wait_for(self.read_frame(), HANDSHAKE_TIMEOUT)
+                break
+            except (OSError, asyncio.TimeoutError):
+                # Accept queue full: back off and retry
+                if self.writer:
+                    self.writer.close()
+                    self.writer = None
+                await asyncio.sleep(0.05 * (attempt + 1))
+        else:
+            return False
+        
+        try:
+            args = self.bench.args
+            if args.encoding == BINARY or args.compression:
+                compression = COMPRESSIONS if args.compression else ()
+                self.writer.write(encode_frame(login_message(self.username, (args.encoding,), compression)))
+            else:
+                self.writer.write(encode_frame(self.username.encode('utf-8')))
+            welcome = decode_message(await self.read_frame())
+        except (ConnectionError, ValueError):
+            return False
+        if welcome.get("status") != "success":
+            return False
+        self.encoding = welcome.get("encoding", JSON)
+        if welcome.get("compression"):
+            self.deflater = Deflater()
+        
+        self.online = True
+        self.read_task = asyncio.create_task(self.read_loop())
+        return True
+    
+    async def disconnect(self):
+        # The server takes a departing user out of all groups
+        self.online = False
+        self.joined = False
+        if self.writer:
+            self.writer.close()
+        if self.read_task:
+            await asyncio.gather(self.read_task, return_exceptions=True)
+            self.read_task = None
+    
+    async def group_command(self, text):
+        """Send a /create or /join and wait for the group listing that follows"""
+        self.group_listed.clear()
+        self.send({"type": "message", "sender": self.username, "receiver": text, "text": ""})
+        await asyncio.wait_for(self.group_listed.wait(), STARTUP_TIMEOUT)
+        self.joined = True
+    
+    async def rejoin(self):
+        """Back in the group after a reconnect (recreated if it emptied meanwhile)"""
+        await self.group_command(f"/create {self.group}")
+        await self.group_command(f"/join {self.group}")
+    
+    async def read_frame(self):
+        while not self.pending:
+            data = await self.reader.read(RECV_BUFFER_SIZE)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            self.bench.stats.wire_bytes += len(data)
+            self.pending.extend(self.decoder.feed(data))
+        return self.inflater.payload(self.pending.popleft())
+    
+    async def read_loop(self):
+        try:
+            while True:
+                payload = await self.read_frame()
+                if is_chunk(payload):
+                    transfer_id = chunk_transfer_id(payload)
+                    if transfer_id in self.incoming:
+                        self.incoming[transfer_id] += len(payload) - CHUNK_HEADER_SIZE
+                    continue
+                try:
+                    message = decode_message(payload)
+                except ValueError:
+                    continue
+                if isinstance(message, dict):
+                    self.handle(message)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.online = False
+    
+    def send(self, message):
+        """Queue one message (flow control happens in traffic())"""
+        self.write(encode_payload(message, self.encoding))
+    
+    def write(self, payload):
+        """Queue one payload, re-encoded and compressed as agreed at login"""
+        payload = transcode(payload, self.encoding)
+        if self.deflater:
+            payload = self.deflater.payload(payload)
+        self.writer.write(encode_frame(payload))
+    
+    def handle(self, message):
+        status = message.get("status")
+        stats = self.bench.stats
+        
+        if status in ("message", "group_message"):
+            stats.message_received(message.get("text"))
+        
+        elif status in ("group_list", "group_delta", "group_list_unchanged"):
+            self.group_listed.set()
+        
+        elif status == "file_offer":
+            self.incoming[message.get("transfer_id")] = 0
+            if message.get("manifest") is not None:
+                # Resumable offer: start from the beginning
+                self.send({
+                    "type": "file_resume",
+                    "sender": self.username,
+                    "receiver": message.get("sender"),
+                    "transfer_id": message.get("transfer_id"),
+                    "offset": 0
+                })
+        
+        elif status == "file_resume":
+            outgoing, offset = self.files.resume(message)
+            if outgoing:
+                asyncio.create_task(self.stream(outgoing, offset))
+        
+        elif status == "file_end":
+            transfer_id = message.get("transfer_id")
+            stats.file_done(transfer_id, self.incoming.pop(transfer_id, 0))
+        
+        elif status == "offline_messages":
+            self.fetch_offline(0)
+        
+        elif status == "offline_page":
+            self.send({"type": "offline_ack", "batch": message.get("batch")})
+            for stored in message.get("messages", []):
+                stats.message_received(stored.get("text"))
+            if message.get("remaining"):
+                self.fetch_offline(message.get("cursor"))
+    
+    def fetch_offline(self, cursor):
+        self.send({
+            "type": "offline_fetch",
+            "cursor": cursor,
+            "direction": "newer",
+            "limit": OFFLINE_PAGE_LIMIT
+        })
+    
+    async def stream(self, outgoing, offset):
+        """Send a file's chunks and file_end after the receiver's file_resume"""
+        try:
+            for payload in outgoing.iter_frames(offset):
+                self.write(payload)
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
+    
+    async def traffic(self, deadline):
+        """Send direct and group messages at the configured rate until deadline"""
+        args = self.bench.args
+        stats = self.bench.stats
+        while True:
+            # Poisson arrivals, but never sleep past the end of the run
+            delay = random.expovariate(args.rate)
+            await asyncio.sleep(min(delay, max(0, deadline - time.perf_counter())))
+            if time.perf_counter() >= deadline:
+                return
+            if not self.online:
+                continue
+            
+            try:
+                if self.joined and random.random() < args.group_ratio:
+                    self.send({
+                        "type": "message",
+                        "sender": self.username,
+                        "receiver": f"@{self.group}",
+                        "text": stats.message_sent("group")
+                    })
+                    # Every member still in the group (sender included) gets a copy
+                    members = self.bench.group_members[self.group]
+                    stats.sent["group"] += sum(1 for member in members if member.joined) - 1
+                else:
+                    peer = self.bench.online_peer(self)
+                    if peer is None:
+                        continue
+                    self.send({
+                        "type": "message",
+                        "sender": self.username,
+                        "receiver": peer.username,
+                        "text": stats.message_sent("direct")
+                    })
+                await self.writer.drain()
+            except (ConnectionError, OSError):
+                self.online = False
+
+class Benchmark:
+    """One load run against one server"""
+    
+    def __init__(self, args, host, ports, pids):
+        self.args = args
+        self.host = host
+        self.ports = ports  # One per cluster node
+        self.pids = pids
+        self.features = SERVER_FEATURES[args.server]
+        self.prefix = f"bench{random.randrange(16 ** 4):04x}_"
+        self.stats = Stats()
+        self.clients = []
+        self.group_members = {}  # {group_name: [SimClient]}
+        self.workdir = None
+    
+    def online_peer(self, client, attempts=5):
+        """A random online client other than client (None if none found)"""
+        for _ in range(attempts):
+            peer = random.choice(self.clients)
+            if peer is not client and peer.online:
+                return peer
+        return None
+    
+    async def connect_all(self):
+        """Connect every client, a batch at a time"""
+        self.clients = [SimClient(self, i) for i in range(self.args.clients)]
+        size = SMALL_BACKLOG_BATCH if self.args.server in SMALL_BACKLOG_SERVERS else CONNECT_BATCH
+        connected = []
+        for start in range(0, len(self.clients), size):
+            batch = self.clients[start:start + size]
+            results = await asyncio.gather(*(client.connect() for client in batch))
+            connected += [client for client, ok in zip(batch, results) if ok]
+        self.stats.connect_failures = len(self.clients) - len(connected)
+        self.clients = connected
+    
+    async def setup_groups(self):
+        """The first clients create the groups, everyone else joins one"""
+        count = min(self.args.groups, len(self.clients))
+        names = [f"{self.prefix}g{i}" for i in range(count)]
+        
+        await asyncio.gather(*(self.clients[i].group_command(f"/create {name}") for i, name in enumerate(names)))
+        
+        joins = []
+        for i, client in enumerate(self.clients):
+            client.group = names[i % count]
+            self.group_members.setdefault(client.group, []).append(client)
+            if i >= count:
+                joins.append(client.group_command(f"/join {client.group}"))
+        for start in range(0, len(joins), CONNECT_BATCH):
+            await asyncio.gather(*joins[start:start + CONNECT_BATCH])
+    
+    async def send_files(self, deadline):
+        """Spread the file transfers evenly over the run"""
+        interval = self.args.duration / (self.args.files + 1)
+        for _ in range(self.args.files):
+            await asyncio.sleep(interval)
+            if time.perf_counter() >= deadline:
+                return
+            sender = self.online_peer(None)
+            receiver = sender and self.online_peer(sender)
+            if receiver is None:
+                continue
+            
+            # Random content: every transfer gets its own id and is really sent
+            path = os.path.join(self.workdir, f"file{self.stats.files_sent}.bin")
+            with open(path, 'wb') as f:
+                f.write(os.urandom(self.args.file_size))
+            outgoing = sender.files.offer(sender.username, receiver.username, path)
+            self.stats.file_started[outgoing.transfer_id] = time.perf_counter()
+            self.stats.files_sent += 1
+            sender.write(outgoing.offer())
+    
+    async def offline_round(self, start):
+        """Take clients offline, message them, bring them back to page through the backlog"""
+        await asyncio.sleep(start)
+        away = [client for client in self.clients if client.online][:self.args.offline]
+        await asyncio.gather(*(client.disconnect() for client in away))
+        await asyncio.sleep(0.5)  # Let the server notice the disconnects
+        
+        for client in away:
+            for _ in range(self.args.offline_messages):
+                sender = self.online_peer(client)
+                if sender is None:
+                    continue
+                sender.send({
+                    "type": "message",
+                    "sender": sender.username,
+                    "receiver": client.username,
+                    "text": self.stats.message_sent("offline")
+                })
+        
+        await asyncio.sleep(self.args.duration / 3)
+        await asyncio.gather(*(client.connect() for client in away))
+        await asyncio.gather(*(client.rejoin() for client in away if client.online and client.group),
+                             return_exceptions=True)
+    
+    async def sample_rss(self):
+        while True:
+            rss = total_rss(self.pids)
+            if rss is not None:
+                self.stats.rss.append(rss)
+            await asyncio.sleep(0.5)
+    
+    async def run(self):
+        args = self.args
+        sampler = asyncio.create_task(self.sample_rss())
+        
+        started = time.perf_counter()
+        await self.connect_all()
+        connect_time = time.perf_counter() - started
+        print(f"[BENCH] Connected {len(self.clients)}/{args.clients} client(s) in {connect_time:.2f} s")
+        if len(self.clients) < 2:
+            sampler.cancel()
+            return None
+        
+        if "group" in self.features and args.groups > 0:
+            try:
+                await self.setup_groups()
+                print(f"[BENCH] {len(self.group_members)} group(s) of ~{len(self.clients) // len(self.group_members)} member(s)")
+            except asyncio.TimeoutError:
+                print("[BENCH] Group setup timed out - sending direct messages only")
+                for client in self.clients:
+                    client.group = None
+        
+        print(f"[BENCH] Sending for {args.duration:.0f} s...")
+        started = time.perf_counter()
+        deadline = started + args.duration
+        tasks = [asyncio.create_task(client.traffic(deadline)) for client in self.clients]
+        if "file" in self.features and args.files > 0:
+            tasks.append(asyncio.create_task(self.send_files(deadline)))
+        if "offline" in self.features and args.offline > 0:
+            tasks.append(asyncio.create_task(self.offline_round(args.duration / 3)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+        
+        # Let in-flight messages arrive (counted, but not in the elapsed time)
+        await asyncio.sleep(args.drain)
+        
+        sampler.cancel()
+        rss_end = total_rss(self.pids)
+        await asyncio.gather(*(client.disconnect() for client in self.clients))
+        return elapsed, rss_end
+    
+    def report(self, elapsed, rss_end):
+        stats = self.stats
+        args = self.args
+        print("=" * 60)
+        nodes = f" ({args.nodes} nodes)" if args.nodes > 1 else ""
+        print(f"[BENCH] server_{args.server}{nodes}, {len(self.clients)} client(s), "
+              f"{args.duration:.0f} s at {args.rate:g} msg/s per client, {args.encoding}"
+              f"{', compressed' if args.compression else ''}")
+        
+        for kind in Stats.KINDS:
+            if not stats.sent[kind]:
+                continue
+            latencies = sorted(stats.latencies[kind])
+            p50, p99 = percentile(latencies, 50), percentile(latencies, 99)
+            line = (f"[BENCH] {kind:7} {stats.delivered[kind]}/{stats.sent[kind]} delivered, "
+                    f"{stats.delivered[kind] / elapsed:.0f} msg/s")
+            if latencies:
+                line += f", p50 {p50 * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms"
+            print(line)
+        
+        if stats.files_sent:
+            total_time = sum(stats.file_times) or 1
+            print(f"[BENCH] files   {stats.files_received}/{stats.files_sent} received, "
+                  f"{stats.file_bytes / 1024 / 1024:.1f} MB at {stats.file_bytes / total_time / 1024 / 1024:.1f} MB/s per transfer")
+        
+        print(f"[BENCH] wire    {stats.wire_bytes / 1024 / 1024:.1f} MB received by the clients")
+        
+        if stats.rss:
+            end = f"{rss_end / 1024 / 1024:.1f} MB at the end" if rss_end else "exited"
+            print(f"[BENCH] server RSS {max(stats.rss) / 1024 / 1024:.1f} MB peak, {end}")
+        else:
+            print("[BENCH] server RSS not available (use --pid, Linux only)")
+        
+        if stats.connect_failures:
+            print(f"[BENCH] {stats.connect_failures} client(s) could not connect")
+        print("=" * 60)
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="ClassChat load generator and benchmark")
+    parser.add_argument("--server", choices=sorted(SERVER_FEATURES), default="bonus3",
+                        help="Server to start (or the protocol of --connect's server; default bonus3)")
+    parser.add_argument("--server-args", default="",
+                        help="Extra options for server_bonus3, e.g. \"--mode reactor\"")
+    parser.add_argument("--connect", metavar="HOST:PORT",
+                        help="Use a server that is already running instead of starting one")
+    parser.add_argument("--pid", type=int, help="Process id of the --connect server, for RSS")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help=f"Port for the server this tool starts (default {DEFAULT_PORT})")
+    parser.add_argument("--nodes", type=int, default=1,
+                        help="Start a cluster of this many server_bonus3 nodes and a broker on --port "
+                             "(nodes on the next ports; default 1, no cluster)")
+    parser.add_argument("--clients", type=int, default=1000, help="Simulated clients (default 1000)")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of traffic (default 10)")
+    parser.add_argument("--rate", type=float, default=1.0, help="Messages per second per client (default 1)")
+    parser.add_argument("--groups", type=int, default=10, help="Groups the clients are spread over (default 10)")
+    parser.add_argument("--group-ratio", type=float, default=0.1,
+                        help="Share of messages sent to the client's @group (default 0.1)")
+    parser.add_argument("--files", type=int, default=10, help="Files streamed during the run (default 10)")
+    parser.add_argument("--file-size", type=int, default=256 * 1024, help="Bytes per file (default 256 KB)")
+    parser.add_argument("--offline", type=int, default=50,
+                        help="Clients that go offline for a third of the run (default 50)")
+    parser.add_argument("--offline-messages", type=int, default=5,
+                        help="Messages sent to each offline client (default 5)")
+    parser.add_argument("--drain", type=float, default=2.0,
+                        help="Seconds to wait for in-flight messages after the run (default 2)")
+    parser.add_argument("--encoding", choices=(JSON, BINARY), default=JSON,
+                        help="Message encoding the clients ask for (binary: server_bonus3 only; default json)")
+    parser.add_argument("--compression", action="store_true",
+                        help="Clients ask for compressed streams (server_bonus3 only)")
+    parser.add_argument("--server-log", help="Write the started server's output here (default: discard)")
+    args = parser.parse_args()
+    if args.nodes > 1 and (args.server != "bonus3" or args.connect):
+        parser.error("--nodes starts a server_bonus3 cluster (no --connect, --server bonus3)")
+    if (args.encoding == BINARY or args.compression) and args.server != "bonus3":
+        parser.error("--encoding binary and --compression need --server bonus3")
+    return args
+
+def start_cluster(args, workdir, log):
+    """Start a broker on args.port and args.nodes nodes after it; returns (ports, processes)"""
+    processes = [start_broker(args.port, log)]
+    if not wait_for_port("127.0.0.1", args.port, processes[0]):
+        return None, processes
+    
+    ports = [args.port + 1 + i for i in range(args.nodes)]
+    for i, port in enumerate(ports):
+        # Every node keeps its own offline queue and spool
+        node_dir = os.path.join(workdir, f"node{i}")
+        os.makedirs(node_dir)
+        cluster_args = ["--cluster", f"tcp://127.0.0.1:{args.port}", "--node", f"node{i}"]
+        processes.append(start_server("bonus3", port, cluster_args + shlex.split(args.server_args), node_dir, log))
+    for port, process in zip(ports, processes[1:]):
+        if not wait_for_port("127.0.0.1", port, process):
+            return None, processes
+    return ports, processes
+
+def main():
+    """Main entry point"""
+    args = parse_args()
+    raise_file_limit()
+    
+    processes = []
+    log = None
+    workdir = tempfile.TemporaryDirectory(prefix="classchat-bench-")
+    try:
+        if args.connect:
+            host, _, port = args.connect.rpartition(":")
+            host, ports, pids = host or "127.0.0.1", [int(port)], [args.pid] if args.pid else []
+        elif args.nodes > 1:
+            host = "127.0.0.1"
+            log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+            ports, processes = start_cluster(args, workdir.name, log)
+            if ports is None:
+                print(f"[BENCH] The cluster did not start (broker on port {args.port})")
+                return 1
+            pids = [process.pid for process in processes]
+            print(f"[BENCH] Started a broker on port {args.port} and {args.nodes} node(s) "
+                  f"on ports {ports[0]}-{ports[-1]}")
+        else:
+            host, port = "127.0.0.1", args.port
+            log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+            process = start_server(args.server, port, shlex.split(args.server_args), workdir.name, log)
+            processes = [process]
+            ports, pids = [port], [process.pid]
+            if not wait_for_port(host, port, process):
+                print(f"[BENCH] server_{args.server} did not start on port {port}")
+                return 1
+            print(f"[BENCH] Started server_{args.server} (pid {process.pid}) on port {port}")
+        
+        bench = Benchmark(args, host, ports, pids)
+        bench.workdir = workdir.name
+        result = asyncio.run(bench.run())
+        if result is None:
+            print("[BENCH] Not enough clients connected")
+            return 1
+        bench.report(*result)
+        return 0
+    except KeyboardInterrupt:
+        print("\n[BENCH] Interrupted")
+        return 1
+    finally:
+        # Nodes first, the broker last
+        for process in reversed(processes):
+            stop_server(process)
+        if log not in (None, subprocess.DEVNULL):
+            log.close()
+        workdir.cleanup()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+ClassChat Metrics
+Latency histograms, lock wait times and queue gauges for the server.
+
+The server's only observability used to be its [DIRECT] / [GROUP] print
+lines. Now every chat message is timed through four stages, per kind of
+message (direct, group, file, offline):
+
+    parse    frame received (recv) -> JSON decoded
+    route    decoded -> recipients looked up
+    fan_out  recipients known -> frames queued (or stored offline)
+    send     frame queued -> written to the recipient's socket
+
+Each (stage, kind) pair has an HDR-style histogram: log-linear buckets
+that keep two significant digits from a microsecond to an hour in a
+fixed list of counters, so recording is O(1) and percentiles never need
+the raw samples. Locks created with timed_lock() report how often they
+were contended and how long threads waited, and gauges sample queue
+depths whenever a snapshot is taken.
+
+    metrics = Metrics()
+    trace = metrics.trace(connection.received_at)
+    message = json.loads(data)
+    trace.mark("parse")
+    ...
+    trace.mark("route")
+    trace.finish("direct")          # records both stages under "direct"
+
+Snapshots go to clients asking with /stats, to the periodic dump file
+and to the shutdown summary.
+"""
+
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+# Message stages and kinds
+STAGES = ("parse", "route", "fan_out", "send")
+KINDS = ("direct", "group", "file", "offline")
+
+# Seconds between dumps to the metrics file
+DEFAULT_DUMP_INTERVAL = 60
+
+# Histogram resolution: values below 2^SUB_BITS microseconds are exact,
+# larger ones fall in buckets 1/64 of their power of two wide (< 1.6% error)
+SUB_BITS = 7
+SUB_BUCKETS = 1 << SUB_BITS
+HALF_BUCKETS = SUB_BUCKETS // 2
+
+# Largest value tracked (one hour); longer ones count as one hour
+MAX_MICROSECONDS = 3600 * 1000000
+
+def bucket_index(value):
+    """Bucket for a value in microseconds"""
+    shift = value.bit_length() - SUB_BITS
+    if shift <= 0:
+        return value
+    return SUB_BUCKETS + (shift - 1) * HALF_BUCKETS + (value >> shift) - HALF_BUCKETS
+
+def bucket_limit(index):
+    """Largest value (microseconds) that falls in a bucket"""
+    if index < SUB_BUCKETS:
+        return index
+    shift, sub = divmod(index - SUB_BUCKETS, HALF_BUCKETS)
+    return ((sub + HALF_BUCKETS + 1) << (shift + 1)) - 1
+
+BUCKET_COUNT = bucket_index(MAX_MICROSECONDS) + 1
+
+class Histogram:
+    """Log-linear latency histogram (HDR style) in microseconds"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0  # Sum of recorded microseconds, for the mean
+        self.min = None
+        self.max = 0
+    
+    def record(self, seconds):
+        value = min(max(int(seconds * 1000000), 0), MAX_MICROSECONDS)
+        index = bucket_index(value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+    
+    def summary(self):
+        """Count, mean and percentiles in milliseconds"""
+        with self.lock:
+            counts = list(self.counts)
+            count, total, low, high = self.count, self.total, self.min, self.max
+        
+        summary = {"count": count}
+        if not count:
+            return summary
+        
+        # Walk the buckets once for every percentile (in ascending order)
+        targets = [("p50", 0.50), ("p90", 0.90), ("p99", 0.99), ("p999", 0.999)]
+        seen = 0
+        for index, bucket in enumerate(counts):
+            seen += bucket
+            while targets and seen >= targets[0][1] * count:
+                name, _ = targets.pop(0)
+                summary[name] = min(bucket_limit(index), high) / 1000
+            if not targets:
+                break
+        
+        summary["mean"] = round(total / count / 1000, 3)
+        summary["min"] = low / 1000
+        summary["max"] = high / 1000
+        return summary
+
+class TimedLock:
+    """threading.Lock that records how long contended acquires waited"""
+    
+    def __init__(self, waits):
+        self.lock = threading.Lock()
+        self.waits = waits  # Histogram shared by every lock with the same name
+        self.acquired = 0   # Updated while holding the lock
+        self.contended = 0
+    
+    def acquire(self, blocking=True, timeout=-1):
+        # Fast path: free locks cost one extra attribute update
+        if self.lock.acquire(False):
+            self.acquired += 1
+            return True
+        if not blocking:
+            return False
+        
+        started = time.perf_counter()
+        if not self.lock.acquire(True, timeout):
+            return False
+        self.waits.record(time.perf_counter() - started)
+        self.acquired += 1
+        self.contended += 1
+        return True
+    
+    def release(self):
+        self.lock.release()
+    
+    def locked(self):
+        return self.lock.locked()
+    
+    def _is_owned(self):
+        # threading.Condition probes ownership with acquire(False) unless
+        # the lock has this; probing the inner lock keeps it out of the counts
+        if self.lock.acquire(False):
+            self.lock.release()
+            return False
+        return True
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+class Trace:
+    """Stage times of one message, recorded once its kind is known"""
+    
+    __slots__ = ("metrics", "last", "stages")
+    
+    def __init__(self, metrics, started=None):
+        self.metrics = metrics
+        self.last = started or time.perf_counter()
+        self.stages = []
+    
+    def mark(self, stage):
+        """End a stage now (it started where the previous one ended)"""
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+    
+    def finish(self, kind):
+        """Record the marked stages for a kind of message"""
+        for stage, seconds in self.stages:
+            self.metrics.record(stage, kind, seconds)
+        self.stages = []
+
+class Metrics:
+    """Histograms, counters, lock statistics and gauges of one server"""
+    
+    def __init__(self):
+        self.started = time.time()
+        self.latency = {(stage, kind): Histogram() for kind in KINDS for stage in STAGES}
+        
+        self.lock = threading.Lock()
+        self.counters = {}     # {name: count}
+        self.gauges = {}       # {name: function returning a number or a dict}
+        self.lock_waits = {}   # {lock name: Histogram}
+        self.locks = {}        # {lock name: [TimedLock]}
+    
+    def trace(self, started=None):
+        """Start timing a message received at started (perf_counter; None = now)"""
+        return Trace(self, started)
+    
+    def record(self, stage, kind, seconds):
+        self.latency[(stage, kind)].record(seconds)
+    
+    def record_sent(self, stamps):
+        """Send latency of frames just written: stamps is [(queued_at, kind)]"""
+        now = time.perf_counter()
+        for queued_at, kind in stamps:
+            if kind:
+                self.latency[("send", kind)].record(now - queued_at)
+    
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+    
+    def gauge(self, name, function):
+        """Sample function() in every snapshot"""
+        self.gauges[name] = function
+    
+    def timed_lock(self, name):
+        """A new lock whose waits are reported under name (shards share one name)"""
+        with self.lock:
+            if name not in self.lock_waits:
+                self.lock_waits[name] = Histogram()
+                self.locks[name] = []
+            lock = TimedLock(self.lock_waits[name])
+            self.locks[name].append(lock)
+        return lock
+    
+    def snapshot(self):
+        """Everything measured so far, as a JSON-ready dict"""
+        latency = {}
+        for (stage, kind), histogram in self.latency.items():
+            summary = histogram.summary()
+            if summary["count"]:
+                latency.setdefault(kind, {})[stage] = summary
+        
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            locks = {name: list(members) for name, members in self.locks.items()}
+        
+        lock_stats = {}
+        for name, members in locks.items():
+            lock_stats[name] = {
+                "acquired": sum(lock.acquired for lock in members),
+                "contended": sum(lock.contended for lock in members),
+                "wait": self.lock_waits[name].summary()
+            }
+        
+        sampled = {}
+        for name, function in gauges.items():
+            try:
+                sampled[name] = function()
+            except Exception as e:
+                sampled[name] = f"error: {e}"
+        
+        return {
+            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "uptime": round(time.time() - self.started, 1),
+            "latency": latency,
+            "locks": lock_stats,
+            "counters": counters,
+            "gauges": sampled
+        }
+    
+    def dump(self, path):
+        """Write a snapshot to path (replaced atomically)"""
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(temp_path, path)
+    
+    def start_dump(self, path, interval=DEFAULT_DUMP_INTERVAL):
+        """Dump a snapshot to path every interval seconds (background thread)"""
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(path)
+                except OSError as e:
+                    print(f"[METRICS] Could not write {path}: {e}")
+        
+        threading.Thread(target=dump_loop, daemon=True).start()
+
+def format_stats(snapshot):
+    """Text lines for a snapshot (server shutdown and the /stats reply)"""
+    lines = [f"Uptime {snapshot.get('uptime', 0)} s, latency in ms:"]
+    lines.append(f"  {'kind':<8} {'stage':<8} {'count':>8} {'p50':>9} {'p99':>9} {'p99.9':>9} {'max':>9}")
+    for kind, stages in snapshot.get("latency", {}).items():
+        for stage in STAGES:
+            summary = stages.get(stage)
+            if summary:
+                lines.append(f"  {kind:<8} {stage:<8} {summary['count']:>8} {summary['p50']:>9.3f} "
+                             f"{summary['p99']:>9.3f} {summary['p999']:>9.3f} {summary['max']:>9.3f}")
+    
+    for name, stats in snapshot.get("locks", {}).items():
+        wait = stats["wait"]
+        line = f"  lock {name}: {stats['acquired']} acquired, {stats['contended']} contended"
+        if wait["count"]:
+            line += f", wait p50 {wait['p50']:.3f} ms, p99 {wait['p99']:.3f} ms, max {wait['max']:.3f} ms"
+        lines.append(line)
+    
+    for name, value in list(snapshot.get("counters", {}).items()) + list(snapshot.get("gauges", {}).items()):
+        if isinstance(value, dict):
+            value = ", ".join(f"{key} {item}" for key, item in value.items())
+        lines.append(f"  {name}: {value}")
+    return lines
@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+"""
+ClassChat Offline Store
+Durable per-recipient queue of messages for offline users.
+
+The offline queue used to be a dict in the server process: a restart (or
+a crash) lost every queued message and file reference. Now it is kept in
+an SQLite database in WAL mode:
+
+    messages(id, recipient, body, blob, size, created, delivered)
+
+- Storing a message is one appended row; the write-ahead log makes that
+  a sequential write. With synchronous=FULL every commit syncs the log,
+  so a message reported as queued survives a crash or a power loss.
+  Messages queued together (a group file for every offline member, a
+  requeue) are one transaction and share one fsync.
+- Each recipient's undelivered rows are found through a partial index on
+  (recipient, id), so logging in reads only that user's messages, in order.
+- Rows are read a page at a time, oldest or newest first from a cursor
+  (a message id), and marked delivered only when the client
+  acknowledges them, so a connection that drops mid-drain gets
+  the rest (at least once) on its next login. A background thread
+  deletes delivered rows in small batches and truncates the log, so the
+  database does not grow with every message ever sent.
+- On startup nothing needs replaying: the database is opened and the
+  undelivered rows are the queue. Rows for stored files carry the file's
+  checksum (blob), so the file store can rebuild its reference counts.
+
+The queue is bounded. Each recipient and the whole store have a quota by
+message count and by bytes (a file counts with its size), and messages
+older than the TTL expire. When a quota is exceeded, messages are
+evicted oldest first; the files_first policy drops stored files (oldest
+first) before any text message. The usage of each recipient and of the
+whole store is counted as messages are queued, acknowledged and removed,
+so an append checks its quotas without a query. A recipient over quota
+is trimmed to the limit; the store is trimmed to LOW_WATER of it, so the
+next append does not go over again at once. A background sweeper expires
+old messages and recounts the usage from the table. Evicted and expired
+files are handed to on_evict(blobs) so the file store can drop them.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+# Default database location (relative to the server's working directory)
+DEFAULT_DB_PATH = "offline.db"
+
+# Seconds between background sweeps (expiry, quotas, compaction)
+SWEEP_INTERVAL = 30.0
+
+# Default quotas (0 = unlimited) and message lifetime (seconds)
+DEFAULT_USER_MESSAGES = 1000
+DEFAULT_USER_BYTES = 100 * 1024 * 1024
+DEFAULT_TOTAL_MESSAGES = 1000000
+DEFAULT_TOTAL_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_TTL = 14 * 24 * 3600
+
+# Eviction policies: oldest messages first, or stored files before text
+EVICT_OLDEST = "oldest"
+EVICT_FILES_FIRST = "files_first"
+EVICTION_POLICIES = (EVICT_OLDEST, EVICT_FILES_FIRST)
+
+# Share of the store quotas left after evicting for them
+LOW_WATER = 0.9
+
+# Delivered rows deleted per transaction while compacting
+COMPACT_BATCH = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    body      TEXT NOT NULL,
+    blob      TEXT,
+    size      INTEGER NOT NULL DEFAULT 0,
+    created   REAL NOT NULL,
+    delivered INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS pending_by_recipient
+    ON messages (recipient, id) WHERE delivered = 0;
+CREATE INDEX IF NOT EXISTS delivered_rows
+    ON messages (id) WHERE delivered = 1;
+CREATE INDEX IF NOT EXISTS pending_by_created
+    ON messages (created) WHERE delivered = 0;
+CREATE INDEX IF NOT EXISTS pending_files
+    ON messages (id) WHERE delivered = 0 AND blob IS NOT NULL;
+"""
+
+def over_quota(usage, max_messages, max_bytes):
+    """True if [messages, bytes] is above either limit (0 = unlimited)"""
+    return bool((max_messages and usage[0] > max_messages) or
+                (max_bytes and usage[1] > max_bytes))
+
+class OfflineStore:
+    """SQLite-backed offline queue; safe to use from any thread"""
+    
+    def __init__(self, path=DEFAULT_DB_PATH,
+                 user_messages=DEFAULT_USER_MESSAGES, user_bytes=DEFAULT_USER_BYTES,
+                 total_messages=DEFAULT_TOTAL_MESSAGES, total_bytes=DEFAULT_TOTAL_BYTES,
+                 ttl=DEFAULT_TTL, eviction=EVICT_FILES_FIRST, on_evict=None,
+                 interval=SWEEP_INTERVAL):
+        self.path = path
+        self.lock = threading.Lock()
+        
+        # One shared connection; autocommit mode, transactions are explicit
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.executescript(SCHEMA)
+        self.closed = False
+        
+        # Databases from before quotas have no size column
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(messages)")]
+        if "size" not in columns:
+            self.db.execute("ALTER TABLE messages ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+            self.db.execute("UPDATE messages SET size = length(body)")
+        
+        # Limits
+        self.user_messages = user_messages
+        self.user_bytes = user_bytes
+        self.total_messages = total_messages
+        self.total_bytes = total_bytes
+        self.ttl = ttl
+        self.eviction = eviction
+        self.on_evict = on_evict
+        
+        # Usage of undelivered messages, kept up to date (and recounted by each sweep)
+        self.usage = {}          # {recipient: [messages, bytes]}
+        self.total = [0, 0]
+        self.refresh_usage()
+        
+        # Metrics
+        self.compacted = 0       # Delivered rows removed
+        self.expired = 0         # Messages dropped by the TTL
+        self.evicted = 0         # Messages dropped by a quota
+        self.evicted_bytes = 0
+        
+        self.interval = interval
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    def append(self, recipient, message):
+        """
+        Queue one message (a dict) for recipient; returns its id, or None if
+        the message alone is larger than a byte quota (it would only evict
+        everything else and then itself).
+        """
+        return self.append_many([(recipient, message)])[0]
+    
+    def append_many(self, entries):
+        """
+        Queue [(recipient, message)] in one transaction (one fsync);
+        returns their ids, None for each message refused like append's.
+        """
+        if not entries:
+            return []
+        rows = []
+        for recipient, message in entries:
+            body = json.dumps(message)
+            blob = message.get("blob")
+            size = len(body) + ((message.get("filesize") or 0) if blob else 0)
+            if (self.user_bytes and size > self.user_bytes) or (self.total_bytes and size > self.total_bytes):
+                rows.append(None)
+            else:
+                rows.append((recipient, body, blob, size))
+        
+        ids = []
+        evicted = []
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for row in rows:
+                    if row is None:
+                        ids.append(None)
+                        continue
+                    recipient, body, blob, size = row
+                    cursor = self.db.execute(
+                        "INSERT INTO messages (recipient, body, blob, size, created) VALUES (?, ?, ?, ?, ?)",
+                        (recipient, body, blob, size, time.time())
+                    )
+                    ids.append(cursor.lastrowid)
+                    
+                    usage = self.usage.setdefault(recipient, [0, 0])
+                    usage[0] += 1
+                    usage[1] += size
+                    self.total[0] += 1
+                    self.total[1] += size
+                    
+                    # Over a quota: evict
+                    if over_quota(usage, self.user_messages, self.user_bytes):
+                        evicted += self.enforce_user_quota(recipient)
+                    if over_quota(self.total, self.total_messages, self.total_bytes):
+                        evicted += self.enforce_total_quota()
+                self.db.execute("COMMIT")
+            except sqlite3.Error:
+                self.db.execute("ROLLBACK")
+                self.refresh_usage()
+                raise
+        
+        self.release(evicted)
+        return ids
+    
+    def page(self, recipient, cursor, older=False, limit=100):
+        """
+        Up to limit undelivered messages for recipient next to cursor: the
+        newest ones below it (older=True) or the oldest ones above it.
+        Returns [(id, body, blob)] nearest the cursor first; body is the JSON text.
+        """
+        if older:
+            query = ("SELECT id, body, blob FROM messages "
+                     "WHERE recipient = ? AND delivered = 0 AND id < ? ORDER BY id DESC LIMIT ?")
+        else:
+            query = ("SELECT id, body, blob FROM messages "
+                     "WHERE recipient = ? AND delivered = 0 AND id > ? ORDER BY id LIMIT ?")
+        with self.lock:
+            return self.db.execute(query, (recipient, cursor, limit)).fetchall()
+    
+    def acknowledge(self, entry_ids):
+        """
+        Mark messages delivered (the client has them).
+        Returns how many were still queued (not expired or evicted meanwhile).
+        """
+        if not entry_ids:
+            return 0
+        with self.lock:
+            self.db.execute("BEGIN")
+            rows = []
+            for entry_id in entry_ids:
+                row = self.db.execute(
+                    "SELECT recipient, size FROM messages WHERE id = ? AND delivered = 0", (entry_id,)
+                ).fetchone()
+                if row:
+                    self.db.execute("UPDATE messages SET delivered = 1 WHERE id = ?", (entry_id,))
+                    rows.append(row)
+            self.db.execute("COMMIT")
+            
+            # Delivered messages no longer count against the quotas
+            for recipient, size in rows:
+                self.release_usage(recipient, size)
+        return len(rows)
+    
+    def count(self, recipient=None, above=0, below=None):
+        """Undelivered messages for one recipient (or everyone), optionally between two ids"""
+        query = "SELECT COUNT(*) FROM messages WHERE delivered = 0 AND id > ?"
+        params = [above]
+        if recipient is not None:
+            query += " AND recipient = ?"
+            params.append(recipient)
+        if below is not None:
+            query += " AND id < ?"
+            params.append(below)
+        with self.lock:
+            return self.db.execute(query, params).fetchone()[0]
+    
+    def newest_id(self, recipient):
+        """Id of recipient's newest undelivered message (0 if none)"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT MAX(id) FROM messages WHERE recipient = ? AND delivered = 0",
+                (recipient,)
+            ).fetchone()
+        return row[0] or 0
+    
+    def blob_references(self):
+        """{checksum: undelivered references} for rebuilding file store counts"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT blob, COUNT(*) FROM messages WHERE delivered = 0 AND blob IS NOT NULL GROUP BY blob"
+            ).fetchall()
+        return dict(rows)
+    
+    def summary(self):
+        """(recipients, messages) still queued, for the startup log"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT COUNT(DISTINCT recipient), COUNT(*) FROM messages WHERE delivered = 0"
+            ).fetchone()
+        return row[0], row[1]
+    
+    def refresh_usage(self):
+        """Recompute exact queue usage per recipient (caller holds the lock or is __init__)"""
+        rows = self.db.execute(
+            "SELECT recipient, COUNT(*), COALESCE(SUM(size), 0) FROM messages "
+            "WHERE delivered = 0 GROUP BY recipient"
+        ).fetchall()
+        self.usage = {recipient: [messages, size] for recipient, messages, size in rows}
+        self.total = [sum(row[1] for row in rows), sum(row[2] for row in rows)]
+    
+    def release_usage(self, recipient, size):
+        """Stop counting one message of recipient (caller holds the lock)"""
+        usage = self.usage.get(recipient)
+        if usage:
+            usage[0] -= 1
+            usage[1] -= size
+            if usage[0] <= 0:
+                del self.usage[recipient]
+        self.total[0] -= 1
+        self.total[1] -= size
+    
+    def enforce_user_quota(self, recipient):
+        """Evict recipient's messages beyond its quota (caller holds the lock); returns blobs"""
+        messages, size = self.usage[recipient]
+        return self.evict("recipient = ?", (recipient,),
+                          messages - self.user_messages if self.user_messages else 0,
+                          size - self.user_bytes if self.user_bytes else 0)
+    
+    def enforce_total_quota(self):
+        """Evict messages down to LOW_WATER of the store's quota (caller holds the lock); returns blobs"""
+        return self.evict("1", (),
+                          self.total[0] - int(self.total_messages * LOW_WATER) if self.total_messages else 0,
+                          self.total[1] - int(self.total_bytes * LOW_WATER) if self.total_bytes else 0)
+    
+    def evict(self, where, params, excess_messages, excess_bytes):
+        """
+        Delete queued messages matching where, in eviction policy order,
+        until both excesses are covered (caller holds the lock).
+        Returns the blobs of evicted files.
+        """
+        if excess_messages <= 0 and excess_bytes <= 0:
+            return []
+        
+        # One pass per class of message, each an index walk that stops once
+        # the excess is covered (sorting on "blob IS NULL" would read them all)
+        passes = ["delivered = 0"]
+        if self.eviction == EVICT_FILES_FIRST:
+            passes.insert(0, "delivered = 0 AND blob IS NOT NULL")
+        victims = []
+        chosen = set()
+        for condition in passes:
+            rows = self.db.execute(
+                f"SELECT id, recipient, size, blob FROM messages WHERE {condition} AND {where} ORDER BY id",
+                params
+            )
+            for row in rows:
+                if excess_messages <= 0 and excess_bytes <= 0:
+                    break
+                if row[0] in chosen:
+                    continue
+                chosen.add(row[0])
+                victims.append(row)
+                excess_messages -= 1
+                excess_bytes -= row[2]
+            rows.close()
+        
+        self.remove(victims)
+        self.evicted += len(victims)
+        self.evicted_bytes += sum(row[2] for row in victims)
+        return [row[3] for row in victims if row[3]]
+    
+    def expire(self):
+        """Delete messages older than the TTL; returns the blobs of expired files"""
+        if not self.ttl:
+            return []
+        with self.lock:
+            victims = self.db.execute(
+                "SELECT id, recipient, size, blob FROM messages WHERE delivered = 0 AND created < ?",
+                (time.time() - self.ttl,)
+            ).fetchall()
+            self.remove(victims)
+            self.expired += len(victims)
+        return [row[3] for row in victims if row[3]]
+    
+    def remove(self, victims):
+        """Delete (id, recipient, size, blob) rows and update usage (caller holds the lock)"""
+        if not victims:
+            return
+        # Part of the caller's transaction if it has one (an append that evicts)
+        own_transaction = not self.db.in_transaction
+        if own_transaction:
+            self.db.execute("BEGIN")
+        self.db.executemany("DELETE FROM messages WHERE id = ?", [(row[0],) for row in victims])
+        if own_transaction:
+            self.db.execute("COMMIT")
+        
+        for _, recipient, size, _ in victims:
+            self.release_usage(recipient, size)
+    
+    def release(self, blobs):
+        """Hand evicted or expired files to the owner of the file store"""
+        if blobs and self.on_evict:
+            self.on_evict(blobs)
+    
+    def sweep(self):
+        """Expire old messages and enforce quotas on exact usage; returns (expired, evicted)"""
+        expired, evicted = self.expired, self.evicted
+        blobs = self.expire()
+        
+        with self.lock:
+            self.refresh_usage()
+            for recipient, usage in list(self.usage.items()):
+                if over_quota(usage, self.user_messages, self.user_bytes):
+                    blobs += self.enforce_user_quota(recipient)
+            if over_quota(self.total, self.total_messages, self.total_bytes):
+                blobs += self.enforce_total_quota()
+        
+        self.release(blobs)
+        return self.expired - expired, self.evicted - evicted
+    
+    def compact(self):
+        """Delete delivered rows in small batches; returns the count"""
+        removed = 0
+        while True:
+            # Short transactions: senders are never blocked for long
+            with self.lock:
+                cursor = self.db.execute(
+                    "DELETE FROM messages WHERE id IN "
+                    "(SELECT id FROM messages WHERE delivered = 1 LIMIT ?)",
+                    (COMPACT_BATCH,)
+                )
+            removed += cursor.rowcount
+            if cursor.rowcount < COMPACT_BATCH:
+                break
+        
+        if removed:
+            with self.lock:
+                # Fold the log back into the database file and shrink it
+                self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.compacted += removed
+        return removed
+    
+    def run(self):
+        """Sweeper: expiry, quotas and compaction in the background"""
+        while not self.closed:
+            time.sleep(self.interval)
+            if self.closed:
+                return
+            try:
+                expired, evicted = self.sweep()
+                if expired or evicted:
+                    print(f"[OFFLINE] Expired {expired} and evicted {evicted} queued message(s)")
+                
+                removed = self.compact()
+                if removed:
+                    print(f"[OFFLINE] Compacted {removed} delivered message(s)")
+            except sqlite3.Error as e:
+                print(f"[ERROR] Offline store sweep failed: {e}")
+    
+    def stats(self):
+        """Counters for monitoring"""
+        with self.lock:
+            messages, size = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM messages WHERE delivered = 0"
+            ).fetchone()
+            return {
+                "queued": messages,
+                "queued_bytes": size,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "evicted_bytes": self.evicted_bytes,
+                "compacted": self.compacted
+            }
+    
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.db.close()
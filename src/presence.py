@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+ClassChat Presence Protocol
+Incremental online-user updates instead of full user-list broadcasts.
+
+Server -> client messages:
+    {"status": "user_list",   "users": [...], "version": N}  - full snapshot
+    {"status": "user_joined", "user": "Bob",  "version": N}  - delta
+    {"status": "user_left",   "user": "Bob",  "version": N}  - delta
+    {"status": "presence_update", "joined": [...], "left": [...],
+     "version": N}                                           - coalesced delta
+
+Every published update bumps the server's presence version by one. A
+client applies deltas in version order; if it sees a gap (a delta was
+dropped) it asks for a fresh snapshot with the /users command.
+
+When hundreds of students log in at the start of a lecture, the server
+collects joins and leaves for a short window (PresenceAggregator) and
+sends a single presence_update per client per window instead of one
+delta per event. Updates carry each user's final state in the window,
+so applying one twice, or on top of a newer snapshot, is harmless.
+"""
+
+import threading
+import time
+
+# Command a client sends to request a full snapshot
+SNAPSHOT_COMMAND = "/users"
+
+# Default coalescing window for join/leave events (seconds)
+DEFAULT_WINDOW = 0.2
+
+# Above this many changes clients print a summary instead of one line each
+SUMMARY_THRESHOLD = 5
+
+def describe_changes(joined, left):
+    """Human readable lines for a set of joins and leaves"""
+    lines = []
+    for users, verb in ((joined, "joined"), (left, "left")):
+        if len(users) > SUMMARY_THRESHOLD:
+            lines.append(f"{len(users)} users have {verb} the chat")
+        else:
+            lines.extend(f"{user} has {verb} the chat" for user in sorted(users))
+    return lines
+
+class PresenceAggregator:
+    """
+    Server-side batching of join/leave events.
+    
+    add() is called with the registry lock held. A background thread
+    waits for the first event, lets the window elapse, then (holding
+    the same lock) hands the net changes to publish(joined, left) so
+    batches and snapshots are queued in version order.
+    """
+    
+    def __init__(self, lock, window, publish):
+        self.ready = threading.Condition(lock)
+        self.window = window
+        self.publish = publish
+        self.pending = {}  # {username: "user_joined" | "user_left"} (last event wins)
+        self.pending_events = 0
+        
+        # Metrics
+        self.events = 0     # Join/leave events received
+        self.updates = 0    # Combined updates published
+        self.coalesced = 0  # Events folded into another event's update
+        
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    def add(self, status, username):
+        """Record a join or leave (caller holds the registry lock)"""
+        self.pending[username] = status
+        self.pending_events += 1
+        self.events += 1
+        self.ready.notify()
+    
+    def run(self):
+        """Flush one combined update per window while events arrive"""
+        while True:
+            with self.ready:
+                while not self.pending:
+                    self.ready.wait()
+            
+            # Let the rest of the burst arrive
+            time.sleep(self.window)
+            
+            with self.ready:
+                self.flush()
+    
+    def flush(self):
+        """Publish pending changes as one update (caller holds the lock)"""
+        if not self.pending:
+            return
+        
+        joined = [user for user, status in self.pending.items() if status == "user_joined"]
+        left = [user for user, status in self.pending.items() if status == "user_left"]
+        self.coalesced += self.pending_events - 1
+        self.updates += 1
+        
+        if self.pending_events > 1:
+            print(f"[PRESENCE] {self.pending_events} join/leave event(s) sent as one update")
+        
+        self.pending = {}
+        self.pending_events = 0
+        self.publish(joined, left)
+    
+    def stats(self):
+        """Counters for the server's status output"""
+        return {
+            "events": self.events,
+            "updates": self.updates,
+            "coalesced": self.coalesced
+        }
+
+class PresenceTracker:
+    """Client-side set of online users kept current from presence messages"""
+    
+    def __init__(self):
+        self.users = set()
+        self.version = None  # No snapshot received yet
+    
+    def apply(self, message):
+        """
+        Apply a user_list / user_joined / user_left / presence_update message.
+        Returns (joined, left, needs_snapshot): the users that changed and
+        whether the client should request a new snapshot.
+        """
+        status = message.get("status")
+        version = message.get("version")
+        
+        if status == "user_list":
+            users = set(message.get("users", []))
+            joined = users - self.users
+            left = self.users - users
+            self.users = users
+            self.version = version
+            return joined, left, False
+        
+        if self.version is None or version is None:
+            # Deltas before the first snapshot are covered by that snapshot
+            return set(), set(), False
+        
+        if version <= self.version:
+            return set(), set(), False  # Already reflected
+        
+        needs_snapshot = version != self.version + 1
+        self.version = version
+        
+        if status == "presence_update":
+            joined = set(message.get("joined", [])) - self.users
+            left = set(message.get("left", [])) & self.users
+            self.users |= joined
+            self.users -= left
+            return joined, left, needs_snapshot
+        
+        user = message.get("user")
+        
+        if status == "user_joined" and user not in self.users:
+            self.users.add(user)
+            return {user}, set(), needs_snapshot
+        
+        if status == "user_left" and user in self.users:
+            self.users.discard(user)
+            return set(), {user}, needs_snapshot
+        
+        return set(), set(), needs_snapshot
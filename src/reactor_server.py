@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+ClassChat Reactor Server Engine
+Non-blocking selectors (epoll on Linux) transport for the ClassChat chat logic.
+
+This is the select() idea from client_advanced.py applied to the server:
+one thread waits on every socket at once and only touches the ones that
+are ready. Each connection keeps a read buffer (FrameDecoder) and an
+outbound queue; queued frames are written optimistically and whatever
+the kernel does not accept is flushed when the socket reports it is
+writable, so a slow client never blocks the loop. Thread count stays
+constant no matter how many students are connected. A client relaying a
+file to a slow receiver is simply not read from until the receiver's
+queue drains.
+
+The engine calls the same three hooks as async_server.py:
+    on_connect(connection)
+    on_frame(connection, payload)   - return False to close the connection
+                                      (or hand it off, see connection.py)
+    on_disconnect(connection)
+
+on_start(adopt) is called once the loop runs; adopt(sock, address,
+preload) takes over a socket accepted by another worker, replaying the
+bytes that worker had already read.
+
+All hooks run on the loop thread, offline-store queries and spool writes
+included, so a slow disk stalls every connection (async_server.py moves
+those to I/O threads instead).
+"""
+
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from connection import Connection, FileRegion, OutboundQueue, WRITE_BATCH_BYTES
+from framing import FrameDecoder, RECV_BUFFER_SIZE
+
+class ReactorConnection(Connection):
+    """Connection with a non-blocking socket, outbound queue and write buffer"""
+    
+    def __init__(self, reactor, sock, address):
+        super().__init__(address)
+        self.reactor = reactor
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.write_pieces = deque()  # Bytes and file regions taken from the queue, the first partly sent
+        self.write_stamps = []  # Metrics stamps of the frames in write_pieces
+        self.reading = True
+        self.watching_write = False
+        self.events = selectors.EVENT_READ  # Interest currently registered
+        self.relay_waiters = []  # Senders paused until this queue drains
+        self.closed = False
+    
+    def wake_writer(self):
+        """Flush now if on the reactor thread, otherwise schedule a flush"""
+        self.reactor.want_write(self)
+    
+    def abort(self):
+        """Drop the connection immediately"""
+        with self.outbound_lock:
+            self.closing = True
+            self.outbound = OutboundQueue()
+        self.reactor.call_soon(self.reactor._close, self)
+
+class Reactor:
+    """Single-threaded selectors event loop"""
+    
+    def __init__(self, on_connect, on_frame, on_disconnect):
+        self.on_connect = on_connect
+        self.on_frame = on_frame
+        self.on_disconnect = on_disconnect
+        self.selector = selectors.DefaultSelector()
+        self.loop_thread = None
+        
+        # Other threads hand work to the loop through this queue + wakeup socket
+        self.pending = deque()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, "wakeup")
+    
+    def in_loop(self):
+        """True when called from the reactor thread"""
+        return threading.get_ident() == self.loop_thread
+    
+    def call_soon(self, callback, *args):
+        """Run callback on the reactor thread"""
+        self.pending.append((callback, args))
+        try:
+            self.wakeup_send.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # Loop is already awake (or shutting down)
+    
+    def want_write(self, connection):
+        """Start watching a connection for write readiness"""
+        if self.in_loop():
+            self._flush(connection)
+        else:
+            self.call_soon(self._flush, connection)
+    
+    def serve(self, host, port, backlog=100, reuse_port=False, on_start=None):
+        """Accept and service connections until interrupted"""
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((host, port))
+        server_socket.listen(backlog)
+        server_socket.setblocking(False)
+        self.selector.register(server_socket, selectors.EVENT_READ, "accept")
+        self.loop_thread = threading.get_ident()
+        if on_start:
+            on_start(self.adopt)
+        
+        try:
+            while True:
+                for key, events in self.selector.select():
+                    if key.data == "accept":
+                        self._accept(server_socket)
+                    elif key.data == "wakeup":
+                        self._run_pending()
+                    else:
+                        connection = key.data
+                        if events & selectors.EVENT_READ:
+                            self._read(connection)
+                        if events & selectors.EVENT_WRITE and not connection.closed:
+                            self._flush(connection)
+        finally:
+            self.selector.unregister(server_socket)
+            server_socket.close()
+            for key in list(self.selector.get_map().values()):
+                if isinstance(key.data, ReactorConnection):
+                    key.data.closed = True
+                    key.fileobj.close()
+    
+    def _run_pending(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        
+        while self.pending:
+            callback, args = self.pending.popleft()
+            callback(*args)
+    
+    def adopt(self, sock, address, preload):
+        """Take over a socket from another worker (safe to call from any thread)"""
+        self.call_soon(self._adopt, sock, address, preload)
+    
+    def _adopt(self, sock, address, preload):
+        sock.setblocking(False)
+        connection = ReactorConnection(self, sock, address)
+        self.selector.register(sock, selectors.EVENT_READ, connection)
+        self._dispatch(connection, preload)
+    
+    def _accept(self, server_socket):
+        # Accept everything that is queued: logins arrive in bursts
+        while True:
+            try:
+                sock, address = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            
+            sock.setblocking(False)
+            connection = ReactorConnection(self, sock, address)
+            self.selector.register(sock, selectors.EVENT_READ, connection)
+            
+            try:
+                self.on_connect(connection)
+            except Exception as e:
+                print(f"[ERROR] Client handler error: {e}")
+                self._close(connection)
+    
+    def _read(self, connection):
+        try:
+            data = connection.sock.recv(RECV_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            print(f"[ERROR] Client handler error: {e}")
+            self._close(connection)
+            return
+        
+        if not data:
+            self._close(connection)
+            return
+        connection.received_at = time.perf_counter()
+        
+        if connection.closing:
+            return  # Ignore input while we flush the final frames
+        
+        if not self._dispatch(connection, data):
+            return
+        
+        # A relayed file waits for its receiver: stop reading until it drains
+        target, connection.throttled_by = connection.throttled_by, None
+        if target and target.backlogged() and not target.closed:
+            target.relay_waiters.append(connection)
+            self._set_interest(connection, reading=False)
+    
+    def _dispatch(self, connection, data):
+        """Hand decoded frames to the chat logic; False once the connection is done"""
+        try:
+            payloads = connection.decoder.feed(data)
+            for index, payload in enumerate(payloads):
+                if not self.on_frame(connection, payload):
+                    if connection.handoff:
+                        # Another worker takes the client from this frame on
+                        connection.hand_off(connection.sock, payloads[index:], connection.decoder)
+                        self._close(connection)
+                    else:
+                        connection.close()
+                    return False
+        except Exception as e:
+            # A bad frame or a failing handler ends this connection, not the loop
+            print(f"[ERROR] Client handler error: {e}")
+            self._close(connection)
+            return False
+        return True
+    
+    def _flush(self, connection):
+        if connection.closed:
+            return
+        
+        failed = False
+        while True:
+            # Refill with a batch of queued frames
+            if not connection.write_pieces:
+                with connection.outbound_lock:
+                    if not connection.outbound:
+                        break
+                    batch, connection.write_stamps = connection.outbound.pop_batch(WRITE_BATCH_BYTES)
+                    connection.drained.notify_all()
+                connection.write_pieces.extend(connection.pack(batch))
+            
+            piece = connection.write_pieces[0]
+            try:
+                if isinstance(piece, FileRegion):
+                    # Stored file data: the kernel copies it from the page cache
+                    piece.send(connection.sock)
+                    done = not piece.count
+                else:
+                    sent = connection.sock.send(piece)
+                    done = sent == len(piece)
+                    if not done:
+                        connection.write_pieces[0] = memoryview(piece)[sent:]
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                failed = True
+                break
+            if done:
+                connection.write_pieces.popleft()
+                if not connection.write_pieces:
+                    connection.sent(connection.write_stamps)
+        
+        if failed or (connection.closing and not connection.write_pieces and not connection.outbound):
+            # Deferred: we may be inside a broadcast that holds a registry lock
+            self.call_soon(self._close, connection)
+        else:
+            # Wait for write readiness only while something is left to send
+            self._set_interest(connection, writing=bool(connection.write_pieces))
+            
+            if connection.relay_waiters and not connection.backlogged():
+                self._resume_waiters(connection)
+    
+    def _resume_waiters(self, connection):
+        # Senders paused on this connection's queue may read again
+        waiters, connection.relay_waiters = connection.relay_waiters, []
+        for waiter in waiters:
+            if not waiter.closed:
+                self._set_interest(waiter, reading=True)
+    
+    def _set_interest(self, connection, reading=None, writing=None):
+        if reading is not None:
+            connection.reading = reading
+        if writing is not None:
+            connection.watching_write = writing
+        
+        events = ((selectors.EVENT_READ if connection.reading else 0) |
+                  (selectors.EVENT_WRITE if connection.watching_write else 0))
+        
+        # Only touch the selector (an epoll_ctl syscall) when interest changes
+        if events == connection.events or connection.closed:
+            return
+        if not connection.events:
+            self.selector.register(connection.sock, events, connection)
+        elif not events:
+            self.selector.unregister(connection.sock)
+        else:
+            self.selector.modify(connection.sock, events, connection)
+        connection.events = events
+    
+    def _close(self, connection):
+        if connection.closed:
+            return
+        
+        with connection.outbound_lock:
+            connection.closed = True
+            connection.closing = True
+            connection.outbound = OutboundQueue()
+        connection.write_pieces.clear()
+        self._resume_waiters(connection)
+        
+        try:
+            self.selector.unregister(connection.sock)
+        except (KeyError, ValueError):
+            pass
+        
+        try:
+            self.on_disconnect(connection)
+        except Exception as e:
+            print(f"[ERROR] Client handler error: {e}")
+        finally:
+            connection.sock.close()
+
+def run(host, port, on_connect, on_frame, on_disconnect, backlog=100, reuse_port=False, on_start=None):
+    """Run the reactor server until interrupted"""
+    reactor = Reactor(on_connect, on_frame, on_disconnect)
+    reactor.serve(host, port, backlog, reuse_port, on_start)
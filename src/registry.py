@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+ClassChat Sharded Registry
+Lock-striped dictionaries for the server's client and group registries.
+
+Every lookup used to take one global lock (clients_lock or groups_lock),
+so two unrelated students messaging each other waited on the same mutex
+as every login, logout and group broadcast. Now the keys are spread over
+SHARD_COUNT buckets by hash, and each bucket has its own lock:
+
+    registry = ShardedRegistry()
+    registry.add("alice", connection)           # False if already taken
+    with registry.shard("cs101") as shard:      # locks only this bucket
+        members = shard.get("cs101")
+        shard.put("cs101", members | {"bob"})
+
+Reads take no lock at all. A bucket's dict is never changed in place:
+writers (holding the bucket lock) build a new dict and swap it in, so
+get() and the keys()/values()/items() snapshots used for fan-out read a
+dict that nobody is modifying. Values should be immutable for the same
+reason (the group registry keeps members as frozensets).
+"""
+
+import threading
+
+# Buckets per registry; more buckets means fewer users sharing a lock
+SHARD_COUNT = 64
+
+class Shard:
+    """One bucket: a lock and a copy-on-write dict"""
+    
+    __slots__ = ("lock", "items")
+    
+    def __init__(self, lock=threading.Lock):
+        self.lock = lock()
+        self.items = {}
+    
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.lock.release()
+    
+    def get(self, key, default=None):
+        return self.items.get(key, default)
+    
+    def put(self, key, value):
+        """Set a key (caller holds the lock)"""
+        items = dict(self.items)
+        items[key] = value
+        self.items = items
+    
+    def delete(self, key):
+        """Remove a key if present (caller holds the lock)"""
+        if key in self.items:
+            items = dict(self.items)
+            del items[key]
+            self.items = items
+
+class ShardedRegistry:
+    """Dictionary split over lock-striped buckets, with lock-free reads"""
+    
+    def __init__(self, shards=SHARD_COUNT, lock=threading.Lock):
+        # lock makes each bucket's lock (e.g. a metrics timed lock)
+        self.shards = [Shard(lock) for _ in range(shards)]
+    
+    def shard(self, key):
+        """The bucket for a key; use it as a context manager to lock it"""
+        return self.shards[hash(key) % len(self.shards)]
+    
+    def get(self, key, default=None):
+        return self.shard(key).items.get(key, default)
+    
+    def __contains__(self, key):
+        return key in self.shard(key).items
+    
+    def __len__(self):
+        return sum(len(shard.items) for shard in self.shards)
+    
+    def items(self):
+        """Snapshot of (key, value) pairs (each bucket as of one moment)"""
+        return [item for shard in self.shards for item in shard.items.items()]
+    
+    def keys(self):
+        return [key for shard in self.shards for key in shard.items]
+    
+    def values(self):
+        return [value for shard in self.shards for value in shard.items.values()]
+    
+    def add(self, key, value):
+        """Insert a key only if it is absent; False if it was already there"""
+        with self.shard(key) as shard:
+            if key in shard.items:
+                return False
+            shard.put(key, value)
+            return True
+    
+    def remove(self, key, value):
+        """Remove a key only while it still maps to value; False otherwise"""
+        with self.shard(key) as shard:
+            if shard.items.get(key) is not value:
+                return False
+            shard.delete(key)
+            return True
+    
+    def clear(self):
+        for shard in self.shards:
+            with shard:
+                shard.items = {}
@@ -15,6 +15,8 @@ import sys
 import threading
 import json
 
+from framing import send_frame, iter_frames
+
 # Server configuration
 HOST = '127.0.0.1'
 PORT = 12345
@@ -27,6 +29,12 @@ clients_lock = threading.Lock()
 groups = {}
 groups_lock = threading.Lock()
 
+# Reverse index for disconnect cleanup: {username: set(group_names)} (under groups_lock)
+user_groups = {}
+
+# /groups listing, rebuilt only after a membership change (under groups_lock)
+group_list_cache = None
+
 def broadcast_user_list():
     """Send updated user list to all clients"""
     with clients_lock:
@@ -37,25 +45,41 @@ def broadcast_user_list():
         })
         for username, (client_socket, _) in clients.items():
             try:
-                client_socket.send(message.encode('utf-8'))
+                send_frame(client_socket, message.encode('utf-8'))
             except:
                 pass
 
+def update_memberships(username, group_name, joined):
+    """Keep the user -> groups index current and drop the cached listing (caller holds groups_lock)"""
+    global group_list_cache
+    if joined:
+        user_groups.setdefault(username, set()).add(group_name)
+    else:
+        names = user_groups.get(username, set())
+        names.discard(group_name)
+        if not names:
+            user_groups.pop(username, None)
+    group_list_cache = None
+
 def send_group_list(client_socket):
     """Send list of available groups to a client"""
+    global group_list_cache
     with groups_lock:
-        group_list = {}
-        for group_name, members in groups.items():
-            group_list[group_name] = list(members)
-        
-        message = json.dumps({
-            "status": "group_list",
-            "groups": group_list
-        })
-        try:
-            client_socket.send(message.encode('utf-8'))
-        except:
-            pass
+        if group_list_cache is None:
+            group_list = {}
+            for group_name, members in groups.items():
+                group_list[group_name] = list(members)
+            
+            group_list_cache = json.dumps({
+                "status": "group_list",
+                "groups": group_list
+            }).encode('utf-8')
+        message = group_list_cache
+    
+    try:
+        send_frame(client_socket, message)
+    except:
+        pass
 
 def create_group(group_name, creator):
     """Create a new group with the creator as first member"""
@@ -64,6 +88,7 @@ def create_group(group_name, creator):
             return False, f"Group '{group_name}' already exists"
         
         groups[group_name] = {creator}
+        update_memberships(creator, group_name, True)
         return True, f"Group '{group_name}' created successfully"
 
 def join_group(group_name, username):
@@ -72,7 +97,9 @@ def join_group(group_name, username):
         if group_name not in groups:
             return False, f"Group '{group_name}' does not exist"
         
-        groups[group_name].add(username)
+        if username not in groups[group_name]:
+            groups[group_name].add(username)
+            update_memberships(username, group_name, True)
         return True, f"Joined group '{group_name}'"
 
 def leave_group(group_name, username):
@@ -85,6 +112,7 @@ def leave_group(group_name, username):
             return False, f"You are not a member of '{group_name}'"
         
         groups[group_name].remove(username)
+        update_memberships(username, group_name, False)
         
         # Delete group if empty
         if len(groups[group_name]) == 0:
@@ -93,6 +121,21 @@ def leave_group(group_name, username):
         
         return True, f"Left group '{group_name}'"
 
+def leave_all_groups(username):
+    """Remove a departing user from its groups (reverse index, no scan)"""
+    global group_list_cache
+    with groups_lock:
+        names = user_groups.pop(username, ())
+        for group_name in names:
+            members = groups.get(group_name)
+            if members is None:
+                continue
+            members.discard(username)
+            if len(members) == 0:
+                del groups[group_name]
+        if names:
+            group_list_cache = None
+
 def broadcast_to_group(group_name, sender, message_text):
     """Send a message to all members of a group"""
     with groups_lock:
@@ -114,7 +157,7 @@ def broadcast_to_group(group_name, sender, message_text):
                     "text": message_text
                 })
                 try:
-                    member_socket.send(group_message.encode('utf-8'))
+                    send_frame(member_socket, group_message.encode('utf-8'))
                     success_count += 1
                 except:
                     pass
@@ -130,8 +173,9 @@ def handle_client(client_socket, address):
     
     try:
         # Step 1: Client Registration
-        client_socket.send("Enter your username: ".encode('utf-8'))
-        username_data = client_socket.recv(1024)
+        send_frame(client_socket, "Enter your username: ".encode('utf-8'))
+        frames = iter_frames(client_socket)
+        username_data = next(frames, None)
         
         if not username_data:
             client_socket.close()
@@ -146,7 +190,7 @@ def handle_client(client_socket, address):
                     "status": "error",
                     "message": f"Username '{username}' is already taken. Disconnecting..."
                 })
-                client_socket.send(error_msg.encode('utf-8'))
+                send_frame(client_socket, error_msg.encode('utf-8'))
                 client_socket.close()
                 return
             
@@ -160,7 +204,7 @@ def handle_client(client_socket, address):
             "status": "success",
             "message": f"Welcome {username}! You are now connected to ClassChat with Group Support."
         })
-        client_socket.send(welcome.encode('utf-8'))
+        send_frame(client_socket, welcome.encode('utf-8'))
         
         # Send available commands
         help_msg = json.dumps({
@@ -174,7 +218,7 @@ def handle_client(client_socket, address):
                 "List groups": "/groups"
             }
         })
-        client_socket.send(help_msg.encode('utf-8'))
+        send_frame(client_socket, help_msg.encode('utf-8'))
         
         # Notify all clients about new user
         join_notification = json.dumps({
@@ -185,7 +229,7 @@ def handle_client(client_socket, address):
             for user, (sock, _) in clients.items():
                 if user != username:
                     try:
-                        sock.send(join_notification.encode('utf-8'))
+                        send_frame(sock, join_notification.encode('utf-8'))
                     except:
                         pass
         
@@ -193,13 +237,7 @@ def handle_client(client_socket, address):
         broadcast_user_list()
         
         # Step 2 & 3: Message and Command Processing
-        while True:
-            data = client_socket.recv(4096)
-            
-            if not data:
-                print(f"[SERVER] {username} disconnected")
-                break
-            
+        for data in frames:
             try:
                 # Parse JSON message
                 message_data = json.loads(data.decode('utf-8'))
@@ -227,7 +265,7 @@ def handle_client(client_socket, address):
                                 "status": "success" if success else "error",
                                 "message": msg
                             })
-                        client_socket.send(response.encode('utf-8'))
+                        send_frame(client_socket, response.encode('utf-8'))
                         send_group_list(client_socket)
                     
                     elif command == "/join":
@@ -243,7 +281,7 @@ def handle_client(client_socket, address):
                                 "status": "success" if success else "error",
                                 "message": msg
                             })
-                        client_socket.send(response.encode('utf-8'))
+                        send_frame(client_socket, response.encode('utf-8'))
                         send_group_list(client_socket)
                     
                     elif command == "/leave":
@@ -259,7 +297,7 @@ def handle_client(client_socket, address):
                                 "status": "success" if success else "error",
                                 "message": msg
                             })
-                        client_socket.send(response.encode('utf-8'))
+                        send_frame(client_socket, response.encode('utf-8'))
                         send_group_list(client_socket)
                     
                     elif command == "/groups":
@@ -270,7 +308,7 @@ def handle_client(client_socket, address):
                             "status": "error",
                             "message": f"Unknown command: {command}"
                         })
-                        client_socket.send(response.encode('utf-8'))
+                        send_frame(client_socket, response.encode('utf-8'))
                     
                     continue
                 
@@ -284,7 +322,7 @@ def handle_client(client_socket, address):
                         "status": "success" if success else "error",
                         "message": msg
                     })
-                    client_socket.send(response.encode('utf-8'))
+                    send_frame(client_socket, response.encode('utf-8'))
                     continue
                 
                 # Handle direct messages (client-to-client)
@@ -297,7 +335,7 @@ def handle_client(client_socket, address):
                             "status": "error",
                             "message": f"User '{receiver}' is not connected."
                         })
-                        client_socket.send(error_response.encode('utf-8'))
+                        send_frame(client_socket, error_response.encode('utf-8'))
                         continue
                     
                     receiver_socket, _ = clients[receiver]
@@ -311,28 +349,28 @@ def handle_client(client_socket, address):
                 })
                 
                 try:
-                    receiver_socket.send(forward_message.encode('utf-8'))
+                    send_frame(receiver_socket, forward_message.encode('utf-8'))
                     
                     # Send confirmation to sender
                     confirmation = json.dumps({
                         "status": "sent",
                         "message": f"Message delivered to {receiver}"
                     })
-                    client_socket.send(confirmation.encode('utf-8'))
+                    send_frame(client_socket, confirmation.encode('utf-8'))
                     
                 except Exception as e:
                     error_response = json.dumps({
                         "status": "error",
                         "message": f"Failed to deliver message to {receiver}"
                     })
-                    client_socket.send(error_response.encode('utf-8'))
+                    send_frame(client_socket, error_response.encode('utf-8'))
             
             except json.JSONDecodeError:
                 error_response = json.dumps({
                     "status": "error",
                     "message": "Invalid message format. Please use JSON."
                 })
-                client_socket.send(error_response.encode('utf-8'))
+                send_frame(client_socket, error_response.encode('utf-8'))
             
             except Exception as e:
                 print(f"[ERROR] {username}: {e}")
@@ -341,9 +379,11 @@ def handle_client(client_socket, address):
                     "message": f"Server error: {str(e)}"
                 })
                 try:
-                    client_socket.send(error_response.encode('utf-8'))
+                    send_frame(client_socket, error_response.encode('utf-8'))
                 except:
                     pass
+        
+        print(f"[SERVER] {username} disconnected")
     
     except Exception as e:
         print(f"[ERROR] Client handler error: {e}")
@@ -351,16 +391,7 @@ def handle_client(client_socket, address):
     finally:
         # Cleanup: Remove client from all groups
         if username:
-            with groups_lock:
-                groups_to_delete = []
-                for group_name, members in groups.items():
-                    if username in members:
-                        members.remove(username)
-                        if len(members) == 0:
-                            groups_to_delete.append(group_name)
-                
-                for group_name in groups_to_delete:
-                    del groups[group_name]
+            leave_all_groups(username)
             
             # Remove client from registry
             with clients_lock:
@@ -377,7 +408,7 @@ def handle_client(client_socket, address):
             with clients_lock:
                 for user, (sock, _) in clients.items():
                     try:
-                        sock.send(leave_notification.encode('utf-8'))
+                        send_frame(sock, leave_notification.encode('utf-8'))
                     except:
                         pass
             
@@ -439,6 +470,7 @@ def start_server():
             clients.clear()
         
         groups.clear()
+        user_groups.clear()
         server_socket.close()
         print("[SERVER] Server shutdown complete")
 
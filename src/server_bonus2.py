@@ -8,7 +8,7 @@ Core Functions:
 2. Group management (create, join, leave)
 3. Direct messaging (client-to-client)
 4. Group broadcasting (one-to-many)
-5. File transfer (client-to-client with binary data)
+5. File transfer (client-to-client, streamed in binary chunks)
 """
 
 import socket
@@ -19,6 +19,9 @@ import base64
 import hashlib
 import os
 
+from framing import send_frame, iter_frames
+from file_transfer import is_chunk, chunk_transfer_id, CHUNK_HEADER_SIZE
+
 # Server configuration
 HOST = '127.0.0.1'
 PORT = 12345
@@ -31,6 +34,16 @@ clients_lock = threading.Lock()
 groups = {}
 groups_lock = threading.Lock()
 
+# Reverse index for disconnect cleanup: {username: set(group_names)} (under groups_lock)
+user_groups = {}
+
+# /groups listing, rebuilt only after a membership change (under groups_lock)
+group_list_cache = None
+
+# Streamed file transfers in progress: {transfer_id: transfer record}
+transfers = {}
+transfers_lock = threading.Lock()
+
 def broadcast_user_list():
     """Send updated user list to all clients"""
     with clients_lock:
@@ -41,25 +54,41 @@ def broadcast_user_list():
         })
         for username, (client_socket, _) in clients.items():
             try:
-                client_socket.send(message.encode('utf-8'))
+                send_frame(client_socket, message.encode('utf-8'))
             except:
                 pass
 
+def update_memberships(username, group_name, joined):
+    """Keep the user -> groups index current and drop the cached listing (caller holds groups_lock)"""
+    global group_list_cache
+    if joined:
+        user_groups.setdefault(username, set()).add(group_name)
+    else:
+        names = user_groups.get(username, set())
+        names.discard(group_name)
+        if not names:
+            user_groups.pop(username, None)
+    group_list_cache = None
+
 def send_group_list(client_socket):
     """Send list of available groups to a client"""
+    global group_list_cache
     with groups_lock:
-        group_list = {}
-        for group_name, members in groups.items():
-            group_list[group_name] = list(members)
-        
-        message = json.dumps({
-            "status": "group_list",
-            "groups": group_list
-        })
-        try:
-            client_socket.send(message.encode('utf-8'))
-        except:
-            pass
+        if group_list_cache is None:
+            group_list = {}
+            for group_name, members in groups.items():
+                group_list[group_name] = list(members)
+            
+            group_list_cache = json.dumps({
+                "status": "group_list",
+                "groups": group_list
+            }).encode('utf-8')
+        message = group_list_cache
+    
+    try:
+        send_frame(client_socket, message)
+    except:
+        pass
 
 def create_group(group_name, creator):
     """Create a new group with the creator as first member"""
@@ -68,6 +97,7 @@ def create_group(group_name, creator):
             return False, f"Group '{group_name}' already exists"
         
         groups[group_name] = {creator}
+        update_memberships(creator, group_name, True)
         return True, f"Group '{group_name}' created successfully"
 
 def join_group(group_name, username):
@@ -76,7 +106,9 @@ def join_group(group_name, username):
         if group_name not in groups:
             return False, f"Group '{group_name}' does not exist"
         
-        groups[group_name].add(username)
+        if username not in groups[group_name]:
+            groups[group_name].add(username)
+            update_memberships(username, group_name, True)
         return True, f"Joined group '{group_name}'"
 
 def leave_group(group_name, username):
@@ -89,6 +121,7 @@ def leave_group(group_name, username):
             return False, f"You are not a member of '{group_name}'"
         
         groups[group_name].remove(username)
+        update_memberships(username, group_name, False)
         
         # Delete group if empty
         if len(groups[group_name]) == 0:
@@ -97,6 +130,21 @@ def leave_group(group_name, username):
         
         return True, f"Left group '{group_name}'"
 
+def leave_all_groups(username):
+    """Remove a departing user from its groups (reverse index, no scan)"""
+    global group_list_cache
+    with groups_lock:
+        names = user_groups.pop(username, ())
+        for group_name in names:
+            members = groups.get(group_name)
+            if members is None:
+                continue
+            members.discard(username)
+            if len(members) == 0:
+                del groups[group_name]
+        if names:
+            group_list_cache = None
+
 def broadcast_to_group(group_name, sender, message_text):
     """Send a message to all members of a group"""
     with groups_lock:
@@ -118,7 +166,7 @@ def broadcast_to_group(group_name, sender, message_text):
                     "text": message_text
                 })
                 try:
-                    member_socket.send(group_message.encode('utf-8'))
+                    send_frame(member_socket, group_message.encode('utf-8'))
                     success_count += 1
                 except:
                     pass
@@ -147,11 +195,144 @@ def transfer_file(sender, receiver, file_data):
     })
     
     try:
-        receiver_socket.send(file_message.encode('utf-8'))
+        send_frame(receiver_socket, file_message.encode('utf-8'))
         return True, f"File '{file_data.get('filename')}' sent to {receiver}"
     except Exception as e:
         return False, f"Failed to send file to {receiver}: {str(e)}"
 
+def start_transfer(sender, message_data):
+    """
+    Begin relaying a streamed file (file_offer) to its receiver.
+    Chunks follow as binary frames and are forwarded one by one.
+    """
+    transfer_id = message_data.get("transfer_id", "")
+    receiver = message_data.get("receiver", "")
+    filename = os.path.basename(message_data.get("filename") or "unknown_file")
+    filesize = message_data.get("filesize", 0)
+    
+    with clients_lock:
+        if receiver not in clients:
+            return False, f"User '{receiver}' is not connected"
+        
+        receiver_socket, _ = clients[receiver]
+        sender_socket, _ = clients[sender]
+    
+    # Registered before the offer goes out: the receiver may answer at once
+    with transfers_lock:
+        transfers[transfer_id] = {
+            "sender": sender,
+            "receiver": receiver,
+            "sender_socket": sender_socket,
+            "socket": receiver_socket,
+            "filename": filename,
+            "received": 0,
+            "failed": False
+        }
+    
+    offer = json.dumps({
+        "status": "file_offer",
+        "sender": sender,
+        "transfer_id": transfer_id,
+        "filename": filename,
+        "filesize": filesize,
+        "chunk_size": message_data.get("chunk_size"),
+        "checksum": message_data.get("checksum"),
+        "manifest": message_data.get("manifest")
+    })
+    
+    try:
+        send_frame(receiver_socket, offer.encode('utf-8'))
+    except Exception as e:
+        with transfers_lock:
+            transfers.pop(transfer_id, None)
+        return False, f"Failed to send file to {receiver}: {str(e)}"
+    
+    print(f"[FILE] {sender} streaming {filename} ({filesize} bytes) to {receiver}")
+    return True, None
+
+def relay_chunk(sender, payload):
+    """Forward one file chunk (blocks while the receiver catches up)"""
+    transfer_id = chunk_transfer_id(payload)
+    with transfers_lock:
+        record = transfers.get(transfer_id)
+    
+    if not record or record["sender"] != sender or record["failed"]:
+        return  # Unknown or failed transfer
+    
+    try:
+        send_frame(record["socket"], payload)
+        record["received"] += len(payload) - CHUNK_HEADER_SIZE
+    except Exception:
+        record["failed"] = True  # Reported to the sender at file_end
+
+def resume_transfer(receiver, message_data):
+    """Pass the receiver's file_resume (byte offset to continue from) to the sender"""
+    transfer_id = message_data.get("transfer_id")
+    with transfers_lock:
+        record = transfers.get(transfer_id)
+    
+    if not record or record["receiver"] != receiver:
+        return
+    
+    offset = int(message_data.get("offset", 0))
+    record["received"] = offset
+    resume = json.dumps({
+        "status": "file_resume",
+        "transfer_id": transfer_id,
+        "offset": offset
+    })
+    try:
+        send_frame(record["sender_socket"], resume.encode('utf-8'))
+    except:
+        pass
+
+def finish_transfer(sender, message_data):
+    """Complete a streamed file (file_end)"""
+    transfer_id = message_data.get("transfer_id")
+    with transfers_lock:
+        record = transfers.pop(transfer_id, None)
+    
+    if not record or record["sender"] != sender:
+        return False, None  # Offer was already rejected
+    
+    if record["failed"]:
+        return False, f"File '{record['filename']}' not delivered: {record['receiver']} disconnected. Send it again to resume."
+    
+    end = json.dumps({
+        "status": "file_end",
+        "sender": sender,
+        "transfer_id": transfer_id,
+        "filename": record["filename"],
+        "filesize": record["received"],
+        "checksum": message_data.get("checksum")
+    })
+    
+    try:
+        send_frame(record["socket"], end.encode('utf-8'))
+        return True, f"File '{record['filename']}' sent to {record['receiver']}"
+    except Exception as e:
+        return False, f"Failed to send file to {record['receiver']}: {str(e)}"
+
+def abort_transfers(username):
+    """Cancel streamed transfers started by a departing client"""
+    with transfers_lock:
+        aborted = [(transfer_id, record) for transfer_id, record in transfers.items()
+                   if record["sender"] == username]
+        for transfer_id, _ in aborted:
+            del transfers[transfer_id]
+    
+    for transfer_id, record in aborted:
+        notice = json.dumps({
+            "status": "file_aborted",
+            "sender": username,
+            "transfer_id": transfer_id,
+            "filename": record["filename"]
+        })
+        try:
+            send_frame(record["socket"], notice.encode('utf-8'))
+        except:
+            pass
+
 def handle_client(client_socket, address):
     """
     Handle communication with a single client.
@@ -161,8 +342,9 @@ def handle_client(client_socket, address):
     
     try:
         # Step 1: Client Registration
-        client_socket.send("Enter your username: ".encode('utf-8'))
-        username_data = client_socket.recv(1024)
+        send_frame(client_socket, "Enter your username: ".encode('utf-8'))
+        frames = iter_frames(client_socket)
+        username_data = next(frames, None)
         
         if not username_data:
             client_socket.close()
@@ -177,7 +359,7 @@ def handle_client(client_socket, address):
                     "status": "error",
                     "message": f"Username '{username}' is already taken. Disconnecting..."
                 })
-                client_socket.send(error_msg.encode('utf-8'))
+                send_frame(client_socket, error_msg.encode('utf-8'))
                 client_socket.close()
                 return
             
@@ -191,7 +373,7 @@ def handle_client(client_socket, address):
             "status": "success",
             "message": f"Welcome {username}! ClassChat with Group Chat + File Transfer."
         })
-        client_socket.send(welcome.encode('utf-8'))
+        send_frame(client_socket, welcome.encode('utf-8'))
         
         # Send available commands
         help_msg = json.dumps({
@@ -206,7 +388,7 @@ def handle_client(client_socket, address):
                 "List groups": "/groups"
             }
         })
-        client_socket.send(help_msg.encode('utf-8'))
+        send_frame(client_socket, help_msg.encode('utf-8'))
         
         # Notify all clients about new user
         join_notification = json.dumps({
@@ -217,7 +399,7 @@ def handle_client(client_socket, address):
             for user, (sock, _) in clients.items():
                 if user != username:
                     try:
-                        sock.send(join_notification.encode('utf-8'))
+                        send_frame(sock, join_notification.encode('utf-8'))
                     except:
                         pass
         
@@ -225,12 +407,11 @@ def handle_client(client_socket, address):
         broadcast_user_list()
         
         # Message and Command Processing
-        while True:
-            data = client_socket.recv(1048576)  # 1MB buffer for files
-            
-            if not data:
-                print(f"[SERVER] {username} disconnected")
-                break
+        for data in frames:
+            # Binary chunk of a streamed file
+            if is_chunk(data):
+                relay_chunk(username, data)
+                continue
             
             try:
                 # Parse JSON message
@@ -242,7 +423,26 @@ def handle_client(client_socket, address):
                 receiver = message_data.get("receiver", "")
                 text = message_data.get("text", "")
                 
-                # Handle file transfer
+                # Handle streamed file transfer
+                if msg_type == "file_resume":
+                    resume_transfer(username, message_data)
+                    continue
+                
+                if msg_type in ("file_offer", "file_end"):
+                    if msg_type == "file_offer":
+                        success, msg = start_transfer(username, message_data)
+                    else:
+                        success, msg = finish_transfer(username, message_data)
+                    
+                    if msg:
+                        response = json.dumps({
+                            "status": "success" if success else "error",
+                            "message": msg
+                        })
+                        send_frame(client_socket, response.encode('utf-8'))
+                    continue
+                
+                # Handle file transfer (single base64 message from older clients)
                 if msg_type == "file":
                     print(f"[FILE] {sender} sending file to {receiver}")
                     file_data = message_data.get("file_data", {})
@@ -252,7 +452,7 @@ def handle_client(client_socket, address):
                         "status": "success" if success else "error",
                         "message": msg
                     })
-                    client_socket.send(response.encode('utf-8'))
+                    send_frame(client_socket, response.encode('utf-8'))
                     continue
                 
                 # Handle group management commands
@@ -273,7 +473,7 @@ def handle_client(client_socket, address):
                                 "status": "success" if success else "error",
                                 "message": msg
                             })
-                        client_socket.send(response.encode('utf-8'))
+                        send_frame(client_socket, response.encode('utf-8'))
                         send_group_list(client_socket)
                     
                     elif command == "/join":
@@ -289,7 +489,7 @@ def handle_client(client_socket, address):
                                 "status": "success" if success else "error",
                                 "message": msg
                             })
-                        client_socket.send(response.encode('utf-8'))
+                        send_frame(client_socket, response.encode('utf-8'))
                         send_group_list(client_socket)
                     
                     elif command == "/leave":
@@ -305,7 +505,7 @@ def handle_client(client_socket, address):
                                 "status": "success" if success else "error",
                                 "message": msg
                             })
-                        client_socket.send(response.encode('utf-8'))
+                        send_frame(client_socket, response.encode('utf-8'))
                         send_group_list(client_socket)
                     
                     elif command == "/groups":
@@ -316,7 +516,7 @@ def handle_client(client_socket, address):
                             "status": "error",
                             "message": f"Unknown command: {command}"
                         })
-                        client_socket.send(response.encode('utf-8'))
+                        send_frame(client_socket, response.encode('utf-8'))
                     
                     continue
                 
@@ -330,7 +530,7 @@ def handle_client(client_socket, address):
                         "status": "success" if success else "error",
                         "message": msg
                     })
-                    client_socket.send(response.encode('utf-8'))
+                    send_frame(client_socket, response.encode('utf-8'))
                     continue
                 
                 # Handle direct messages (client-to-client)
@@ -343,7 +543,7 @@ def handle_client(client_socket, address):
                             "status": "error",
                             "message": f"User '{receiver}' is not connected."
                         })
-                        client_socket.send(error_response.encode('utf-8'))
+                        send_frame(client_socket, error_response.encode('utf-8'))
                         continue
                     
                     receiver_socket, _ = clients[receiver]
@@ -357,28 +557,28 @@ def handle_client(client_socket, address):
                 })
                 
                 try:
-                    receiver_socket.send(forward_message.encode('utf-8'))
+                    send_frame(receiver_socket, forward_message.encode('utf-8'))
                     
                     # Send confirmation to sender
                     confirmation = json.dumps({
                         "status": "sent",
                         "message": f"Message delivered to {receiver}"
                     })
-                    client_socket.send(confirmation.encode('utf-8'))
-                    
+                    send_frame(client_socket, confirmation.encode('utf-8'))
+                
                 except Exception as e:
                     error_response = json.dumps({
                         "status": "error",
                         "message": f"Failed to deliver message to {receiver}"
                     })
-                    client_socket.send(error_response.encode('utf-8'))
+                    send_frame(client_socket, error_response.encode('utf-8'))
             
             except json.JSONDecodeError:
                 error_response = json.dumps({
                     "status": "error",
                     "message": "Invalid message format. Please use JSON."
                 })
-                client_socket.send(error_response.encode('utf-8'))
+                send_frame(client_socket, error_response.encode('utf-8'))
             
             except Exception as e:
                 print(f"[ERROR] {username}: {e}")
@@ -387,26 +587,21 @@ def handle_client(client_socket, address):
                     "message": f"Server error: {str(e)}"
                 })
                 try:
-                    client_socket.send(error_response.encode('utf-8'))
+                    send_frame(client_socket, error_response.encode('utf-8'))
                 except:
                     pass
+        
+        print(f"[SERVER] {username} disconnected")
     
     except Exception as e:
         print(f"[ERROR] Client handler error: {e}")
     
     finally:
-        # Cleanup: Remove client from all groups
+        # Cleanup: Cancel file transfers and remove client from all groups
         if username:
-            with groups_lock:
-                groups_to_delete = []
-                for group_name, members in groups.items():
-                    if username in members:
-                        members.remove(username)
-                        if len(members) == 0:
-                            groups_to_delete.append(group_name)
-                
-                for group_name in groups_to_delete:
-                    del groups[group_name]
+            abort_transfers(username)
+            
+            leave_all_groups(username)
             
             # Remove client from registry
             with clients_lock:
@@ -423,7 +618,7 @@ def handle_client(client_socket, address):
             with clients_lock:
                 for user, (sock, _) in clients.items():
                     try:
-                        sock.send(leave_notification.encode('utf-8'))
+                        send_frame(sock, leave_notification.encode('utf-8'))
                     except:
                         pass
             
@@ -485,6 +680,7 @@ def start_server():
             clients.clear()
         
         groups.clear()
+        user_groups.clear()
         server_socket.close()
         print("[SERVER] Server shutdown complete")
 
@@ -8,175 +8,869 @@ Core Functions:
 2. Group management (create, join, leave)
 3. Direct messaging (client-to-client)
 4. Group broadcasting (one-to-many)
-5. File transfer (client-to-client with binary data)
-6. Offline message storage and delivery
+5. File transfer (client-to-client, streamed in binary chunks)
+6. Offline message storage and delivery (kept across restarts, files spooled to disk)
+7. Files to a whole group, stored once and fetched by checksum
+8. Latency histograms, lock waits and queue depths (/stats, --metrics-file)
+9. Several worker processes on one port (--workers, see workers.py)
+10. Several servers acting as one over a message bus (--cluster, see cluster.py)
+11. Compact binary messages for clients that ask for them at login (see codec.py)
+12. Compressed streams for clients that ask for them (see compression.py)
+
+Server modes (--mode):
+- thread:  one handler thread per client (default)
+- asyncio: single event loop, one coroutine per client
+- reactor: single selectors (epoll) loop with per-connection buffers
+
+With --workers N, N processes run one of these each and share the port
+(SO_REUSEPORT); users, groups and messages are routed between them.
+With --cluster, servers on different ports or machines do the same
+through a bus (broker.py).
 """
 
 import socket
 import sys
 import threading
+import time
 import json
 import base64
 import hashlib
 import os
+import argparse
+import itertools
 from datetime import datetime
 from collections import defaultdict
 
+from framing import FrameDecoder, encode_frame, HEADER_SIZE, RECV_BUFFER_SIZE
+from connection import SocketConnection, FileRegion, configure_outbound, OVERFLOW_POLICIES, DEFAULT_QUEUE_LIMIT, DROP_OLDEST
+from presence import PresenceAggregator, DEFAULT_WINDOW
+from registry import ShardedRegistry
+from group_directory import GroupDirectory
+from metrics import Metrics, format_stats, DEFAULT_DUMP_INTERVAL
+from workers import WorkerFabric, run_workers, worker_path
+from cluster import open_bus
+from codec import decode_message, encode_payload, parse_login, CodecError
+from compression import Deflater, Inflater, CompressionStats, CompressionError, choose_compression, DEFAULT_THRESHOLD
+from file_transfer import is_chunk, chunk_prefix, chunk_transfer_id, chunk_data, transfer_id_for, CHUNK_HEADER_SIZE
+from file_store import FileStore, DEFAULT_SPOOL_DIR, valid_checksum
+from offline_store import (OfflineStore, DEFAULT_DB_PATH, EVICTION_POLICIES, EVICT_FILES_FIRST,
+                           DEFAULT_USER_MESSAGES, DEFAULT_USER_BYTES,
+                           DEFAULT_TOTAL_MESSAGES, DEFAULT_TOTAL_BYTES, DEFAULT_TTL)
+
 # Server configuration
 HOST = '127.0.0.1'
 PORT = 12345
 
-# Client registry: {username: (socket, address)}
-clients = {}
-clients_lock = threading.Lock()
-
-# Group registry: {group_name: set(usernames)}
-groups = {}
-groups_lock = threading.Lock()
-
-# Offline message queue: {username: [list of messages]}
-offline_messages = defaultdict(list)
-offline_lock = threading.Lock()
-
-def broadcast_user_list():
-    """Send updated user list to all clients"""
-    with clients_lock:
-        user_list = list(clients.keys())
-        message = json.dumps({
-            "status": "user_list",
-            "users": user_list
-        })
-        for username, (client_socket, _) in clients.items():
-            try:
-                client_socket.send(message.encode('utf-8'))
-            except:
-                pass
-
-def send_group_list(client_socket):
-    """Send list of available groups to a client"""
-    with groups_lock:
-        group_list = {}
-        for group_name, members in groups.items():
-            group_list[group_name] = list(members)
-        
-        message = json.dumps({
-            "status": "group_list",
-            "groups": group_list
-        })
+# Pending connections the kernel may queue during a login burst
+LISTEN_BACKLOG = socket.SOMAXCONN
+
+# Stage latencies, lock waits and queue gauges (see metrics.py)
+metrics = Metrics()
+
+# Snapshot file written every metrics interval (None = no dump)
+metrics_file = None
+
+# Payload size from which frames to clients that negotiated compression are
+# compressed (None = compression not offered), and what it achieved
+compress_threshold = DEFAULT_THRESHOLD
+compression_stats = CompressionStats()
+
+# Client registry: {username: connection}, lock-striped by username (see registry.py)
+clients = ShardedRegistry(lock=lambda: metrics.timed_lock("clients"))
+
+# Group registry: {group_name: frozenset(usernames)}, lock-striped by group name
+groups = ShardedRegistry(lock=lambda: metrics.timed_lock("groups"))
+
+# Reverse index: {username: frozenset(group_names)}, updated under the group's bucket lock
+user_groups = ShardedRegistry(lock=lambda: metrics.timed_lock("user_groups"))
+
+# Versioned /groups listing, serialized once per membership change (see group_directory.py)
+group_directory = GroupDirectory(groups)
+
+# Other worker processes (see workers.py) or cluster nodes (see cluster.py);
+# None when running as one process
+peers = None
+
+# True when peers is a cluster bus: users belong to the node they are connected to
+cluster = False
+
+# Takes over a client socket handed over by another worker: adopt_socket(sock, address, preload)
+adopt_socket = None
+
+# Spool directory of worker 0; the others are derived from it (stored files are linked across)
+spool_base = None
+
+# Users online at other workers or nodes: {username: worker index or node name}
+# (changed under presence_lock)
+remote_users = {}
+
+# Stored files handed over by other nodes are sent in file_part messages
+CLUSTER_PART_SIZE = 256 * 1024
+
+# Numbers the files this node hands over; parts arriving: {(node, number): SpoolFile}
+# (only touched by the bus reader thread)
+handover_ids = itertools.count(1)
+incoming_files = {}
+
+# Presence version: bumped on every published update (see presence.py)
+presence_version = 0
+
+# Orders presence deltas and snapshots (held while queueing them)
+presence_lock = metrics.timed_lock("presence")
+
+# Batches join/leave events during login storms (None = send each event)
+presence_aggregator = None
+
+# Streamed file transfers in progress: {transfer_id: transfer record}
+transfers = {}
+transfers_lock = metrics.timed_lock("transfers")
+
+# Offline message queue, kept in SQLite so it survives restarts (see offline_store.py)
+offline_store = None
+
+# asyncio mode: frames that may wait on disk or on a store lock are handed
+# back to the engine, which finishes them on its I/O threads (see blocking())
+offload_io = False
+
+# Files for offline users live on disk; the queue holds {"blob": checksum} references
+file_store = None
+
+# Group files online members may fetch: {username: {checksum: reference}}
+# (each reference holds a count on its stored file)
+available_files = defaultdict(dict)
+
+# Guards available_files, offline_deliveries and the spill state (never held while sending)
+offline_lock = metrics.timed_lock("offline")
+
+# Stored files are replayed in large chunks to keep the frame count low
+OFFLINE_CHUNK_SIZE = 1024 * 1024
+
+# Clients pull stored messages in pages (offline_fetch); default and
+# largest page, and a size cap so a page is never one huge frame
+OFFLINE_PAGE_SIZE = 20
+OFFLINE_PAGE_MAX = 100
+OFFLINE_PAGE_BYTES = 256 * 1024
+
+# Offline pages sent but not yet acknowledged: {username: delivery state}
+offline_deliveries = {}
+
+# Messages worth keeping when a slow client's queue overflows (spill policy)
+SPILLABLE_STATUSES = ("message", "group_message", "file_transfer")
+
+# Spilled messages not stored yet: {connection: [message]} (one helper thread each),
+# and the connections a helper is waiting on to send an offline_messages notice
+spilled = {}
+spill_notices = set()
+
+def blocking(function, *args):
+    """
+    Call function(*args), which may wait on disk or on a store lock. In
+    asyncio mode return it instead, for the engine to run on an I/O thread
+    while the event loop serves the other connections.
+    """
+    if offload_io:
+        return lambda: function(*args)
+    return function(*args)
+
+def fan_out(connections, message, kind=None):
+    """
+    Queue one message for many clients.
+    The message is serialized and framed once per encoding; every
+    recipient's queue shares the same immutable bytes object.
+    """
+    frames = {}  # {encoding: frame}
+    delivered = 0
+    for connection in connections:
         try:
-            client_socket.send(message.encode('utf-8'))
+            frame = frames.get(connection.encoding)
+            if frame is None:
+                frame = frames[connection.encoding] = encode_frame(encode_payload(message, connection.encoding))
+            connection.send_frame(frame, kind)
+            delivered += 1
         except:
             pass
+    return delivered
+
+def user_list_snapshot():
+    """Build a versioned snapshot of online users (caller holds presence_lock)"""
+    return {
+        "status": "user_list",
+        "users": clients.keys() + list(remote_users),
+        "version": presence_version
+    }
+
+def send_user_list(connection):
+    """Send a versioned snapshot of online users to one client"""
+    # Queued under the lock so no delta can overtake the snapshot
+    with presence_lock:
+        connection.send(user_list_snapshot())
+
+def configure_presence(window):
+    """Coalesce join/leave events over window seconds (0 sends each event)"""
+    global presence_aggregator
+    if window > 0:
+        presence_aggregator = PresenceAggregator(presence_lock, window, publish_presence_update)
+
+def publish_presence_update(joined, left):
+    """
+    Send one combined join/leave update to every client.
+    Called by the aggregator with presence_lock held.
+    """
+    global presence_version
+    presence_version += 1
+    update = {
+        "status": "presence_update",
+        "joined": joined,
+        "left": left,
+        "version": presence_version
+    }
+    fan_out(clients.values(), update)
+
+def publish_presence(status, username):
+    """
+    Announce a join or leave to everyone else.
+    Caller holds presence_lock, so updates are queued in version order.
+    """
+    if presence_aggregator:
+        presence_aggregator.add(status, username)
+        return
+    
+    # No aggregation: send a one-user delta right away
+    global presence_version
+    presence_version += 1
+    delta = {
+        "status": status,
+        "user": username,
+        "version": presence_version
+    }
+    others = [other for user, other in clients.items() if user != username]
+    fan_out(others, delta)
+
+def update_memberships(username, group_name, joined, publish=True):
+    """
+    Record a join or leave in the user -> groups index and the group
+    directory, and tell the other workers unless it came from one.
+    Caller holds the group's bucket lock (group before user lock).
+    """
+    with user_groups.shard(username) as shard:
+        names = shard.get(username, frozenset())
+        names = names | {group_name} if joined else names - {group_name}
+        if names:
+            shard.put(username, names)
+        else:
+            shard.delete(username)
+    
+    group_directory.changed(group_name)
+    
+    # Queued, never waits: safe under the bucket lock
+    if peers and publish:
+        peers.broadcast({
+            "op": "membership",
+            "group": group_name,
+            "user": username,
+            "joined": joined
+        })
+
+def apply_membership(group_name, username, joined):
+    """
+    A join or leave made at another worker. Applied as add/remove (the
+    group appears with its first member and goes with its last), so
+    changes from different workers end up the same everywhere.
+    """
+    with groups.shard(group_name) as shard:
+        members = shard.get(group_name, frozenset())
+        if (username in members) == joined:
+            return
+        
+        members = members | {username} if joined else members - {username}
+        if members:
+            shard.put(group_name, members)
+        else:
+            shard.delete(group_name)
+        update_memberships(username, group_name, joined, publish=False)
+
+def remote_home(username):
+    """Worker or node that serves a user if it is not this one (None in one process)"""
+    if peers is None:
+        return None
+    if cluster:
+        # Online at another node; offline users are served (queued for) here
+        return remote_users.get(username)
+    home = peers.home(username)
+    return None if home == peers.index else home
+
+def send_group_list(connection, since=None):
+    """
+    Send the groups to a client: the full listing, or only what changed
+    after the version it last saw (since)
+    """
+    try:
+        connection.send_frame(group_directory.reply(since))
+    except:
+        pass
 
 def create_group(group_name, creator):
     """Create a new group with the creator as first member"""
-    with groups_lock:
-        if group_name in groups:
+    with groups.shard(group_name) as shard:
+        if shard.get(group_name) is not None:
             return False, f"Group '{group_name}' already exists"
         
-        groups[group_name] = {creator}
+        shard.put(group_name, frozenset([creator]))
+        update_memberships(creator, group_name, True)
         return True, f"Group '{group_name}' created successfully"
 
 def join_group(group_name, username):
     """Add a user to a group"""
-    with groups_lock:
-        if group_name not in groups:
+    # Member sets are frozen: replace the set so lock-free readers never see it change
+    with groups.shard(group_name) as shard:
+        members = shard.get(group_name)
+        if members is None:
             return False, f"Group '{group_name}' does not exist"
         
-        groups[group_name].add(username)
+        if username not in members:
+            shard.put(group_name, members | {username})
+            update_memberships(username, group_name, True)
         return True, f"Joined group '{group_name}'"
 
 def leave_group(group_name, username):
     """Remove a user from a group"""
-    with groups_lock:
-        if group_name not in groups:
-            return False, f"Group '{group_name}' does not exist"
-        
-        if username not in groups[group_name]:
-            return False, f"You are not a member of '{group_name}'"
-        
-        groups[group_name].remove(username)
-        
-        # Delete group if empty
-        if len(groups[group_name]) == 0:
-            del groups[group_name]
-            return True, f"Left group '{group_name}' (group deleted - no members)"
+    if group_name not in groups:
+        return False, f"Group '{group_name}' does not exist"
+    
+    removed, deleted = remove_member(group_name, username)
+    if not removed:
+        return False, f"You are not a member of '{group_name}'"
+    
+    if deleted:
+        return True, f"Left group '{group_name}' (group deleted - no members)"
+    
+    return True, f"Left group '{group_name}'"
+
+def remove_member(group_name, username):
+    """
+    Take a user out of one group, deleting the group when it empties.
+    Returns (removed, deleted).
+    """
+    with groups.shard(group_name) as shard:
+        members = shard.get(group_name)
+        if members is None or username not in members:
+            return False, False
         
-        return True, f"Left group '{group_name}'"
+        members = members - {username}
+        if members:
+            shard.put(group_name, members)
+        else:
+            shard.delete(group_name)
+        update_memberships(username, group_name, False)
+        return True, not members
 
-def broadcast_to_group(group_name, sender, message_text):
+def broadcast_to_group(group_name, sender, message_text, trace):
     """Send a message to all members of a group"""
-    with groups_lock:
-        if group_name not in groups:
-            return False, f"Group '{group_name}' does not exist"
-        
-        members = groups[group_name].copy()
+    # Lock-free reads: the member set is immutable, lookups take no bucket lock
+    members = groups.get(group_name)
+    if members is None:
+        return False, f"Group '{group_name}' does not exist"
+    
+    member_connections = [connection for connection in map(clients.get, members) if connection]
+    trace.mark("route")
     
     # Send to all group members
-    success_count = 0
-    with clients_lock:
-        for member in members:
-            if member in clients:
-                member_socket, _ = clients[member]
-                group_message = json.dumps({
-                    "status": "group_message",
-                    "group": group_name,
-                    "sender": sender,
-                    "text": message_text
-                })
-                try:
-                    member_socket.send(group_message.encode('utf-8'))
-                    success_count += 1
-                except:
-                    pass
+    group_message = {
+        "status": "group_message",
+        "group": group_name,
+        "sender": sender,
+        "text": message_text
+    }
+    success_count = fan_out(member_connections, group_message, "group")
+    
+    # One copy for every other worker or node with members online
+    if peers:
+        with presence_lock:
+            remote_members = [member for member in members if member in remote_users]
+            homes = {remote_users[member] for member in remote_members}
+        for peer in homes:
+            peers.send(peer, {
+                "op": "group_message",
+                "group": group_name,
+                "message": group_message
+            })
+        success_count += len(remote_members)
+    trace.mark("fan_out")
+    trace.finish("group")
     
     return True, f"Message sent to {success_count}/{len(members)} members in '{group_name}'"
 
+def outbound_depths():
+    """Gauge: frames and bytes waiting in the clients' outbound queues"""
+    connections = clients.values()
+    depths = [connection.queued_frames() for connection in connections]
+    return {
+        "clients": len(connections),
+        "frames": sum(depths),
+        "max_frames": max(depths, default=0),
+        "bytes": sum(connection.outbound.bytes for connection in connections)
+    }
+
+def configure_compression(threshold):
+    """Compress frames of at least threshold bytes for clients that ask (None: never)"""
+    global compress_threshold
+    compress_threshold = threshold
+
+def configure_metrics(path, interval):
+    """Register the queue gauges and dump a snapshot to path every interval seconds"""
+    global metrics_file
+    metrics.gauge("outbound", outbound_depths)
+    metrics.gauge("groups", lambda: len(groups))
+    metrics.gauge("transfers", lambda: len(transfers))
+    metrics.gauge("offline", lambda: offline_store.stats() if offline_store else {})
+    metrics.gauge("compression", compression_stats.summary)
+    
+    if path:
+        metrics_file = path
+        metrics.start_dump(path, interval)
+        print(f"[METRICS] Writing statistics to {path} every {interval:g} s")
+
+def configure_offline_store(db_path, spool_dir, **limits):
+    """Open the durable offline queue (with its quotas) and the file store it refers to"""
+    global offline_store, file_store
+    file_store = FileStore(spool_dir)
+    offline_store = OfflineStore(db_path, on_evict=release_files, **limits)
+    
+    recipients, messages = offline_store.summary()
+    if messages:
+        print(f"[OFFLINE] Recovered {messages} queued message(s) for {recipients} user(s) from {db_path}")
+    
+    # Files are kept while a queued message refers to them
+    removed = file_store.load_references(offline_store.blob_references())
+    if removed:
+        print(f"[OFFLINE] Removed {removed} stale file(s) from {spool_dir}")
+
+def release_files(blobs):
+    """Drop the offline queue's references to expired or evicted files"""
+    for blob in blobs:
+        file_store.release(blob)
+
 def store_offline_message(receiver, message_data):
-    """Store a message for offline user"""
+    """Store a message for offline user; False if it is larger than the offline quota"""
+    if message_data.get("status") == "file_transfer":
+        # Single-message file from an older client: move the bytes to disk
+        spool = file_store.spool()
+        spool.write(base64.b64decode(message_data.get("data") or ""))
+        reference = {
+            "status": "file_offer",
+            "sender": message_data.get("sender"),
+            "transfer_id": transfer_id_for(message_data.get("sender"), receiver, spool.sha256.hexdigest()),
+            "filename": os.path.basename(message_data.get("filename") or "unknown_file"),
+            "filesize": spool.size,
+            "checksum": message_data.get("checksum")
+        }
+        return store_offline_file(receiver, reference, spool) is not None
+    
+    # Add timestamp
+    message_data["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if offline_store.append(receiver, message_data) is None:
+        print(f"[OFFLINE] Message for {receiver} is larger than the offline quota - not stored")
+        return False
+    print(f"[OFFLINE] Stored message for {receiver} (total: {offline_store.count(receiver)})")
+    return True
+
+def store_offline_file(receiver, reference, spool=None, checksum=None):
+    """
+    Queue a small reference to a stored file for an offline user.
+    The file comes from spool, or is already stored under checksum (no spool).
+    Returns False if the file does not match the expected checksum and
+    None if it is larger than the offline quota.
+    """
+    if spool:
+        blob = file_store.commit(spool, checksum)
+    else:
+        blob = checksum if file_store.acquire(checksum) else None
+    if blob is None:
+        return False
+    
+    home = remote_home(receiver)
+    if home is not None:
+        # The user's own worker or node queues the file (or streams it if the user is online)
+        hand_over_file(home, {"op": "file", "user": receiver, "reference": reference}, blob)
+        file_store.release(blob)
+        return True
+    
+    reference["blob"] = blob
+    reference["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if not queue_stored_file(receiver, reference):
+        print(f"[OFFLINE] File {reference['filename']} for {receiver} is larger than the offline quota - not stored")
+        return None
+    print(f"[OFFLINE] Stored file {reference['filename']} for {receiver} (total: {offline_store.count(receiver)})")
+    return True
+
+def queue_stored_file(username, reference):
+    """Queue a reference to a stored file; False (and the file released) if it is over the quota"""
+    return queue_stored_files([(username, reference)])[0]
+
+def queue_stored_files(entries):
+    """queue_stored_file for [(username, reference)], in one store transaction"""
+    queued = []
+    for (username, reference), entry_id in zip(entries, offline_store.append_many(entries)):
+        if entry_id is None:
+            file_store.release(reference["blob"])
+        queued.append(entry_id is not None)
+    return queued
+
+def hand_over_file(peer, message, blob):
+    """
+    Give another worker or node its own copy of a stored file and send it
+    message about it. Workers share the disk (a hard link into the peer's
+    spool); nodes get the bytes over the bus first.
+    """
+    message["blob"] = blob
+    if not cluster:
+        message["path"] = file_store.link(blob, os.path.join(worker_path(spool_base, peer), "tmp"))
+        peers.send(peer, message)
+        return
+    
+    # Held until the last part is sent; the parts are read from disk as the bus sends them
+    if file_store.acquire(blob, duplicate=False):
+        peers.send_stream(peer, file_parts(blob, next(handover_ids), message))
+
+def file_parts(blob, number, message):
+    """Messages carrying a stored file to another node, message last"""
+    try:
+        for data in file_store.iter_chunks(blob, CLUSTER_PART_SIZE):
+            yield {
+                "op": "file_part",
+                "transfer": number,
+                "data": base64.b64encode(data).decode('ascii')
+            }
+        message["transfer"] = number
+        yield message
+    finally:
+        file_store.release(blob)
+
+def receive_file(message):
+    """
+    Take over the file that came with a file or group_file message.
+    Returns its checksum, with one reference, or None if it arrived damaged.
+    """
+    if "path" in message:
+        return file_store.adopt(message["path"], message["blob"])
+    
+    spool = incoming_files.pop((message["from"], message["transfer"]), None) or file_store.spool()
+    return file_store.commit(spool, message["blob"])
+
+def share_group_file(group_name, reference, blob, members=None):
+    """
+    Give every other member of a group its own reference to one stored file.
+    Online members are told the file is available and fetch it by checksum;
+    offline members find it in their offline queue. Members served by other
+    workers or nodes get it from there. Returns the member count.
+    """
+    sender = reference["sender"]
+    if members is None:
+        members = groups.get(group_name, frozenset()) - {sender}
+    count = len(members)
+    
+    if peers:
+        by_home = {}
+        for member in members:
+            by_home.setdefault(remote_home(member), set()).add(member)
+        members = by_home.pop(None, set())
+        for peer, homed in by_home.items():
+            hand_over_file(peer, {
+                "op": "group_file",
+                "group": group_name,
+                "reference": reference,
+                "members": sorted(homed)
+            }, blob)
+    
+    online = {member: clients.get(member) for member in members}
+    online = {member: connection for member, connection in online.items() if connection}
+    
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    offline = []
+    for member in members:
+        file_store.acquire(blob)
+        member_reference = dict(reference,
+                                transfer_id=transfer_id_for(sender, member, blob),
+                                blob=blob,
+                                timestamp=timestamp)
+        if member in online:
+            with offline_lock:
+                available_files[member][blob] = member_reference
+        else:
+            offline.append((member, member_reference))
+    queue_stored_files(offline)
+    
+    # One notice for every online member, serialized once
+    fan_out(online.values(), {
+        "status": "file_available",
+        "sender": sender,
+        "group": group_name,
+        "filename": reference["filename"],
+        "filesize": reference["filesize"],
+        "checksum": blob
+    })
+    print(f"[FILE] {reference['filename']} shared with {len(members)} member(s) of @{group_name} "
+          f"({len(online)} online) - stored once")
+    return count
+
+def fetch_file(connection, message_data):
+    """Stream a group file the user was offered (file_fetch by checksum)"""
+    checksum = message_data.get("checksum")
+    reference = None
+    if valid_checksum(checksum):
+        with offline_lock:
+            reference = available_files.get(connection.username, {}).pop(checksum, None)
+    
+    if reference is None:
+        connection.send({
+            "status": "error",
+            "message": "That file is not available"
+        })
+        return
+    
+    # Not in the offline queue (no entry id) until the download fails
+    threading.Thread(
+        target=send_stored_files,
+        args=(connection, [(None, reference)]),
+        daemon=True
+    ).start()
+
+def requeue_available_files(username):
+    """Move group files a user never fetched into its offline queue"""
     with offline_lock:
-        # Add timestamp
-        message_data["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        offline_messages[receiver].append(message_data)
-        print(f"[OFFLINE] Stored message for {receiver} (total: {len(offline_messages[receiver])})")
+        unfetched = available_files.pop(username, None)
+    if unfetched:
+        queue_stored_files([(username, reference) for reference in unfetched.values()])
 
-def deliver_offline_messages(username, client_socket):
-    """Deliver all stored offline messages to a user"""
+def send_stored_files(connection, entries):
+    """
+    Stream files kept for an offline user from disk (helper thread).
+    entries is [(offline store id or None, reference)]. Each file goes out
+    as offer, 1 MB chunks and end, pacing on the receiver's queue, and is
+    removed from the offline queue once sent; files not sent before a
+    disconnect stay queued. The chunks are queued as regions of the spool
+    file, which the writer sends with sendfile() (see connection.py).
+    """
+    username = connection.username
+    
+    for index, (entry_id, reference) in enumerate(entries):
+        blob = reference["blob"]
+        transfer_id = reference["transfer_id"]
+        
+        # Hold the file while it streams: its queue entry may expire meanwhile
+        if not file_store.acquire(blob, duplicate=False):
+            print(f"[OFFLINE] {reference['filename']} for {username} has expired")
+            continue
+        
+        # No manifest: the receiver starts at offset 0 without a file_resume
+        connection.send({key: value for key, value in reference.items() if key not in ("blob", "checksum")})
+        
+        # The queued regions keep the file open after we let go of it
+        delivered = True
+        spool_file = file_store.open(blob)
+        size = os.fstat(spool_file.fileno()).st_size
+        for offset in range(0, size, OFFLINE_CHUNK_SIZE):
+            if not connection.wait_until_drained():
+                delivered = False
+                break
+            count = min(OFFLINE_CHUNK_SIZE, size - offset)
+            connection.send_frame(FileRegion(chunk_prefix(transfer_id, count), spool_file, offset, count), "offline")
+        file_store.release(blob)
+        
+        if not delivered:
+            # Queued entries are still in the store; fetched group files go to the end
+            remaining = entries[index:]
+            queue_stored_files([(username, reference) for entry_id, reference in remaining if entry_id is None])
+            print(f"[OFFLINE] {username} disconnected; {len(remaining)} file(s) kept for later")
+            return
+        
+        connection.send({
+            "status": "file_end",
+            "sender": reference["sender"],
+            "transfer_id": transfer_id,
+            "filename": reference["filename"],
+            "filesize": reference["filesize"],
+            "checksum": reference["checksum"]
+        })
+        file_store.add_holder(blob, username)
+        
+        # The queue's reference goes with its entry (unless the sweeper took both)
+        if entry_id is None or offline_store.acknowledge([entry_id]):
+            file_store.release(blob)
+
+def deliver_offline_messages(username, connection):
+    """
+    Tell a user about stored messages; the client then pulls them in pages.
+    
+    Login:  {"status": "offline_messages", "count": N, "cursor": C}
+    Client: {"type": "offline_fetch", "cursor": C, "direction": "older" | "newer", "limit": n}
+    Server: {"status": "offline_page", "batch": B, "messages": [...], "files": F,
+             "cursor": C2, "remaining": R}
+    Client: {"type": "offline_ack", "batch": B}
+    
+    C from the login message with "older" gives the newest page first
+    (for a chat window that loads history while scrolling up); cursor 0
+    with "newer" reads the backlog from the oldest message. Pages are in
+    chronological order; pass the returned cursor to get the next one.
+    Messages stay queued until their page is acknowledged, and files in
+    a page are streamed from disk right after it.
+    """
+    # Group files offered during a previous session
+    requeue_available_files(username)
+    
+    message_count = offline_store.count(username)
+    if not message_count:
+        return
+    
+    # Send notification about pending messages
+    notification = {
+        "status": "offline_messages",
+        "count": message_count,
+        "cursor": offline_store.newest_id(username) + 1,
+        "message": f"You have {message_count} offline message(s)"
+    }
+    connection.send(notification)
+
+def send_offline_page(connection, message_data):
+    """offline_fetch: send one page of stored messages next to the client's cursor"""
+    username = connection.username
+    older = message_data.get("direction") == "older"
+    try:
+        cursor = int(message_data.get("cursor", 0))
+        limit = min(max(int(message_data.get("limit", OFFLINE_PAGE_SIZE)), 1), OFFLINE_PAGE_MAX)
+    except (TypeError, ValueError):
+        connection.send({
+            "status": "error",
+            "message": "Invalid offline_fetch request"
+        })
+        return
+    
     with offline_lock:
-        if username in offline_messages and offline_messages[username]:
-            message_count = len(offline_messages[username])
-            
-            # Send notification about pending messages
-            notification = json.dumps({
-                "status": "offline_messages",
-                "count": message_count,
-                "message": f"You have {message_count} offline message(s)"
-            })
-            try:
-                client_socket.send(notification.encode('utf-8'))
-            except:
-                return
-            
-            # Deliver each message
-            for msg in offline_messages[username]:
-                try:
-                    client_socket.send(json.dumps(msg).encode('utf-8'))
-                except Exception as e:
-                    print(f"[ERROR] Failed to deliver offline message: {e}")
-            
-            # Clear delivered messages
-            offline_messages[username].clear()
-            print(f"[OFFLINE] Delivered {message_count} message(s) to {username}")
+        delivery = offline_deliveries.get(username)
+        if not delivery or delivery["connection"] is not connection:
+            delivery = {
+                "connection": connection,
+                "batch": 0,        # Last page number sent
+                "in_flight": {}    # {batch: [queue ids]} awaiting offline_ack
+            }
+            offline_deliveries[username] = delivery
+    
+    # Bodies are already JSON: the page frame is built without re-encoding them
+    bodies = []
+    entry_ids = []
+    files = []
+    size = 0
+    for entry_id, body, blob in offline_store.page(username, cursor, older, limit):
+        if bodies and size + len(body) > OFFLINE_PAGE_BYTES:
+            break
+        cursor = entry_id
+        if blob:
+            files.append((entry_id, json.loads(body)))
+            continue
+        bodies.append(body)
+        entry_ids.append(entry_id)
+        size += len(body)
+    
+    if older:
+        # Read newest first; sent in chronological order
+        bodies.reverse()
+        entry_ids.reverse()
+        files.reverse()
+        remaining = offline_store.count(username, below=cursor)
+    else:
+        remaining = offline_store.count(username, above=cursor)
+    
+    delivery["batch"] += 1
+    delivery["in_flight"][delivery["batch"]] = entry_ids
+    payload = (f'{{"status": "offline_page", "batch": {delivery["batch"]}, '
+               f'"messages": [{", ".join(bodies)}], "files": {len(files)}, '
+               f'"cursor": {cursor}, "remaining": {remaining}}}')
+    connection.send_frame(encode_frame(payload.encode('utf-8')), "offline")
+    
+    if files:
+        threading.Thread(
+            target=send_stored_files,
+            args=(connection, files),
+            daemon=True
+        ).start()
+
+def acknowledge_offline_page(connection, message_data):
+    """offline_ack: remove a page the client has received from the offline queue"""
+    with offline_lock:
+        delivery = offline_deliveries.get(connection.username)
+    
+    if not delivery or delivery["connection"] is not connection:
+        return
+    
+    entry_ids = delivery["in_flight"].pop(message_data.get("batch"), None)
+    if entry_ids:
+        offline_store.acknowledge(entry_ids)
+        print(f"[OFFLINE] Delivered {len(entry_ids)} message(s) to {connection.username}")
+
+def spill_to_offline(connection, frame):
+    """
+    Overflow policy 'spill': park a frame for a slow client in its offline queue.
+    Only chat content is kept; presence and status updates are dropped.
+    """
+    if not connection.username or isinstance(frame, FileRegion):
+        return False
+    
+    try:
+        message = decode_message(frame[HEADER_SIZE:])
+    except CodecError:
+        return False
+    
+    if not isinstance(message, dict) or message.get("status") not in SPILLABLE_STATUSES:
+        return False
+    
+    # Stored by a helper thread: send() may run on an event loop
+    with offline_lock:
+        pending = spilled.get(connection)
+        if pending is None:
+            pending = spilled[connection] = []
+            threading.Thread(target=store_spilled, args=(connection,), daemon=True).start()
+        pending.append(message)
+    return True
+
+def store_spilled(connection):
+    """
+    Store a slow client's spilled messages in order (helper thread), then
+    tell it to fetch them once its queue has room again.
+    """
+    username = connection.username
+    while True:
+        with offline_lock:
+            messages = spilled[connection]
+            if not messages:
+                del spilled[connection]
+                if connection in spill_notices:
+                    return  # Its notice counts these too
+                spill_notices.add(connection)
+                break
+            spilled[connection] = []
+        for message in messages:
+            store_offline_message(username, message)
+    
+    drained = connection.wait_until_drained(frames=connection.queue_limit // 2)
+    with offline_lock:
+        spill_notices.discard(connection)
+    if not drained:
+        return  # Gone: the messages wait for the next login
+    message_count = offline_store.count(username)
+    if message_count:
+        connection.send({
+            "status": "offline_messages",
+            "count": message_count,
+            "cursor": offline_store.newest_id(username) + 1,
+            "message": f"You have {message_count} offline message(s)"
+        })
 
 def transfer_file(sender, receiver, file_data):
     """
     Transfer file from sender to receiver.
     If receiver is offline, store for later delivery.
     """
-    with clients_lock:
-        receiver_online = receiver in clients
-        if receiver_online:
-            receiver_socket, _ = clients[receiver]
+    receiver_connection = clients.get(receiver)
     
     # Prepare file message
     file_message = {
@@ -188,328 +882,984 @@ def transfer_file(sender, receiver, file_data):
         "data": file_data.get("data")
     }
     
-    if receiver_online:
+    home = remote_home(receiver)
+    if home is not None:
+        deliver_remote(home, receiver, file_message, "file")
+        return True, f"File '{file_data.get('filename')}' sent to {receiver}"
+    
+    if receiver_connection:
         # Deliver immediately
         try:
-            receiver_socket.send(json.dumps(file_message).encode('utf-8'))
+            receiver_connection.send(file_message)
             return True, f"File '{file_data.get('filename')}' sent to {receiver}"
         except Exception as e:
             return False, f"Failed to send file to {receiver}: {str(e)}"
     else:
         # Store for offline delivery
-        store_offline_message(receiver, file_message)
+        if not store_offline_message(receiver, file_message):
+            return False, f"File '{file_data.get('filename')}' is larger than {receiver}'s offline quota - not queued"
         return True, f"File '{file_data.get('filename')}' queued for {receiver} (offline)"
 
-def handle_client(client_socket, address):
+def start_transfer(connection, message_data):
     """
-    Handle communication with a single client.
-    Supports registration, direct messaging, group chatting, file transfer, and offline messages.
+    Begin relaying a streamed file (file_offer) to its receiver.
+    Files for offline users and groups (receiver "@group") go to the store;
+    a stored file the sender is known to have is not uploaded again.
     """
-    username = None
+    username = connection.username
+    transfer_id = message_data.get("transfer_id", "")
+    receiver = message_data.get("receiver", "")
+    filename = os.path.basename(message_data.get("filename") or "unknown_file")
+    filesize = message_data.get("filesize", 0)
+    checksum = message_data.get("checksum")
     
     try:
-        # Step 1: Client Registration
-        client_socket.send("Enter your username: ".encode('utf-8'))
-        username_data = client_socket.recv(1024)
-        
-        if not username_data:
-            client_socket.close()
+        valid_id = len(bytes.fromhex(transfer_id)) == 16
+    except (TypeError, ValueError):
+        valid_id = False
+    
+    if not valid_id or not receiver or not valid_checksum(checksum):
+        connection.send({
+            "status": "error",
+            "message": "Invalid file offer"
+        })
+        return
+    
+    group_name = receiver[1:] if receiver.startswith("@") else None
+    if group_name:
+        members = groups.get(group_name)
+        if members is None or username not in members:
+            connection.send({
+                "status": "error",
+                "message": f"You are not a member of group '{group_name}'"
+            })
             return
+        receiver_connection = None
+    else:
+        receiver_connection = clients.get(receiver)
+    
+    # Already on disk and the sender has had it: the upload can be skipped.
+    # The checksum alone proves nothing (every recipient of the file sees it),
+    # and the size is the stored file's, not the one claimed in the offer.
+    stored_size = file_store.held_size(checksum, username) if receiver_connection is None else None
+    stored = stored_size is not None
+    if stored:
+        filesize = stored_size
+    
+    offer = {
+        "status": "file_offer",
+        "sender": username,
+        "transfer_id": transfer_id,
+        "filename": filename,
+        "filesize": filesize,
+        "chunk_size": message_data.get("chunk_size"),
+        "checksum": checksum,
+        "manifest": message_data.get("manifest")
+    }
+    record = {
+        "sender": connection,
+        "receiver": receiver,
+        "target": receiver_connection,
+        "group": group_name,
+        "offer": offer,
+        "stored": stored,
+        "spool": file_store.spool() if receiver_connection is None and not stored else None,  # Spooled to disk
+        "received": filesize if stored else 0
+    }
+    with transfers_lock:
+        transfers[transfer_id] = record
+    
+    if receiver_connection:
+        # The receiver answers with file_resume (offset of any .part it kept)
+        print(f"[FILE] {username} streaming {filename} ({filesize} bytes) to {receiver}")
+        receiver_connection.send(offer)
+    else:
+        # Stored: from the start, or nothing left to send if already stored
+        if stored:
+            print(f"[FILE] {filename} from {username} for {receiver} is already stored - upload skipped")
+        else:
+            print(f"[FILE] {username} storing {filename} ({filesize} bytes) for {receiver}")
+        connection.send({
+            "status": "file_resume",
+            "transfer_id": transfer_id,
+            "offset": filesize if stored else 0
+        })
+
+def resume_transfer(connection, message_data):
+    """Pass the receiver's file_resume (byte offset to continue from) to the sender"""
+    transfer_id = message_data.get("transfer_id")
+    with transfers_lock:
+        record = transfers.get(transfer_id)
+    
+    if not record or record["target"] is not connection:
+        return
+    
+    offset = int(message_data.get("offset", 0))
+    record["received"] = offset
+    if offset:
+        print(f"[FILE] {record['receiver']} resumes {record['offer']['filename']} at byte {offset}")
+    
+    record["sender"].send({
+        "status": "file_resume",
+        "transfer_id": transfer_id,
+        "offset": offset
+    })
+
+def relay_chunk(connection, payload, trace):
+    """
+    Forward one file chunk to the receiver as soon as it arrives.
+    Returns True, or a continuation if the chunk goes to disk (see blocking()).
+    """
+    transfer_id = chunk_transfer_id(payload)
+    trace.mark("parse")
+    with transfers_lock:
+        record = transfers.get(transfer_id)
+    
+    if not record or record["sender"] is not connection:
+        return True  # Unknown or cancelled transfer
+    
+    record["received"] += len(payload) - CHUNK_HEADER_SIZE
+    target = record["target"]
+    trace.mark("route")
+    
+    if target is None:
+        # Offline receiver or group: written to the spool until file_end
+        return blocking(spool_chunk, record, payload, trace)
+    
+    # Same bytes, new header; the sender pauses while the receiver catches up
+    target.send_frame(encode_frame(payload), "file")
+    connection.throttle(target)
+    trace.mark("fan_out")
+    trace.finish("file")
+    return True
+
+def spool_chunk(record, payload, trace):
+    """Append a chunk of a stored transfer to its spool file; returns True"""
+    if record["spool"]:
+        record["spool"].write(chunk_data(payload))
+    trace.mark("fan_out")
+    trace.finish("offline")
+    return True
+
+def finish_transfer(connection, message_data):
+    """Complete a streamed file (file_end) and confirm to the sender"""
+    transfer_id = message_data.get("transfer_id")
+    
+    with transfers_lock:
+        record = transfers.get(transfer_id)
+        if not record or record["sender"] is not connection:
+            return  # Cancelled; the sender has already been told
+        del transfers[transfer_id]
+    
+    offer = record["offer"]
+    receiver = record["receiver"]
+    target = record["target"]
+    checksum = message_data.get("checksum")
+    
+    # Reference kept in the offline queue: the offer minus the upload details
+    reference = {key: value for key, value in offer.items() if key not in ("manifest", "chunk_size")}
+    reference["filesize"] = record["received"]
+    reference["checksum"] = checksum
+    
+    if record["group"]:
+        # One stored copy (and one upload reference) for the whole group
+        if record["stored"]:
+            blob = checksum if checksum == offer["checksum"] and file_store.acquire(checksum) else None
+        else:
+            blob = file_store.commit(record["spool"], checksum)
         
-        username = username_data.decode('utf-8').strip()
+        if blob is None:
+            response = {
+                "status": "error",
+                "message": f"File '{offer['filename']}' was corrupted in transit - not shared"
+            }
+        else:
+            file_store.add_holder(blob, offer["sender"])
+            count = share_group_file(record["group"], reference, blob)
+            file_store.release(blob)
+            response = {
+                "status": "success",
+                "message": f"File '{offer['filename']}' shared with {count} member(s) of {receiver}"
+            }
+    
+    elif target:
+        target.send({
+            "status": "file_end",
+            "sender": offer["sender"],
+            "transfer_id": transfer_id,
+            "filename": offer["filename"],
+            "filesize": record["received"],
+            "checksum": checksum
+        })
+        response = {
+            "status": "success",
+            "message": f"File '{offer['filename']}' sent to {receiver}"
+        }
+    else:
+        # Keep the file on disk; the queue only gets a reference
+        if record["stored"] and checksum != offer["checksum"]:
+            stored = False
+        else:
+            stored = store_offline_file(receiver, reference, record["spool"], checksum)
+        if stored:
+            file_store.add_holder(checksum, offer["sender"])
         
-        # Check if username already taken
-        with clients_lock:
-            if username in clients:
-                error_msg = json.dumps({
-                    "status": "error",
-                    "message": f"Username '{username}' is already taken. Disconnecting..."
+        if stored and receiver in remote_users:
+            response = {
+                "status": "success",
+                "message": f"File '{offer['filename']}' sent to {receiver}"
+            }
+        elif stored:
+            response = {
+                "status": "success",
+                "message": f"File '{offer['filename']}' queued for {receiver} (offline)"
+            }
+        elif stored is None:
+            response = {
+                "status": "error",
+                "message": f"File '{offer['filename']}' is larger than {receiver}'s offline quota - not queued"
+            }
+        else:
+            response = {
+                "status": "error",
+                "message": f"File '{offer['filename']}' was corrupted in transit - not queued"
+            }
+    
+    print(f"[FILE] {offer['filename']} from {offer['sender']} to {receiver} complete ({record['received']} bytes)")
+    connection.send(response)
+
+def abort_transfers(connection):
+    """Cancel streamed transfers sent by or to a departing client"""
+    with transfers_lock:
+        affected = [(transfer_id, record) for transfer_id, record in transfers.items()
+                    if record["sender"] is connection or record["target"] is connection]
+        for transfer_id, _ in affected:
+            del transfers[transfer_id]
+    
+    for transfer_id, record in affected:
+        offer = record["offer"]
+        if record["spool"]:
+            record["spool"].discard()
+        if record["sender"] is connection:
+            # Receiver keeps its .part file for a later resume
+            if record["target"]:
+                record["target"].send({
+                    "status": "file_aborted",
+                    "sender": offer["sender"],
+                    "transfer_id": transfer_id,
+                    "filename": offer["filename"]
                 })
-                client_socket.send(error_msg.encode('utf-8'))
-                client_socket.close()
-                return
+        else:
+            record["sender"].send({
+                "status": "file_interrupted",
+                "transfer_id": transfer_id,
+                "filename": offer["filename"],
+                "receiver": record["receiver"],
+                "message": f"File '{offer['filename']}' interrupted: {record['receiver']} disconnected. "
+                           f"Send it again to resume."
+            })
+        print(f"[FILE] Transfer of {offer['filename']} to {record['receiver']} cancelled")
+
+def client_connected(connection):
+    """Start registration for a newly accepted connection"""
+    connection.send("Enter your username: ")
+
+def register_client(connection, username_data):
+    """
+    Register a client from its username frame (a bare name, or a login
+    message offering encodings).
+    Returns False if the connection should be closed.
+    """
+    username, encoding, login = parse_login(username_data)
+    if username is None:
+        connection.send({
+            "status": "error",
+            "message": "Invalid username (not UTF-8 text). Disconnecting..."
+        })
+        return False
+    
+    # Users live at their home worker: pass the socket there (it replays this frame)
+    home = None if cluster else remote_home(username)
+    if home is not None:
+        connection.handoff = lambda sock, preload: peers.hand_off(home, sock, connection.address, preload)
+        return False
+    
+    # Register client (fails if the username is already taken, here or at another node)
+    connection.username = username
+    if username in remote_users or not clients.add(username, connection):
+        connection.username = None  # Not ours: skip the disconnect cleanup
+        error_msg = {
+            "status": "error",
+            "message": f"Username '{username}' is already taken. Disconnecting..."
+        }
+        connection.send(error_msg)
+        return False
+    
+    compression = choose_compression(login.get("compression")) if compress_threshold is not None else None
+    print(f"[SERVER] {username} connected from {connection.address} ({encoding}"
+          f"{', ' + compression if compression else ''})")
+    metrics.count(f"logins_{encoding}")
+    
+    # Send welcome message (everything from here on in the negotiated encoding;
+    # the client inflates compressed frames from its login on)
+    connection.encoding = encoding
+    if compression:
+        metrics.count(f"logins_{compression}")
+        connection.inflater = Inflater(compression_stats)
+        connection.deflater = Deflater(compress_threshold, compression_stats)
+    welcome = {
+        "status": "success",
+        "message": f"Welcome {username}! ClassChat with Groups + Files + Offline Messages.",
+        "encoding": encoding,
+        "compression": compression
+    }
+    connection.send(welcome)
+    
+    # Deliver offline messages first
+    deliver_offline_messages(username, connection)
+    
+    # Send available commands
+    help_msg = {
+        "status": "help",
+        "commands": {
+            "Direct message": "Use receiver's username",
+            "Group message": "Use @groupname as receiver",
+            "Send file": "Use /sendfile username filepath",
+            "Send file to group": "Use /sendfile @groupname filepath",
+            "Create group": "/create groupname",
+            "Join group": "/join groupname",
+            "Leave group": "/leave groupname",
+            "List groups": "/groups",
+            "Online users": "/users",
+            "Server statistics": "/stats"
+        }
+    }
+    connection.send(help_msg)
+    
+    # Tell others about the new user (delta) and send this client a snapshot
+    with presence_lock:
+        publish_presence("user_joined", username)
+        connection.send(user_list_snapshot())
+        if peers:
+            peers.broadcast({"op": "presence", "status": "user_joined", "user": username})
+    return True
+
+def handle_command(connection, receiver, since=None):
+    """
+    Handle /create, /join, /leave, /groups, /users and /stats commands.
+    since is the group directory version the client last saw, if it sent one.
+    """
+    username = connection.username
+    command_parts = receiver.split(maxsplit=1)
+    command = command_parts[0]
+    
+    if command in ("/create", "/join", "/leave"):
+        if len(command_parts) < 2:
+            response = {
+                "status": "error",
+                "message": f"Usage: {command} groupname"
+            }
+        else:
+            group_name = command_parts[1]
+            if command == "/create":
+                success, msg = create_group(group_name, username)
+            elif command == "/join":
+                success, msg = join_group(group_name, username)
+            else:
+                success, msg = leave_group(group_name, username)
+            response = {
+                "status": "success" if success else "error",
+                "message": msg
+            }
+        connection.send(response)
+        send_group_list(connection, since)
+    
+    elif command == "/groups":
+        send_group_list(connection, since)
+    
+    elif command == "/users":
+        send_user_list(connection)
+    
+    elif command == "/stats":
+        connection.send({
+            "status": "stats",
+            "stats": metrics.snapshot()
+        })
+    
+    else:
+        response = {
+            "status": "error",
+            "message": f"Unknown command: {command}"
+        }
+        connection.send(response)
+
+def handle_direct_message(connection, sender, receiver, text, trace):
+    """Deliver a direct message, or queue it if the receiver is offline"""
+    print(f"[DIRECT] From {sender} to {receiver}: {text}")
+    
+    # Check if receiver is online
+    receiver_connection = clients.get(receiver)
+    
+    # Prepare message
+    forward_message = {
+        "status": "message",
+        "sender": sender,
+        "receiver": receiver,
+        "text": text
+    }
+    trace.mark("route")
+    
+    home = remote_home(receiver)
+    if home is not None:
+        # The receiver's worker delivers it, or queues it if the receiver is offline
+        deliver_remote(home, receiver, forward_message, "direct")
+        online = receiver in remote_users
+        trace.mark("fan_out")
+        trace.finish("direct" if online else "offline")
+        connection.send({
+            "status": "sent",
+            "message": f"Message delivered to {receiver}" if online else
+                       f"Message queued for {receiver} (currently offline)"
+        })
+        return
+    
+    if receiver_connection:
+        # Deliver immediately
+        try:
+            receiver_connection.send(forward_message, "direct")
+            trace.mark("fan_out")
+            trace.finish("direct")
             
-            # Register client
-            clients[username] = (client_socket, address)
+            # Send confirmation to sender
+            confirmation = {
+                "status": "sent",
+                "message": f"Message delivered to {receiver}"
+            }
+            connection.send(confirmation)
         
-        print(f"[SERVER] {username} connected from {address}")
+        except Exception as e:
+            error_response = {
+                "status": "error",
+                "message": f"Failed to deliver message to {receiver}"
+            }
+            connection.send(error_response)
+    else:
+        # Store for offline delivery
+        queued = store_offline_message(receiver, forward_message)
+        trace.mark("fan_out")
+        trace.finish("offline")
         
-        # Send welcome message
-        welcome = json.dumps({
-            "status": "success",
-            "message": f"Welcome {username}! ClassChat with Groups + Files + Offline Messages."
-        })
-        client_socket.send(welcome.encode('utf-8'))
+        # Notify sender
+        if queued:
+            offline_notice = {
+                "status": "sent",
+                "message": f"Message queued for {receiver} (currently offline)"
+            }
+        else:
+            offline_notice = {
+                "status": "error",
+                "message": f"Message is larger than {receiver}'s offline quota - not queued"
+            }
+        connection.send(offline_notice)
+
+def deliver_remote(peer, username, message, kind, rerouted=False):
+    """Send a message to a user served by another worker or node"""
+    peers.send(peer, {
+        "op": "deliver",
+        "user": username,
+        "message": message,
+        "kind": kind,
+        "rerouted": rerouted
+    })
+
+def deliver_local(username, message, kind, rerouted=False):
+    """Deliver a message from another worker or node to a user served here, or queue it"""
+    connection = clients.get(username)
+    if connection:
+        connection.send(message, kind)
+        return
+    
+    # Logged in at another node while this was on its way: follow once, then queue
+    home = remote_home(username)
+    if home is not None and not rerouted:
+        deliver_remote(home, username, message, kind, True)
+    else:
+        store_offline_message(username, message)
+
+def deliver_stored_file(username, reference):
+    """A file handed over by another worker or node: stream it to the user, or queue it"""
+    connection = clients.get(username)
+    if connection:
+        threading.Thread(
+            target=send_stored_files,
+            args=(connection, [(None, reference)]),
+            daemon=True
+        ).start()
+    else:
+        reference["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        queue_stored_file(username, reference)
+
+def forward_offline(username, node):
+    """Send what is queued here for a user who logged in at another node, then drop it"""
+    forwarded = 0
+    cursor = 0
+    while True:
+        entries = offline_store.page(username, cursor, limit=OFFLINE_PAGE_MAX)
+        if not entries:
+            break
         
-        # Deliver offline messages first
-        deliver_offline_messages(username, client_socket)
+        for entry_id, body, blob in entries:
+            cursor = entry_id
+            message = json.loads(body)
+            if blob:
+                del message["blob"]
+                hand_over_file(node, {"op": "file", "user": username, "reference": message}, blob)
+            else:
+                deliver_remote(node, username, message, "offline")
+            
+            # The queue's reference to a file goes with its entry (hand_over_file holds its own)
+            if offline_store.acknowledge([entry_id]) and blob:
+                file_store.release(blob)
+            forwarded += 1
+    
+    if forwarded:
+        print(f"[CLUSTER] Forwarded {forwarded} offline message(s) for {username} to node {node}")
+
+def sync_node(node):
+    """Tell a node that joined the cluster who is connected here, and their groups"""
+    users = clients.keys()
+    peers.send(node, {
+        "op": "sync",
+        "users": users,
+        "groups": {user: sorted(user_groups.get(user, ())) for user in users}
+    })
+
+def remote_user_joined(username, home):
+    """A user came online at another worker or node (caller holds presence_lock)"""
+    if username not in remote_users:
+        remote_users[username] = home
+        publish_presence("user_joined", username)
+
+def forget_node(node):
+    """A node left the cluster (None: all of them): its users are offline now"""
+    with presence_lock:
+        gone = [user for user, home in remote_users.items() if node is None or home == node]
+        for user in gone:
+            del remote_users[user]
+            publish_presence("user_left", user)
+    
+    # Their memberships end here too (each node drops them itself)
+    for user in gone:
+        for group_name in user_groups.get(user, ()):
+            apply_membership(group_name, user, False)
+    
+    for key in [key for key in incoming_files if node is None or key[0] == node]:
+        incoming_files.pop(key).discard()
+    print(f"[CLUSTER] Node {node or '(all)'} left; {len(gone)} user(s) went offline")
+
+def handle_peer_message(message, fd):
+    """
+    Apply a message from another worker or cluster node (reader thread, see
+    workers.py and cluster.py)
+    """
+    op = message.get("op")
+    
+    if op == "handoff":
+        address = tuple(message["address"]) if message.get("address") else None
+        adopt_socket(socket.socket(fileno=fd), address, base64.b64decode(message["preload"]))
+    
+    elif op == "deliver":
+        deliver_local(message["user"], message["message"], message.get("kind"), message.get("rerouted"))
+    
+    elif op == "presence":
+        username = message["user"]
+        with presence_lock:
+            if message["status"] == "user_joined":
+                remote_user_joined(username, message["from"] if cluster else peers.home(username))
+            elif remote_users.pop(username, None) is not None:
+                publish_presence("user_left", username)
         
-        # Send available commands
-        help_msg = json.dumps({
-            "status": "help",
-            "commands": {
-                "Direct message": "Use receiver's username",
-                "Group message": "Use @groupname as receiver",
-                "Send file": "Use /sendfile username filepath",
-                "Create group": "/create groupname",
-                "Join group": "/join groupname",
-                "Leave group": "/leave groupname",
-                "List groups": "/groups"
-            }
-        })
-        client_socket.send(help_msg.encode('utf-8'))
+        # Whatever this node kept for the user while it was offline
+        if cluster and message["status"] == "user_joined" and offline_store.count(username):
+            forward_offline(username, message["from"])
+    
+    elif op == "membership":
+        apply_membership(message["group"], message["user"], message["joined"])
+    
+    elif op == "group_message":
+        members = groups.get(message["group"], frozenset())
+        fan_out([connection for connection in map(clients.get, members) if connection],
+                message["message"], "group")
+    
+    elif op == "file_part":
+        key = (message["from"], message["transfer"])
+        spool = incoming_files.get(key)
+        if spool is None:
+            spool = incoming_files[key] = file_store.spool()
+        spool.write(base64.b64decode(message["data"]))
+    
+    elif op in ("file", "group_file"):
+        # The file becomes ours; one reference until it is queued or shared
+        blob = receive_file(message)
+        if blob is None:
+            print(f"[CLUSTER] {message['reference'].get('filename')} from {message.get('from')} "
+                  f"failed its checksum - dropped")
+            return
+        reference = dict(message["reference"], blob=blob)
+        if op == "file":
+            deliver_stored_file(message["user"], reference)
+        else:
+            share_group_file(message["group"], reference, blob, message["members"])
+            file_store.release(blob)
+    
+    elif op == "node_joined":
+        sync_node(message["from"])
+    
+    elif op == "node_left":
+        forget_node(message["from"])
+    
+    elif op == "sync":
+        node = message["from"]
+        with presence_lock:
+            for username in message["users"]:
+                remote_user_joined(username, node)
+        for username, group_names in message["groups"].items():
+            for group_name in group_names:
+                apply_membership(group_name, username, True)
+        for username in message["users"]:
+            if offline_store.count(username):
+                forward_offline(username, node)
+
+def handle_message(connection, data, trace):
+    """
+    Parse one message frame from a registered client and route it.
+    Returns True, or a continuation if routing may block (see blocking()).
+    """
+    try:
+        # Parse the message (JSON or binary)
+        message_data = decode_message(data)
+        trace.mark("parse")
         
-        # Notify all clients about new user
-        join_notification = json.dumps({
-            "status": "system",
-            "message": f"{username} has joined the chat"
-        })
-        with clients_lock:
-            for user, (sock, _) in clients.items():
-                if user != username:
-                    try:
-                        sock.send(join_notification.encode('utf-8'))
-                    except:
-                        pass
+        # The offline queue and the file store are used off the event loop
+        if message_blocks(message_data):
+            return blocking(route_message, connection, message_data, trace)
+    
+    except CodecError:
+        error_response = {
+            "status": "error",
+            "message": "Invalid message format. Please use JSON (or the binary encoding)."
+        }
+        connection.send(error_response)
+        return True
+    
+    except Exception as e:
+        return report_error(connection, e)
+    
+    return route_message(connection, message_data, trace)
+
+def message_blocks(message_data):
+    """True if routing a message may wait on disk or on a store lock"""
+    msg_type = message_data.get("type", "message")
+    if msg_type in STORAGE_TYPES:
+        return True
+    if msg_type in CONTROL_HANDLERS:
+        return False
+    
+    receiver = message_data.get("receiver", "")
+    if receiver.startswith("/"):
+        # /stats counts the offline queue
+        return receiver.split(maxsplit=1)[0] == "/stats"
+    if receiver.startswith("@"):
+        return False  # Group messages only go to members online
+    
+    # A direct message is queued here if its receiver is offline
+    return clients.get(receiver) is None and remote_home(receiver) is None
+
+def route_message(connection, message_data, trace):
+    """Route one parsed message to its handler; returns True"""
+    try:
+        # Extract fields
+        msg_type = message_data.get("type", "message")
+        sender = message_data.get("sender", connection.username)
+        receiver = message_data.get("receiver", "")
+        text = message_data.get("text", "")
         
-        # Broadcast updated user list
-        broadcast_user_list()
+        # Handle streamed file transfer and offline paging (timed as one routing stage)
+        handler = CONTROL_HANDLERS.get(msg_type)
+        if handler:
+            handler(connection, message_data)
+            trace.mark("route")
+            trace.finish("offline" if msg_type.startswith("offline") else "file")
+            return True
         
-        # Message and Command Processing
-        while True:
-            data = client_socket.recv(1048576)  # 1MB buffer for files
+        # Handle file transfer (single base64 message from older clients)
+        if msg_type == "file":
+            print(f"[FILE] {sender} sending file to {receiver}")
+            file_data = message_data.get("file_data", {})
+            success, msg = transfer_file(sender, receiver, file_data)
+            trace.mark("route")
+            trace.finish("file")
             
-            if not data:
-                print(f"[SERVER] {username} disconnected")
-                break
-            
-            try:
-                # Parse JSON message
-                message_data = json.loads(data.decode('utf-8'))
-                
-                # Extract fields
-                msg_type = message_data.get("type", "message")
-                sender = message_data.get("sender", username)
-                receiver = message_data.get("receiver", "")
-                text = message_data.get("text", "")
-                
-                # Handle file transfer
-                if msg_type == "file":
-                    print(f"[FILE] {sender} sending file to {receiver}")
-                    file_data = message_data.get("file_data", {})
-                    success, msg = transfer_file(sender, receiver, file_data)
-                    
-                    response = json.dumps({
-                        "status": "success" if success else "error",
-                        "message": msg
-                    })
-                    client_socket.send(response.encode('utf-8'))
-                    continue
-                
-                # Handle group management commands
-                if receiver.startswith("/"):
-                    command_parts = receiver.split(maxsplit=1)
-                    command = command_parts[0]
-                    
-                    if command == "/create":
-                        if len(command_parts) < 2:
-                            response = json.dumps({
-                                "status": "error",
-                                "message": "Usage: /create groupname"
-                            })
-                        else:
-                            group_name = command_parts[1]
-                            success, msg = create_group(group_name, username)
-                            response = json.dumps({
-                                "status": "success" if success else "error",
-                                "message": msg
-                            })
-                        client_socket.send(response.encode('utf-8'))
-                        send_group_list(client_socket)
-                    
-                    elif command == "/join":
-                        if len(command_parts) < 2:
-                            response = json.dumps({
-                                "status": "error",
-                                "message": "Usage: /join groupname"
-                            })
-                        else:
-                            group_name = command_parts[1]
-                            success, msg = join_group(group_name, username)
-                            response = json.dumps({
-                                "status": "success" if success else "error",
-                                "message": msg
-                            })
-                        client_socket.send(response.encode('utf-8'))
-                        send_group_list(client_socket)
-                    
-                    elif command == "/leave":
-                        if len(command_parts) < 2:
-                            response = json.dumps({
-                                "status": "error",
-                                "message": "Usage: /leave groupname"
-                            })
-                        else:
-                            group_name = command_parts[1]
-                            success, msg = leave_group(group_name, username)
-                            response = json.dumps({
-                                "status": "success" if success else "error",
-                                "message": msg
-                            })
-                        client_socket.send(response.encode('utf-8'))
-                        send_group_list(client_socket)
-                    
-                    elif command == "/groups":
-                        send_group_list(client_socket)
-                    
-                    else:
-                        response = json.dumps({
-                            "status": "error",
-                            "message": f"Unknown command: {command}"
-                        })
-                        client_socket.send(response.encode('utf-8'))
-                    
-                    continue
-                
-                # Handle group messages (receiver starts with @)
-                if receiver.startswith("@"):
-                    group_name = receiver[1:]  # Remove @ prefix
-                    print(f"[GROUP] {sender} to @{group_name}: {text}")
-                    
-                    success, msg = broadcast_to_group(group_name, sender, text)
-                    response = json.dumps({
-                        "status": "success" if success else "error",
-                        "message": msg
-                    })
-                    client_socket.send(response.encode('utf-8'))
-                    continue
-                
-                # Handle direct messages (client-to-client)
-                print(f"[DIRECT] From {sender} to {receiver}: {text}")
-                
-                # Check if receiver is online
-                with clients_lock:
-                    receiver_online = receiver in clients
-                    if receiver_online:
-                        receiver_socket, _ = clients[receiver]
-                
-                # Prepare message
-                forward_message = {
-                    "status": "message",
-                    "sender": sender,
-                    "receiver": receiver,
-                    "text": text
-                }
-                
-                if receiver_online:
-                    # Deliver immediately
-                    try:
-                        receiver_socket.send(json.dumps(forward_message).encode('utf-8'))
-                        
-                        # Send confirmation to sender
-                        confirmation = json.dumps({
-                            "status": "sent",
-                            "message": f"Message delivered to {receiver}"
-                        })
-                        client_socket.send(confirmation.encode('utf-8'))
-                    
-                    except Exception as e:
-                        error_response = json.dumps({
-                            "status": "error",
-                            "message": f"Failed to deliver message to {receiver}"
-                        })
-                        client_socket.send(error_response.encode('utf-8'))
-                else:
-                    # Store for offline delivery
-                    store_offline_message(receiver, forward_message)
-                    
-                    # Notify sender
-                    offline_notice = json.dumps({
-                        "status": "sent",
-                        "message": f"Message queued for {receiver} (currently offline)"
-                    })
-                    client_socket.send(offline_notice.encode('utf-8'))
-            
-            except json.JSONDecodeError:
-                error_response = json.dumps({
-                    "status": "error",
-                    "message": "Invalid message format. Please use JSON."
-                })
-                client_socket.send(error_response.encode('utf-8'))
+            response = {
+                "status": "success" if success else "error",
+                "message": msg
+            }
+            connection.send(response)
+            return True
+        
+        # Handle group management commands
+        if receiver.startswith("/"):
+            handle_command(connection, receiver, message_data.get("version"))
+            return True
+        
+        # Handle group messages (receiver starts with @)
+        if receiver.startswith("@"):
+            group_name = receiver[1:]  # Remove @ prefix
+            print(f"[GROUP] {sender} to @{group_name}: {text}")
             
-            except Exception as e:
-                print(f"[ERROR] {username}: {e}")
-                error_response = json.dumps({
-                    "status": "error",
-                    "message": f"Server error: {str(e)}"
-                })
-                try:
-                    client_socket.send(error_response.encode('utf-8'))
-                except:
-                    pass
+            success, msg = broadcast_to_group(group_name, sender, text, trace)
+            response = {
+                "status": "success" if success else "error",
+                "message": msg
+            }
+            connection.send(response)
+            return True
+        
+        # Handle direct messages (client-to-client)
+        handle_direct_message(connection, sender, receiver, text, trace)
+        return True
+    
+    except Exception as e:
+        return report_error(connection, e)
+
+def report_error(connection, e):
+    """Tell a client its message failed on the server; returns True (it stays connected)"""
+    print(f"[ERROR] {connection.username}: {e}")
+    error_response = {
+        "status": "error",
+        "message": f"Server error: {str(e)}"
+    }
+    try:
+        connection.send(error_response)
+    except:
+        pass
+    return True
+
+# Streamed file and offline paging messages: {type: handler(connection, message_data)}
+CONTROL_HANDLERS = {
+    "file_offer": start_transfer,
+    "file_end": finish_transfer,
+    "file_resume": resume_transfer,
+    "file_fetch": fetch_file,
+    "offline_fetch": send_offline_page,
+    "offline_ack": acknowledge_offline_page
+}
+
+# Message types that read or write the offline queue or the file store
+STORAGE_TYPES = ("file", "file_offer", "file_end", "offline_fetch", "offline_ack")
+
+def handle_frame(connection, data):
+    """
+    Dispatch one frame received from a client.
+    The first frame is the username; everything after is a message (JSON
+    or binary) or a binary file chunk.
+    Returns False if the connection should be closed, or (asyncio mode)
+    a continuation for a frame that may block (see blocking()).
+    """
+    if connection.username is None:
+        # Logging in reads the offline queue
+        return blocking(register_client, connection, data)
+    
+    if connection.inflater:
+        try:
+            data = connection.inflater.payload(data)
+        except CompressionError as e:
+            # The rest of the stream cannot be read either
+            print(f"[ERROR] {connection.username}: {e} - disconnecting")
+            return False
+    
+    # Stages are timed from the read that delivered the frame
+    trace = metrics.trace(connection.received_at)
+    if is_chunk(data):
+        return relay_chunk(connection, data, trace)
+    
+    return handle_message(connection, data, trace)
+
+def client_disconnected(connection):
+    """Remove a departing client from groups and the registry"""
+    username = connection.username
+    if not username:
+        return
+    
+    print(f"[SERVER] {username} disconnected")
+    
+    # Cancel file transfers in flight
+    abort_transfers(connection)
+    
+    # Cleanup: Remove client from its own groups (reverse index, no scan)
+    for group_name in user_groups.get(username, ()):
+        remove_member(group_name, username)
+    
+    # Remove client from registry and notify others (delta)
+    if clients.remove(username, connection):
+        with presence_lock:
+            publish_presence("user_left", username)
+            if peers:
+                peers.broadcast({"op": "presence", "status": "user_left", "user": username})
+    
+    print(f"[SERVER] {username} removed from registry")
+    
+    # Unacknowledged offline pages stay queued for the next login
+    with offline_lock:
+        delivery = offline_deliveries.get(username)
+        if delivery and delivery["connection"] is connection:
+            del offline_deliveries[username]
+    
+    # Group files not fetched yet wait in the offline queue
+    requeue_available_files(username)
+    
+    # Check if there are pending offline messages
+    pending = offline_store.count(username)
+    if pending:
+        print(f"[OFFLINE] {username} has {pending} undelivered message(s)")
+
+def handle_client(client_socket, address, preload=None):
+    """
+    Handle communication with a single client (thread mode).
+    Supports registration, direct messaging, group chatting, file transfer, and offline messages.
+    preload: bytes already read by the worker that accepted the client.
+    """
+    connection = SocketConnection(client_socket, address)
+    decoder = FrameDecoder()
+    
+    try:
+        if preload is None:
+            client_connected(connection)
+            data = client_socket.recv(RECV_BUFFER_SIZE)
+        else:
+            data = preload
+        
+        # Registration frame first, then message and command processing
+        while data:
+            connection.received_at = time.perf_counter()
+            payloads = decoder.feed(data)
+            for index, payload in enumerate(payloads):
+                if not handle_frame(connection, payload):
+                    if connection.handoff:
+                        connection.hand_off(client_socket, payloads[index:], decoder)
+                    return
+                connection.wait_for_room()
+            data = client_socket.recv(RECV_BUFFER_SIZE)
     
     except Exception as e:
         print(f"[ERROR] Client handler error: {e}")
     
     finally:
-        # Cleanup: Remove client from all groups
-        if username:
-            with groups_lock:
-                groups_to_delete = []
-                for group_name, members in groups.items():
-                    if username in members:
-                        members.remove(username)
-                        if len(members) == 0:
-                            groups_to_delete.append(group_name)
-                
-                for group_name in groups_to_delete:
-                    del groups[group_name]
-            
-            # Remove client from registry
-            with clients_lock:
-                if username in clients:
-                    del clients[username]
-            
-            print(f"[SERVER] {username} removed from registry")
-            
-            # Check if there are pending offline messages
-            with offline_lock:
-                if username in offline_messages and offline_messages[username]:
-                    print(f"[OFFLINE] {username} has {len(offline_messages[username])} undelivered message(s)")
-            
-            # Notify others about disconnect
-            leave_notification = json.dumps({
-                "status": "system",
-                "message": f"{username} has left the chat"
-            })
-            with clients_lock:
-                for user, (sock, _) in clients.items():
-                    try:
-                        sock.send(leave_notification.encode('utf-8'))
-                    except:
-                        pass
-            
-            # Broadcast updated user list
-            broadcast_user_list()
+        client_disconnected(connection)
+        connection.close()
+
+def print_banner(host, port, mode):
+    """Print the startup banner"""
+    print("=" * 60)
+    print("ClassChat Server - Bonus 5.3: Offline Messages")
+    print("=" * 60)
+    if cluster:
+        mode += f" mode, cluster node {peers.node}"
+    elif peers:
+        mode += f" mode, worker {peers.index + 1} of {peers.count}"
+    else:
+        mode += " mode"
+    print(f"[SERVER] Server started on {host}:{port} ({mode})")
+    print("[SERVER] Features: Messages + Groups + Files + Offline Queue")
+    print("[SERVER] Offline messages will be delivered on reconnect")
+    print("[SERVER] Press Ctrl+C to stop\n")
+
+def raise_file_limit():
+    """Raise the open file limit so one process can hold many sockets"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        return hard
+    except (ImportError, ValueError, OSError):
+        return None
+
+def shutdown_server():
+    """Close all client connections and report undelivered messages"""
+    # Final statistics, taken while the queues are still there
+    for line in format_stats(metrics.snapshot()):
+        print(f"[METRICS] {line}")
+    if metrics_file:
+        try:
+            metrics.dump(metrics_file)
+        except OSError as e:
+            print(f"[METRICS] Could not write {metrics_file}: {e}")
+    
+    # Close all client connections
+    for username, connection in clients.items():
+        try:
+            connection.close()
+        except:
+            pass
+    clients.clear()
+    
+    groups.clear()
+    user_groups.clear()
+    
+    # Display presence coalescing metrics
+    if presence_aggregator:
+        stats = presence_aggregator.stats()
+        print(f"[PRESENCE] {stats['events']} join/leave event(s), {stats['updates']} update(s) sent, "
+              f"{stats['coalesced']} coalesced")
+    
+    # Display group directory metrics
+    stats = group_directory.stats()
+    print(f"[GROUPS] {stats['full']} full listing(s) ({stats['rebuilt']} serialized), "
+          f"{stats['deltas']} delta(s), {stats['unchanged']} not modified")
+    
+    # Display file store deduplication metrics
+    if file_store:
+        stats = file_store.stats()
+        print(f"[STORE] {stats['files']} file(s) stored for {stats['references']} reference(s), "
+              f"{stats['deduplicated']} duplicate(s) not stored again ({stats['saved_bytes']} bytes saved)")
+    
+    # Undelivered messages stay on disk for the next start
+    if offline_store:
+        stats = offline_store.stats()
+        print(f"[OFFLINE] {stats['queued']} queued ({stats['queued_bytes']} bytes), "
+              f"{stats['expired']} expired, {stats['evicted']} evicted ({stats['evicted_bytes']} bytes), "
+              f"{stats['compacted']} compacted")
         
-        client_socket.close()
+        undelivered = stats['queued']
+        if undelivered > 0:
+            print(f"[SERVER] {undelivered} offline message(s) kept in {offline_store.path} for the next start")
+        offline_store.close()
+    
+    print("[SERVER] Server shutdown complete")
 
-def start_server():
-    """Start the ClassChat server with offline message support"""
+def adopt_thread(client_socket, address, preload):
+    """Thread mode: serve a socket handed over by another worker"""
+    threading.Thread(
+        target=handle_client,
+        args=(client_socket, address, preload),
+        daemon=True
+    ).start()
+
+def start_server(host=HOST, port=PORT, reuse_port=False, on_start=None):
+    """Start the ClassChat server with offline message support (thread mode)"""
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     
     try:
-        server_socket.bind((HOST, PORT))
-        server_socket.listen(10)
+        server_socket.bind((host, port))
+        server_socket.listen(LISTEN_BACKLOG)
+        if on_start:
+            on_start(adopt_thread)
         
-        print("=" * 60)
-        print("ClassChat Server - Bonus 5.3: Offline Messages")
-        print("=" * 60)
-        print(f"[SERVER] Server started on {HOST}:{PORT}")
-        print("[SERVER] Features: Messages + Groups + Files + Offline Queue")
-        print("[SERVER] Offline messages will be delivered on reconnect")
-        print("[SERVER] Press Ctrl+C to stop\n")
+        print_banner(host, port, "thread")
         
         while True:
             client_socket, address = server_socket.accept()
@@ -523,47 +1873,201 @@ def start_server():
             thread.start()
             
             # Display active users, groups, and offline queue
-            with clients_lock:
-                print(f"[SERVER] Active users: {list(clients.keys())}")
-            with groups_lock:
-                if groups:
-                    print(f"[SERVER] Active groups: {list(groups.keys())}")
-            with offline_lock:
-                pending = {user: len(msgs) for user, msgs in offline_messages.items() if msgs}
-                if pending:
-                    print(f"[SERVER] Pending offline messages: {pending}\n")
-                else:
-                    print()
+            print(f"[SERVER] Active users: {clients.keys()}")
+            group_names = groups.keys()
+            if group_names:
+                print(f"[SERVER] Active groups: {group_names}")
+            recipients, pending = offline_store.summary()
+            if pending:
+                print(f"[SERVER] Pending offline messages: {pending} for {recipients} user(s)\n")
+            else:
+                print()
     
     except KeyboardInterrupt:
         print("\n[SERVER] Server interrupted by user")
     except Exception as e:
         print(f"[SERVER ERROR] {e}")
     finally:
-        # Close all client connections
-        with clients_lock:
-            for username, (sock, _) in clients.items():
-                try:
-                    sock.close()
-                except:
-                    pass
-            clients.clear()
-        
-        groups.clear()
         server_socket.close()
-        
-        # Display undelivered messages
-        with offline_lock:
-            undelivered = sum(len(msgs) for msgs in offline_messages.values())
-            if undelivered > 0:
-                print(f"[SERVER] {undelivered} offline message(s) remain in queue")
-        
-        print("[SERVER] Server shutdown complete")
+        shutdown_server()
+
+def start_async_server(host=HOST, port=PORT, reuse_port=False, on_start=None, io_threads=None):
+    """Start the ClassChat server on a single asyncio event loop"""
+    import async_server
+    global offload_io
+    
+    # Storage work goes to the engine's I/O threads (see blocking())
+    offload_io = True
+    limit = raise_file_limit()
+    
+    def started(adopt):
+        if on_start:
+            on_start(adopt)
+        print_banner(host, port, "asyncio")
+        if limit:
+            print(f"[SERVER] Open file limit: {limit}\n")
+    
+    try:
+        async_server.run(
+            host, port,
+            client_connected, handle_frame, client_disconnected,
+            backlog=LISTEN_BACKLOG, reuse_port=reuse_port, on_start=started,
+            io_threads=io_threads or async_server.IO_THREADS
+        )
+    except KeyboardInterrupt:
+        print("\n[SERVER] Server interrupted by user")
+    except Exception as e:
+        print(f"[SERVER ERROR] {e}")
+    finally:
+        shutdown_server()
+
+def start_reactor_server(host=HOST, port=PORT, reuse_port=False, on_start=None):
+    """Start the ClassChat server on a selectors/epoll reactor"""
+    import reactor_server
+    
+    limit = raise_file_limit()
+    
+    def started(adopt):
+        if on_start:
+            on_start(adopt)
+        print_banner(host, port, "reactor")
+        if limit:
+            print(f"[SERVER] Open file limit: {limit}\n")
+    
+    try:
+        reactor_server.run(
+            host, port,
+            client_connected, handle_frame, client_disconnected,
+            backlog=LISTEN_BACKLOG, reuse_port=reuse_port, on_start=started
+        )
+    except KeyboardInterrupt:
+        print("\n[SERVER] Server interrupted by user")
+    except Exception as e:
+        print(f"[SERVER ERROR] {e}")
+    finally:
+        shutdown_server()
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="ClassChat Bonus 5.3 server")
+    parser.add_argument("--mode", choices=["thread", "asyncio", "reactor"], default="thread",
+                        help="I/O model: thread per client, asyncio event loop or selectors reactor "
+                             "(the reactor runs offline-store and spool I/O on its loop)")
+    parser.add_argument("--io-threads", type=int,
+                        help="asyncio mode: threads for logins, offline-store queries and spool writes, "
+                             "which would block the event loop (default 4)")
+    parser.add_argument("--host", default=HOST, help=f"Bind address (default {HOST})")
+    parser.add_argument("--port", type=int, default=PORT, help=f"Listen port (default {PORT})")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the port (SO_REUSEPORT, default 1); "
+                             "each keeps its own offline database and spool (offline.w0.db, spool.w0, ...)")
+    parser.add_argument("--cluster", metavar="URL",
+                        help="Join a cluster of servers through a message bus, e.g. tcp://127.0.0.1:12500 "
+                             "(start the broker with src/broker.py)")
+    parser.add_argument("--node",
+                        help="Name of this server in the cluster (default HOST:PORT)")
+    parser.add_argument("--queue-limit", type=int, default=DEFAULT_QUEUE_LIMIT,
+                        help=f"Frames queued per client before the overflow policy applies (default {DEFAULT_QUEUE_LIMIT})")
+    parser.add_argument("--queue-policy", choices=OVERFLOW_POLICIES, default=DROP_OLDEST,
+                        help="What to do with a client whose queue is full (default drop_oldest)")
+    parser.add_argument("--offline-db", default=DEFAULT_DB_PATH,
+                        help=f"SQLite database for the offline message queue (default {DEFAULT_DB_PATH})")
+    parser.add_argument("--offline-quota", type=int, default=DEFAULT_USER_MESSAGES,
+                        help=f"Messages queued per offline user, 0 for no limit (default {DEFAULT_USER_MESSAGES})")
+    parser.add_argument("--offline-quota-bytes", type=int, default=DEFAULT_USER_BYTES,
+                        help=f"Bytes (files included) queued per offline user, 0 for no limit (default {DEFAULT_USER_BYTES})")
+    parser.add_argument("--offline-total", type=int, default=DEFAULT_TOTAL_MESSAGES,
+                        help=f"Messages queued for all users, 0 for no limit (default {DEFAULT_TOTAL_MESSAGES})")
+    parser.add_argument("--offline-total-bytes", type=int, default=DEFAULT_TOTAL_BYTES,
+                        help=f"Bytes queued for all users, 0 for no limit (default {DEFAULT_TOTAL_BYTES})")
+    parser.add_argument("--offline-ttl", type=float, default=DEFAULT_TTL / 3600,
+                        help=f"Hours an offline message is kept, 0 for no expiry (default {DEFAULT_TTL // 3600})")
+    parser.add_argument("--offline-eviction", choices=EVICTION_POLICIES, default=EVICT_FILES_FIRST,
+                        help="What goes first when a quota is exceeded: oldest messages, "
+                             "or stored files before text (default files_first)")
+    parser.add_argument("--spool-dir", default=DEFAULT_SPOOL_DIR,
+                        help=f"Directory for files waiting for offline users (default {DEFAULT_SPOOL_DIR})")
+    parser.add_argument("--presence-window", type=float, default=DEFAULT_WINDOW,
+                        help=f"Seconds to batch join/leave updates, 0 to send each one (default {DEFAULT_WINDOW})")
+    parser.add_argument("--compress-threshold", type=int, default=DEFAULT_THRESHOLD,
+                        help=f"Compress frames from this many bytes for clients that ask (default {DEFAULT_THRESHOLD})")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="Do not offer compression to clients")
+    parser.add_argument("--metrics-file",
+                        help="JSON file for periodic latency/queue statistics (default: none, use /stats)")
+    parser.add_argument("--metrics-interval", type=float, default=DEFAULT_DUMP_INTERVAL,
+                        help=f"Seconds between metrics file updates (default {DEFAULT_DUMP_INTERVAL})")
+    args = parser.parse_args()
+    if args.cluster and args.workers > 1:
+        parser.error("--cluster runs one process per node: start more nodes instead of --workers")
+    return args
+
+def configure(args, index=None, count=1):
+    """Apply the command line options (index: this worker, when there are count of them)"""
+    def own(path):
+        return worker_path(path, index) if index is not None else path
+    
+    configure_outbound(args.queue_limit, args.queue_policy, spill_to_offline, metrics)
+    configure_presence(args.presence_window)
+    configure_compression(None if args.no_compression else args.compress_threshold)
+    configure_metrics(own(args.metrics_file) if args.metrics_file else None, args.metrics_interval)
+    
+    # Each worker queues for its own users: the store-wide quotas are shared out
+    configure_offline_store(
+        own(args.offline_db), own(args.spool_dir),
+        user_messages=args.offline_quota,
+        user_bytes=args.offline_quota_bytes,
+        total_messages=args.offline_total // count,
+        total_bytes=args.offline_total_bytes // count,
+        ttl=args.offline_ttl * 3600,
+        eviction=args.offline_eviction
+    )
+
+def serve(args, reuse_port=False, on_start=None):
+    """Run the server in the chosen I/O mode until interrupted"""
+    if args.mode == "asyncio":
+        start_async_server(args.host, args.port, reuse_port, on_start, args.io_threads)
+    elif args.mode == "reactor":
+        start_reactor_server(args.host, args.port, reuse_port, on_start)
+    else:
+        start_server(args.host, args.port, reuse_port, on_start)
+
+def worker_main(index, count, fabric_dir, args):
+    """Entry point of one worker process (see workers.py)"""
+    global spool_base
+    spool_base = args.spool_dir
+    configure(args, index, count)
+    
+    def start_peers(adopt):
+        # Listening: now other workers may hand us clients
+        global peers, adopt_socket
+        adopt_socket = adopt
+        peers = WorkerFabric(index, count, fabric_dir, handle_peer_message)
+    
+    try:
+        serve(args, True, start_peers)
+    except KeyboardInterrupt:
+        pass
+
+def start_cluster(args):
+    """on_start hook joining the cluster once the server listens"""
+    def join(adopt):
+        global peers, cluster
+        cluster = True
+        peers = open_bus(args.cluster, args.node or f"{args.host}:{args.port}", handle_peer_message)
+        peers.start()
+    return join
 
 def main():
     """Main entry point"""
+    args = parse_args()
+    if args.workers > 1:
+        run_workers(args.workers, worker_main, args)
+        return
+    
+    configure(args)
     try:
-        start_server()
+        serve(args, on_start=start_cluster(args) if args.cluster else None)
     except KeyboardInterrupt:
         print("\n[SERVER] Shutting down...")
         sys.exit(0)
@@ -14,6 +14,8 @@ import sys
 import threading
 import json
 
+from framing import send_frame, iter_frames
+
 # Server configuration
 HOST = '127.0.0.1'
 PORT = 12345
@@ -32,7 +34,7 @@ def broadcast_user_list():
         })
         for username, (client_socket, _) in clients.items():
             try:
-                client_socket.send(message.encode('utf-8'))
+                send_frame(client_socket, message.encode('utf-8'))
             except:
                 pass
 
@@ -46,8 +48,9 @@ def handle_client(client_socket, address):
     try:
         # Step 1: Client Registration
         # Ask for username
-        client_socket.send("Enter your username: ".encode('utf-8'))
-        username_data = client_socket.recv(1024)
+        send_frame(client_socket, "Enter your username: ".encode('utf-8'))
+        frames = iter_frames(client_socket)
+        username_data = next(frames, None)
         
         if not username_data:
             client_socket.close()
@@ -62,7 +65,7 @@ def handle_client(client_socket, address):
                     "status": "error",
                     "message": f"Username '{username}' is already taken. Disconnecting..."
                 })
-                client_socket.send(error_msg.encode('utf-8'))
+                send_frame(client_socket, error_msg.encode('utf-8'))
                 client_socket.close()
                 return
             
@@ -76,7 +79,7 @@ def handle_client(client_socket, address):
             "status": "success",
             "message": f"Welcome {username}! You are now connected to ClassChat."
         })
-        client_socket.send(welcome.encode('utf-8'))
+        send_frame(client_socket, welcome.encode('utf-8'))
         
         # Notify all clients about new user
         join_notification = json.dumps({
@@ -87,7 +90,7 @@ def handle_client(client_socket, address):
             for user, (sock, _) in clients.items():
                 if user != username:
                     try:
-                        sock.send(join_notification.encode('utf-8'))
+                        send_frame(sock, join_notification.encode('utf-8'))
                     except:
                         pass
         
@@ -95,13 +98,7 @@ def handle_client(client_socket, address):
         broadcast_user_list()
         
         # Step 2 & 3: Receive and Forward Messages
-        while True:
-            data = client_socket.recv(4096)
-            
-            if not data:
-                print(f"[SERVER] {username} disconnected")
-                break
-            
+        for data in frames:
             try:
                 # Parse JSON message
                 message_data = json.loads(data.decode('utf-8'))
@@ -121,7 +118,7 @@ def handle_client(client_socket, address):
                             "status": "error",
                             "message": f"User '{receiver}' is not connected."
                         })
-                        client_socket.send(error_response.encode('utf-8'))
+                        send_frame(client_socket, error_response.encode('utf-8'))
                         continue
                     
                     # Get receiver's socket
@@ -136,14 +133,14 @@ def handle_client(client_socket, address):
                 })
                 
                 try:
-                    receiver_socket.send(forward_message.encode('utf-8'))
+                    send_frame(receiver_socket, forward_message.encode('utf-8'))
                     
                     # Send confirmation to sender
                     confirmation = json.dumps({
                         "status": "sent",
                         "message": f"Message delivered to {receiver}"
                     })
-                    client_socket.send(confirmation.encode('utf-8'))
+                    send_frame(client_socket, confirmation.encode('utf-8'))
                     
                 except Exception as e:
                     # Failed to send to receiver
@@ -151,14 +148,14 @@ def handle_client(client_socket, address):
                         "status": "error",
                         "message": f"Failed to deliver message to {receiver}"
                     })
-                    client_socket.send(error_response.encode('utf-8'))
+                    send_frame(client_socket, error_response.encode('utf-8'))
             
             except json.JSONDecodeError:
                 error_response = json.dumps({
                     "status": "error",
                     "message": "Invalid message format. Please use JSON."
                 })
-                client_socket.send(error_response.encode('utf-8'))
+                send_frame(client_socket, error_response.encode('utf-8'))
             
             except Exception as e:
                 print(f"[ERROR] {username}: {e}")
@@ -167,9 +164,11 @@ def handle_client(client_socket, address):
                     "message": f"Server error: {str(e)}"
                 })
                 try:
-                    client_socket.send(error_response.encode('utf-8'))
+                    send_frame(client_socket, error_response.encode('utf-8'))
                 except:
                     pass
+        
+        print(f"[SERVER] {username} disconnected")
     
     except Exception as e:
         print(f"[ERROR] Client handler error: {e}")
@@ -191,7 +190,7 @@ def handle_client(client_socket, address):
             with clients_lock:
                 for user, (sock, _) in clients.items():
                     try:
-                        sock.send(leave_notification.encode('utf-8'))
+                        send_frame(sock, leave_notification.encode('utf-8'))
                     except:
                         pass
             
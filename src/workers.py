@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+ClassChat Workers
+Multi-process server: N worker processes share the listening port.
+
+One CPython process saturates a core on JSON parsing long before the
+network is busy. With --workers N the server forks N workers that each
+bind the same port with SO_REUSEPORT, so the kernel spreads incoming
+connections over them, and each worker runs the normal chat logic on
+its own core.
+
+Every username has a home worker (CRC32 of the name modulo N). A worker
+that accepts a connection reads the username and, if the user lives
+elsewhere, passes the socket itself to the home worker over a Unix
+domain socket (SCM_RIGHTS) together with any bytes it has already read.
+The client never notices: the home worker carries on from the username
+frame. So every worker owns a fixed subset of the users, and the things
+that must be unique or durable per user stay in one process:
+
+- username checks and the user's connection
+- the user's offline queue and stored files (one database per worker)
+
+The rest travels over the routing fabric, a mesh of Unix domain sockets
+between the workers carrying framed JSON (see handle_peer_message() in
+server_bonus3.py):
+
+    deliver        a direct message (or old-style file) for a user homed there
+    presence       a user came online or went offline
+    membership     a group join or leave (every worker keeps all groups)
+    group_message  an @group message for the members connected there
+    file           a stored file for a user homed there
+    group_file     a group file for the members homed there
+    handoff        a client socket (the descriptor rides along)
+
+Stored files are handed over by hard-linking them into the other
+worker's spool, so only the name crosses the fabric.
+
+Sends are queued and written by one thread per peer, so a worker holding
+a registry lock never waits on another process.
+"""
+
+import base64
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+
+from framing import FrameDecoder, encode_frame, encode_message, RECV_BUFFER_SIZE
+
+# Seconds a worker keeps retrying to reach a peer that is still starting
+CONNECT_TIMEOUT = 10.0
+
+# Descriptors accepted with one read (each handoff carries one)
+MAX_FDS = 16
+
+def home_worker(username, count):
+    """Worker index that owns a username (stable across processes)"""
+    return zlib.crc32(username.encode('utf-8')) % count
+
+def worker_path(path, index):
+    """Per-worker variant of a file or directory path: offline.db -> offline.w1.db"""
+    root, extension = os.path.splitext(path)
+    return f"{root}.w{index}{extension}"
+
+def pending_bytes(payloads, decoder):
+    """Input not processed yet: decoded payloads (re-framed) and the decoder's partial frame"""
+    return b"".join(encode_frame(payload) for payload in payloads) + bytes(decoder.buffer)
+
+class PeerLink:
+    """Outbound link to one peer worker: a queue drained by a writer thread"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.queue = deque()  # (frame, fd or None)
+        self.ready = threading.Condition()
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+    
+    def send(self, frame, fd=None):
+        with self.ready:
+            self.queue.append((frame, fd))
+            self.ready.notify()
+    
+    def connect(self):
+        """Connect to the peer, waiting for it to start listening"""
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                return sock
+            except OSError:
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+    
+    def write_loop(self):
+        try:
+            sock = self.connect()
+        except OSError as e:
+            print(f"[WORKER] Could not reach {self.path}: {e}")
+            return
+        
+        while True:
+            with self.ready:
+                while not self.queue:
+                    self.ready.wait()
+                frame, fd = self.queue.popleft()
+            
+            try:
+                if fd is None:
+                    sock.sendall(frame)
+                else:
+                    # The descriptor travels with the first byte; send the rest after it
+                    sent = socket.send_fds(sock, [frame], [fd])
+                    sock.sendall(frame[sent:])
+            except OSError as e:
+                print(f"[WORKER] Link to {self.path} failed: {e}")
+                return
+            finally:
+                if fd is not None:
+                    os.close(fd)
+
+class WorkerFabric:
+    """Routing fabric of one worker: its listener and links to every other worker"""
+    
+    def __init__(self, index, count, directory, on_message):
+        self.index = index
+        self.count = count
+        self.directory = directory
+        self.on_message = on_message  # on_message(message, fd) in a reader thread
+        self.links = {peer: PeerLink(self.path(peer)) for peer in range(count) if peer != index}
+        
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path(index))
+        self.listener.listen(count)
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+    
+    def path(self, index):
+        return os.path.join(self.directory, f"worker-{index}.sock")
+    
+    def home(self, username):
+        return home_worker(username, self.count)
+    
+    def send(self, peer, message):
+        self.links[peer].send(encode_message(message))
+    
+    def broadcast(self, message):
+        """Send a message to every other worker (serialized once)"""
+        frame = encode_message(message)
+        for link in self.links.values():
+            link.send(frame)
+    
+    def hand_off(self, peer, sock, address, preload):
+        """Pass a client socket and its unprocessed input to another worker"""
+        message = {
+            "op": "handoff",
+            "address": list(address) if address else None,
+            "preload": base64.b64encode(preload).decode('ascii')
+        }
+        # The link closes its duplicate once sent; the caller closes the original
+        self.links[peer].send(encode_message(message), os.dup(sock.fileno()))
+    
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.read_loop, args=(sock,), daemon=True).start()
+    
+    def read_loop(self, sock):
+        """Dispatch messages from one peer; descriptors are matched to handoffs in order"""
+        decoder = FrameDecoder()
+        fds = deque()
+        while True:
+            try:
+                data, received_fds, _, _ = socket.recv_fds(sock, RECV_BUFFER_SIZE, MAX_FDS)
+            except OSError:
+                break
+            if not data:
+                break
+            fds.extend(received_fds)
+            
+            for payload in decoder.feed(data):
+                message = json.loads(payload.decode('utf-8'))
+                fd = fds.popleft() if message.get("op") == "handoff" else None
+                try:
+                    self.on_message(message, fd)
+                except Exception as e:
+                    print(f"[WORKER {self.index}] Error handling {message.get('op')}: {e}")
+        sock.close()
+
+def run_workers(count, target, *args):
+    """
+    Fork count workers running target(index, count, fabric_dir, *args) and
+    wait for them. Ctrl+C reaches every worker (same process group); if
+    one worker dies the others are stopped too.
+    """
+    # kill (SIGTERM) shuts down like Ctrl+C, in this process and the workers
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    
+    directory = tempfile.mkdtemp(prefix="classchat-workers-")
+    processes = [multiprocessing.Process(target=target, args=(index, count, directory) + args)
+                 for index in range(count)]
+    for process in processes:
+        process.start()
+    print(f"[SERVER] Started {count} worker(s): pids {', '.join(str(p.pid) for p in processes)}")
+    
+    try:
+        while all(process.is_alive() for process in processes):
+            time.sleep(0.5)
+        print("[SERVER] A worker exited - stopping the others")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Ctrl+C in a terminal already reached the workers; give them a moment,
+        # then stop the rest (SIGTERM runs their shutdown too), then insist
+        deadline = time.monotonic() + 2
+        while any(process.is_alive() for process in processes) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(10)
+            if process.is_alive():
+                process.kill()
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)